@@ -1,36 +1,78 @@
 import os
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-import requests
-import pandas as pd
-from recommendation_engine import WhiskyRecommender
-from data_loader import load_whisky_data
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+import time
+import numpy as np
+from flask import (Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort,
+                   Response, stream_with_context, g)
+from catalog_manager import CatalogManager, refresh_interval_from_env
+from baxus_client import BaxusClient, BaxusAPIError
+from result_store import get_result_store, bar_fingerprint
+from explanation_cache import get_explanation_cache
+from explanation_stream import ExplanationStreams, explanation_events, sse_event
+from instrumentation import span, start_trace, log_payload, render_metrics, REQUEST_SECONDS, CACHE_EVENTS
+
+# Configure logging (LOG_LEVEL=DEBUG also logs a sample of the request payloads)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # Create Flask app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
 
-# Load whisky data from Google Sheets
-whisky_data = None
-try:
-    whisky_data = load_whisky_data()
-    logger.info(f"Loaded {len(whisky_data)} whisky bottles")
-except Exception as e:
-    logger.error(f"Error loading whisky data: {e}")
+# Startup is split in phases: importing this module only sets up the web layer
+# (pandas, scikit-learn and the catalog are not imported here), /healthz answers
+# right away and /readyz once a catalog is loaded. The catalog is loaded in a
+# background thread (CATALOG_LOAD=background, the default), by the first request
+# that needs it (lazy) or before the import returns (eager). Requests wait up to
+# CATALOG_WAIT_TIMEOUT seconds for the first load.
+CATALOG_LOAD = os.environ.get("CATALOG_LOAD", "background")
+CATALOG_WAIT_TIMEOUT = float(os.environ.get("CATALOG_WAIT_TIMEOUT", 60))
 
-# Initialize the recommender engine
-whisky_recommender = None
-if whisky_data is not None:
-    whisky_recommender = WhiskyRecommender(whisky_data)
-    logger.info("Whisky recommender initialized")
+def load_catalog(current_version):
+    """
+    Recommender from the local catalog snapshot, rebuilt from Google Sheets only when
+    the sheet changed (CATALOG_OFFLINE=1 skips the check). Under Gunicorn the master
+    keeps the snapshot up to date (gunicorn.conf.py) and sets CATALOG_SHARED_SNAPSHOT=1,
+    so workers only memory-map it.
+    """
+    from data_loader import load_recommender
+    recommender = load_recommender(
+        refresh=os.environ.get("CATALOG_OFFLINE") != "1" and os.environ.get("CATALOG_SHARED_SNAPSHOT") != "1",
+        current_version=current_version
+    )
+    if recommender is not None and current_version is None:
+        logger.info(f"Whisky recommender initialized with {len(recommender.catalog)} bottles "
+                    f"(catalog {recommender.catalog_version})")
+    return recommender
 
-# Função utilitária para converter numpy types para tipos nativos Python
-import numpy as np
+# The catalog manager reloads it in the background every CATALOG_REFRESH_INTERVAL
+# seconds or on an admin trigger, and swaps the new recommender in atomically.
+catalog_manager = CatalogManager(load_catalog, refresh_interval=refresh_interval_from_env())
+if CATALOG_LOAD == 'eager':
+    catalog_manager.reload()
+elif CATALOG_LOAD != 'lazy':
+    catalog_manager.trigger_reload()
+catalog_manager.start()
+
+# BAXUS API client (pooled session, timeouts, retries and a short per-user cache)
+baxus_client = BaxusClient()
+
+# Contadores dos caches em /metrics, lidos na hora (o cliente e o recomendador podem ser trocados)
+CACHE_EVENTS.register('explanations', lambda: get_explanation_cache().stats())
+CACHE_EVENTS.register('results', lambda: get_result_store().stats())
+CACHE_EVENTS.register('baxus_bars', lambda: baxus_client.cache_stats())
+
+# With LLM_STREAMING=1 the recommendations page is rendered with the rule-based
+# messages and the LLM explanations are pushed to it over Server-Sent Events
+LLM_STREAMING = os.environ.get("LLM_STREAMING", "1") == "1"
+# A stream holds a server thread until it ends, so it needs a threaded worker
+# (gthread, see gunicorn.conf.py) and is cut off well before the worker timeout
+# (WORKER_TIMEOUT, also read by gunicorn.conf.py), whatever the LLM is doing
+WORKER_TIMEOUT = float(os.environ.get("WORKER_TIMEOUT", 30))
+STREAM_TIMEOUT = max(1.0, min(float(os.environ.get("LLM_STREAM_TIMEOUT", 20)), WORKER_TIMEOUT - 5))
+explanation_streams = ExplanationStreams()
 
+# Função utilitária para converter numpy types para tipos nativos Python
 def convert_numpy(obj):
     if isinstance(obj, dict):
         return {k: convert_numpy(v) for k, v in obj.items()}
@@ -41,6 +83,40 @@ def convert_numpy(obj):
     else:
         return obj
 
+@app.before_request
+def start_request_trace():
+    g.request_start = time.perf_counter()
+    g.timings = start_trace()
+
+@app.after_request
+def record_request_duration(response):
+    if 'request_start' in g:
+        elapsed = time.perf_counter() - g.request_start
+        REQUEST_SECONDS.observe(elapsed, request.url_rule.rule if request.url_rule else 'unmatched',
+                                request.method, str(response.status_code))
+        if g.timings and logger.isEnabledFor(logging.DEBUG):
+            stages = ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in g.timings.items())
+            logger.debug(f"{request.method} {request.path} took {elapsed * 1000:.1f}ms ({stages})")
+    return response
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the web process answers (the catalog may still be loading)"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 once a catalog is loaded, 503 before (and starts a lazy load or a due retry)"""
+    ready = catalog_manager.wait(0) is not None
+    status = {'ready': ready, 'catalog_version': catalog_manager.catalog_version,
+              'loading': catalog_manager.reloading, 'last_error': catalog_manager.last_error}
+    return jsonify(status), 200 if ready else 503
+
+@app.route('/metrics')
+def metrics():
+    """Stage and request latency histograms in the Prometheus text format"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -57,27 +133,35 @@ def analyze():
     
     # Fetch user bar data from BAXUS API
     try:
-        api_url = f"http://services.baxus.co/api/bar/user/{username}"
-        response = requests.get(api_url)
-        
-        if response.status_code != 200:
-            flash(f'Error fetching bar data: {response.status_code}', 'danger')
+        try:
+            with span('baxus_fetch'):
+                bar_data = baxus_client.get_bar(username)
+        except BaxusAPIError as e:
+            flash(f'Error fetching bar data: {e.status_code or e}', 'danger')
             return redirect(url_for('index'))
         
-        # Store bar data in session
-        bar_data = response.json()
-        logger.warning(f"Raw BAXUS API response for user {username}: {bar_data}")
+        log_payload(logger, f"Raw BAXUS API response for user {username}", bar_data)
         if not bar_data:
             flash('No bottles found in your BAXUS collection', 'warning')
             return redirect(url_for('index'))
 
-        # Generate recommendations
+        # Generate recommendations (the whole request uses the same recommender instance)
+        whisky_recommender = catalog_manager.wait(CATALOG_WAIT_TIMEOUT)
         if whisky_recommender is not None:
-            user_profile, similar_recs, complementary_recs, bar_stats = whisky_recommender.get_recommendations(bar_data)
-            logger.warning(f"Extracted user_profile: {user_profile}")
-            logger.warning(f"Similar recommendations: {similar_recs}")
-            logger.warning(f"Complementary recommendations: {complementary_recs}")
-            logger.warning(f"Bar stats: {bar_stats}")
+            # Results are kept server-side; the session only carries a short token
+            result_store = get_result_store()
+            token = result_store.make_token(username, whisky_recommender.catalog_version)
+            fingerprint = bar_fingerprint(bar_data)
+            stored = result_store.get_result(token)
+            if stored is not None and stored.get('bar_fingerprint') == fingerprint:
+                logger.debug(f"Reusing stored recommendations for user {username}")
+                session['result_token'] = token
+                return redirect(url_for('recommendations'))
+            
+            user_profile, similar_recs, complementary_recs, bar_stats = whisky_recommender.get_recommendations(
+                bar_data, explain=not LLM_STREAMING, user_key=username
+            )
+            log_payload(logger, "Recommendations", (user_profile, similar_recs, complementary_recs, bar_stats))
             
             # Ensure user_profile has required keys
             user_profile = user_profile or {}
@@ -85,11 +169,26 @@ def analyze():
             user_profile.setdefault('min_price', 0)
             user_profile.setdefault('max_price', 0)
             
-            # Convert all results to native Python types before saving to session
-            session['user_profile'] = convert_numpy(user_profile)
-            session['similar_recommendations'] = convert_numpy(similar_recs)
-            session['complementary_recommendations'] = convert_numpy(complementary_recs)
-            session['bar_stats'] = convert_numpy(bar_stats)
+            # Convert all results to native Python types before storing them
+            result = convert_numpy({
+                'bar_fingerprint': fingerprint,
+                'user_profile': user_profile,
+                'similar_recommendations': similar_recs,
+                'complementary_recommendations': complementary_recs,
+                'bar_stats': bar_stats,
+                'explanations_pending': LLM_STREAMING
+            })
+            result['bar_stats_key'] = result_store.put_chart_data(result['bar_stats'])
+            result_store.put_result(token, result)
+            session['result_token'] = token
+            
+            if LLM_STREAMING:
+                def store_explanations(explained):
+                    # Only if the stored result is still the one being explained
+                    current = result_store.get_result(token)
+                    if current is not None and current.get('bar_fingerprint') == fingerprint:
+                        result_store.put_result(token, explained)
+                explanation_streams.start(token, whisky_recommender, result, on_complete=store_explanations)
             
             return redirect(url_for('recommendations'))
         else:
@@ -108,19 +207,266 @@ def recommendations():
         not username or
         username.strip() == '' or
         username.lower() in ['test', 'default', 'none']
-        or 'similar_recommendations' not in session
     ):
         flash('Please enter a valid username first.', 'warning')
         return redirect(url_for('index'))
 
-    return render_template(
-        'recommendations.html',
-        username=username,
-        user_profile=session['user_profile'],
-        similar_recommendations=session['similar_recommendations'],
-        complementary_recommendations=session['complementary_recommendations'],
-        bar_stats=session['bar_stats']
+    result = get_result_store().get_result(session.get('result_token'))
+    if result is None:
+        flash('Your recommendations have expired, please analyze your collection again.', 'warning')
+        return redirect(url_for('index'))
+
+    # Chart data is fetched by the page from api_bar_stats; stored again if it was evicted first
+    result_store = get_result_store()
+    bar_stats_key = result.get('bar_stats_key')
+    if bar_stats_key is None or result_store.get_chart_data(bar_stats_key) is None:
+        bar_stats_key = result_store.put_chart_data(result['bar_stats'])
+
+    with span('render'):
+        return render_template(
+            'recommendations.html',
+            username=username,
+            user_profile=result['user_profile'],
+            similar_recommendations=result['similar_recommendations'],
+            complementary_recommendations=result['complementary_recommendations'],
+            bar_stats_key=bar_stats_key,
+            explanations_pending=result.get('explanations_pending', False)
+        )
+
+@app.route('/recommendations/stream')
+def recommendations_stream():
+    """Server-Sent Events with the LLM explanations of the current result"""
+    token = session.get('result_token')
+    if get_result_store().get_result(token) is None:
+        abort(404)
+    # Sem threads (worker sync) o stream bloquearia o worker inteiro: só envia o que já existe, sem esperar
+    wait = STREAM_TIMEOUT if request.environ.get('wsgi.multithread') else 0
+
+    def generate():
+        job = explanation_streams.get(token)
+        if job is not None:
+            for event in job.iter_events(wait):
+                yield sse_event(event)
+        else:
+            # Explanations generated by another worker: wait until they are stored
+            deadline = time.monotonic() + wait
+            result = get_result_store().get_result(token)
+            while result is not None and result.get('explanations_pending') and time.monotonic() < deadline:
+                time.sleep(0.5)
+                result = get_result_store().get_result(token)
+            if result is not None and not result.get('explanations_pending'):
+                for event in explanation_events(result):
+                    yield sse_event(event)
+        yield sse_event({}, event='done')
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# JSON API
+
+API_BATCH_LIMIT = int(os.environ.get("API_BATCH_LIMIT", 100))
+# Chart data never changes for a given key, so caches may keep it as long as they want
+CHART_DATA_MAX_AGE = int(os.environ.get("CHART_DATA_MAX_AGE", 86400))
+
+def api_error(message, status_code):
+    return jsonify({'error': message}), status_code
+
+def api_bar_data(item):
+    """
+    Bar payload of an API request item: the raw 'bar' list, or the BAXUS bar of 'username'
+    
+    Returns (bar_data, None) or (None, (error message, status code)).
+    """
+    if item.get('bar') is not None:
+        if not isinstance(item['bar'], list):
+            return None, ("'bar' must be a list of BAXUS bar items", 400)
+        return item['bar'], None
+    username = item.get('username')
+    if not username or not isinstance(username, str):
+        return None, ("Provide a 'username' or a 'bar'", 400)
+    try:
+        return baxus_client.get_bar(username), None
+    except BaxusAPIError as e:
+        return None, (f"Error fetching bar data: {e.status_code or e}", 404 if e.status_code == 404 else 502)
+
+def api_result(recommendations):
+    user_profile, similar_recs, complementary_recs, bar_stats = recommendations
+    return convert_numpy({
+        'user_profile': user_profile,
+        'similar_recommendations': similar_recs,
+        'complementary_recommendations': complementary_recs,
+        'bar_stats': bar_stats
+    })
+
+def parse_flag(value, name):
+    """JSON boolean, 0/1, or a "true"/"false"/"0"/"1" string; ValueError for anything else"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ('true', '1', 'false', '0'):
+        return value.strip().lower() in ('true', '1')
+    raise ValueError(f"'{name}' must be true or false")
+
+def api_options(payload, explain_default):
+    num_recommendations = payload.get('num_recommendations', 5)
+    if not isinstance(num_recommendations, int) or not 1 <= num_recommendations <= 50:
+        raise ValueError("'num_recommendations' must be an integer between 1 and 50")
+    # "explain" liga as chamadas ao LLM (o caminho lento): também aceito na query string
+    explain = payload.get('explain', request.args.get('explain', explain_default))
+    return num_recommendations, parse_flag(explain, 'explain')
+
+@app.route('/api/recommendations', methods=['POST'])
+def api_recommendations():
+    """
+    Recommendations for one user as JSON
+    
+    Body: {"username": ...} or {"bar": [...BAXUS bar items...]}, plus optional
+    "num_recommendations" (default 5) and "explain" (LLM explanations, default true).
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return api_error("Expected a JSON object", 400)
+    try:
+        num_recommendations, explain = api_options(payload, explain_default=True)
+    except ValueError as e:
+        return api_error(str(e), 400)
+    
+    whisky_recommender = catalog_manager.wait(CATALOG_WAIT_TIMEOUT)
+    if whisky_recommender is None:
+        return api_error("Recommendation engine not available", 503)
+    
+    bar_data, error = api_bar_data(payload)
+    if error:
+        return api_error(*error)
+    
+    # Só um bar buscado na BAXUS para esse username atualiza o perfil incremental dele:
+    # um 'bar' enviado no corpo não pode sobrescrever o estado de outro usuário
+    user_key = payload['username'] if payload.get('bar') is None else None
+    recommendations = whisky_recommender.get_recommendations(
+        bar_data, num_recommendations, explain=explain, user_key=user_key
     )
+    return jsonify({'catalog_version': whisky_recommender.catalog_version, **api_result(recommendations)})
+
+@app.route('/api/bar-stats/<key>')
+def api_bar_stats(key):
+    """Chart data of an analyzed bar, by the content key from ResultStore.put_chart_data"""
+    payload = get_result_store().get_chart_data(key)
+    if payload is None:
+        return api_error("Unknown chart data", 404)
+    response = Response(payload, mimetype='application/json')
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = CHART_DATA_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+@app.route('/api/bottles/<bottle_id>/similar')
+def api_similar_bottles(bottle_id):
+    """
+    Bottles like one catalog bottle ("more like this")
+    
+    Query string: optional "n" (number of bottles, default 5).
+    """
+    try:
+        num_recommendations = int(request.args.get('n', 5))
+    except ValueError:
+        num_recommendations = None
+    if num_recommendations is None or not 1 <= num_recommendations <= 50:
+        return api_error("'n' must be an integer between 1 and 50", 400)
+    
+    whisky_recommender = catalog_manager.wait(CATALOG_WAIT_TIMEOUT)
+    if whisky_recommender is None:
+        return api_error("Recommendation engine not available", 503)
+    
+    with span('similar_to_bottle'):
+        result = whisky_recommender.similar_to_bottle(bottle_id, num_recommendations)
+    if result is None:
+        return api_error(f"Unknown bottle id: {bottle_id}", 404)
+    bottle, similar_recs = result
+    return jsonify(convert_numpy({
+        'catalog_version': whisky_recommender.catalog_version,
+        'bottle': bottle,
+        'similar_bottles': similar_recs,
+    }))
+
+@app.route('/api/recommendations/batch', methods=['POST'])
+def api_recommendations_batch():
+    """
+    Recommendations for many users in one call
+    
+    Body: {"users": [{"username": ...} or {"bar": [...]}, ...]}, plus optional
+    "num_recommendations" and "explain" (default false). Each item may carry an "id"
+    that is echoed back; results keep the order of "users".
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('users'), list):
+        return api_error("Expected a JSON object with a 'users' list", 400)
+    users = payload['users']
+    if len(users) > API_BATCH_LIMIT:
+        return api_error(f"At most {API_BATCH_LIMIT} users per batch", 400)
+    try:
+        num_recommendations, explain = api_options(payload, explain_default=False)
+    except ValueError as e:
+        return api_error(str(e), 400)
+    
+    whisky_recommender = catalog_manager.wait(CATALOG_WAIT_TIMEOUT)
+    if whisky_recommender is None:
+        return api_error("Recommendation engine not available", 503)
+    
+    results = [None] * len(users)
+    bars, positions = [], []
+    for position, item in enumerate(users):
+        if not isinstance(item, dict):
+            results[position] = {'error': "Each user must be a JSON object", 'status': 400}
+            continue
+        bar_data, error = api_bar_data(item)
+        if error:
+            results[position] = {'error': error[0], 'status': error[1]}
+        else:
+            bars.append(bar_data)
+            positions.append(position)
+    
+    batch = whisky_recommender.get_recommendations_batch(bars, num_recommendations, explain=explain)
+    for position, recommendations in zip(positions, batch):
+        results[position] = api_result(recommendations)
+    for item, result in zip(users, results):
+        if isinstance(item, dict) and 'id' in item:
+            result['id'] = item['id']
+    
+    return jsonify({'catalog_version': whisky_recommender.catalog_version, 'results': results})
+
+def require_admin():
+    """Abort with 403 unless the request carries the ADMIN_TOKEN in X-Admin-Token"""
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token or request.headers.get('X-Admin-Token') != admin_token:
+        abort(403)
+
+@app.route('/admin/reload-catalog', methods=['POST'])
+def reload_catalog():
+    """Start a background catalog reload"""
+    require_admin()
+    started = catalog_manager.trigger_reload()
+    return jsonify({'reload_started': started, **catalog_manager.status()}), 202
+
+@app.route('/admin/catalog')
+def catalog_status():
+    require_admin()
+    return jsonify(catalog_manager.status())
+
+@app.route('/admin/retrieval')
+def retrieval_report():
+    """Recall of the similar-bottle search backend against the exact scan"""
+    require_admin()
+    whisky_recommender = catalog_manager.wait(CATALOG_WAIT_TIMEOUT)
+    if whisky_recommender is None:
+        return jsonify({'error': 'Recommendation engine not available'}), 503
+    num_queries = min(request.args.get('queries', 100, type=int), 1000)
+    k = request.args.get('k', 10, type=int)
+    return jsonify(whisky_recommender.retriever.measure_recall(num_queries=num_queries, k=k))
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -0,0 +1,133 @@
+import os
+import logging
+import threading
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BAXUS_API_URL = "http://services.baxus.co/api"
+
+
+class BaxusAPIError(Exception):
+    """Error fetching data from the BAXUS API (status_code is None for network errors)"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _InFlight:
+    """A BAXUS call shared by every request waiting for the same username"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BaxusClient:
+    """
+    Client for the BAXUS bar API.
+
+    Uses a pooled session with connect/read timeouts and retries with backoff,
+    caches each user's bar for `cache_ttl` seconds (LRU of `cache_size` users), and
+    collapses concurrent requests for the same username into a single upstream call.
+    """
+
+    def __init__(self, base_url=None, connect_timeout=None, read_timeout=None, retries=None,
+                 backoff_factor=None, cache_ttl=None, pool_size=None, cache_size=None):
+        self.base_url = (base_url or os.environ.get("BAXUS_API_URL", DEFAULT_BAXUS_API_URL)).rstrip('/')
+        self.timeout = (
+            float(connect_timeout or os.environ.get("BAXUS_CONNECT_TIMEOUT", 3)),
+            float(read_timeout or os.environ.get("BAXUS_READ_TIMEOUT", 10))
+        )
+        self.cache_ttl = float(cache_ttl if cache_ttl is not None else os.environ.get("BAXUS_CACHE_TTL", 60))
+        retries = int(retries if retries is not None else os.environ.get("BAXUS_RETRIES", 2))
+        backoff_factor = float(backoff_factor if backoff_factor is not None else os.environ.get("BAXUS_BACKOFF", 0.3))
+        pool_size = int(pool_size or os.environ.get("BAXUS_POOL_SIZE", 10))
+        cache_size = int(cache_size if cache_size is not None else os.environ.get("BAXUS_CACHE_SIZE", 1024))
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._cache = TTLCache(max_entries=cache_size if self.cache_ttl > 0 else 0, ttl=self.cache_ttl)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_bar(self, username):
+        """
+        Bottles in the user's BAXUS bar (the parsed JSON list)
+
+        Raises BaxusAPIError on HTTP errors, timeouts and connection errors.
+        """
+        with self._lock:
+            cached = self._cache.get(username)
+            if cached is not None:
+                return cached
+            call = self._in_flight.get(username)
+            leader = call is None
+            if leader:
+                call = self._in_flight[username] = _InFlight()
+
+        if not leader:
+            # Another request is already fetching this bar: wait for its result
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._fetch_bar(username)
+            self._cache.set(username, call.result)
+            return call.result
+        except BaxusAPIError as e:
+            call.error = e
+            raise
+        except Exception as e:
+            # Qualquer outra falha também chega aos pedidos em espera, nunca como um bar vazio
+            call.error = BaxusAPIError(f"Error fetching BAXUS bar: {e}")
+            raise call.error from e
+        finally:
+            with self._lock:
+                del self._in_flight[username]
+            call.done.set()
+
+    def _fetch_bar(self, username):
+        url = f"{self.base_url}/bar/user/{quote(username, safe='')}"
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise BaxusAPIError(f"BAXUS API unavailable: {e}") from e
+        if response.status_code != 200:
+            raise BaxusAPIError(f"BAXUS API returned {response.status_code}", response.status_code)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise BaxusAPIError(f"Invalid BAXUS API response: {e}", response.status_code) from e
+
+    def invalidate(self, username=None):
+        """Drop the cached bar of a user (or of every user)"""
+        if username is None:
+            self._cache.clear()
+        else:
+            self._cache.delete(username)
+
+    def cache_stats(self):
+        """Hit, miss and eviction counters of the bar cache (see TTLCache.stats)"""
+        return self._cache.stats()
+
+    def close(self):
+        self.session.close()
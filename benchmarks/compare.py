@@ -0,0 +1,57 @@
+"""
+Compare two benchmark result files.
+
+Usage (from the repository root):
+
+    python -m benchmarks.compare benchmarks/results/baseline.json benchmarks/results/current.json
+"""
+import sys
+import json
+
+
+def _key(entry):
+    return entry['stage'], entry['catalog_size'], entry.get('bar_size')
+
+
+def compare_results(baseline, current):
+    """Rows with the median of every stage present in both reports, and current / baseline"""
+    baseline_entries = {_key(entry): entry for entry in baseline['results']}
+    rows = []
+    for entry in current['results']:
+        previous = baseline_entries.get(_key(entry))
+        if previous is None:
+            continue
+        rows.append({
+            'stage': entry['stage'],
+            'catalog_size': entry['catalog_size'],
+            'bar_size': entry.get('bar_size'),
+            'baseline_ms': previous['median_ms'],
+            'current_ms': entry['median_ms'],
+            'ratio': entry['median_ms'] / previous['median_ms'] if previous['median_ms'] else float('inf'),
+        })
+    return rows
+
+
+def print_comparison(rows):
+    print(f"{'stage':<28} {'catalog':>8} {'bar':>6} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for row in rows:
+        bar = row['bar_size'] if row['bar_size'] is not None else '-'
+        print(f"{row['stage']:<28} {row['catalog_size']:>8} {bar:>6} {row['baseline_ms']:>12.2f} "
+              f"{row['current_ms']:>12.2f} {row['ratio']:>6.2f}x")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print(__doc__)
+        return 2
+    with open(argv[0]) as f:
+        baseline = json.load(f)
+    with open(argv[1]) as f:
+        current = json.load(f)
+    print_comparison(compare_results(baseline, current))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Deterministic synthetic data for the benchmarks.
+
+make_catalog builds a raw catalog with the columns of the Google Sheet export
+(before preprocess_whisky_data), make_bar builds a BAXUS bar payload in the
+shape returned by /bar/user/<username>.
+"""
+import io
+import numpy as np
+import pandas as pd
+
+SPIRITS = [
+    'Bourbon', 'Rye', 'Scotch', 'Canadian Whisky', 'Japanese Whisky', 'Irish Whiskey',
+    'American Whiskey', 'Tennessee Whiskey', 'Wheat Whiskey', 'Single Malt', 'Blended Whisky', 'World Whisky'
+]
+REGIONS = [
+    'Kentucky', 'Tennessee', 'Islay', 'Speyside', 'Highland', 'Lowland', 'Campbeltown', 'Japan',
+    'Ireland', 'Canada', 'Indiana', 'Texas', 'Colorado', 'New York', 'Taiwan', 'India'
+]
+SIZES = ['375', '700', '750', '1000', '1750']
+
+
+def _category_names(base, count, prefix):
+    names = list(base[:count])
+    names.extend(f"{prefix} {i}" for i in range(len(names), count))
+    return np.array(names, dtype=object)
+
+
+def _with_missing(values, rate, rng):
+    values = np.asarray(values, dtype=object if values.dtype.kind in 'OUS' else np.float64).copy()
+    values[rng.random(len(values)) < rate] = None if values.dtype == object else np.nan
+    return values
+
+
+def make_catalog(num_bottles, num_brands=None, num_spirits=len(SPIRITS), num_regions=len(REGIONS),
+                 missing_rate=0.1, seed=0):
+    """
+    Raw catalog DataFrame with the Google Sheet columns
+
+    Brand popularity is skewed (a few brands own many bottles), as in the real
+    catalog. `missing_rate` is the share of empty cells in the optional columns
+    (spirit, region, price, proof, age, ...).
+    """
+    rng = np.random.default_rng(seed)
+    num_brands = num_brands or max(50, min(num_bottles // 10, 20000))
+    brands = _category_names([], num_brands, 'Brand')
+    spirits = _category_names(SPIRITS, num_spirits, 'Spirit')
+    regions = _category_names(REGIONS, num_regions, 'Region')
+
+    brand_weights = 1.0 / np.arange(1, num_brands + 1) ** 0.8
+    brand_codes = rng.choice(num_brands, size=num_bottles, p=brand_weights / brand_weights.sum())
+    msrp = np.round(rng.lognormal(4.2, 0.8, num_bottles), 2)
+    abv = np.round(rng.uniform(40, 65, num_bottles), 1)
+
+    return pd.DataFrame({
+        'ID': rng.permutation(num_bottles) + 1,
+        'Name': [f"Bottle {i}" for i in range(num_bottles)],
+        'Brand': brands[brand_codes],
+        'Spirit': _with_missing(spirits[rng.integers(0, num_spirits, num_bottles)], missing_rate, rng),
+        'Spirit Type': _with_missing(spirits[rng.integers(0, num_spirits, num_bottles)], 0.5, rng),
+        'Region': _with_missing(regions[rng.integers(0, num_regions, num_bottles)], missing_rate, rng),
+        'Size': np.array(SIZES, dtype=object)[rng.integers(0, len(SIZES), num_bottles)],
+        'Price': _with_missing(np.round(msrp * rng.uniform(0.9, 1.3, num_bottles), 2), missing_rate * 3, rng),
+        'Proof': _with_missing(abv * 2, missing_rate, rng),
+        'ABV': abv,
+        'Age': _with_missing(rng.integers(3, 30, num_bottles).astype(float), 0.5, rng),
+        'Average MSRP': _with_missing(msrp, missing_rate, rng),
+        'Fair Price': np.round(msrp * 1.05, 2),
+        'Shelf Price': np.round(msrp * 1.15, 2),
+        'Popularity': rng.integers(0, 200000, num_bottles),
+        'Image URL': [f"https://img.example.com/{i}" for i in range(num_bottles)],
+    })
+
+
+def catalog_csv(catalog):
+    """CSV text of a raw catalog, as downloaded from the sheet"""
+    buffer = io.StringIO()
+    catalog.to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+
+def make_bar(catalog, num_bottles, unknown_rate=0.05, missing_rate=0.1, seed=0, username='benchmark'):
+    """
+    BAXUS bar payload with `num_bottles` items drawn from a preprocessed catalog
+
+    About `unknown_rate` of the products are not in the catalog, and `missing_rate`
+    of them lack proof or brand, as user-added bottles often do.
+    """
+    rng = np.random.default_rng(seed)
+    positions = rng.choice(len(catalog), size=min(num_bottles, len(catalog)), replace=False)
+    rows = catalog.iloc[positions]
+    bar = []
+    for i, row in enumerate(rows.itertuples(index=False)):
+        product = {
+            'id': int(row.id) if rng.random() >= unknown_rate else 10 ** 9 + i,
+            'name': row.name,
+            'image_url': row.image_url if hasattr(row, 'image_url') else None,
+            'brand_id': i,
+            'brand': row.brand if rng.random() >= missing_rate else None,
+            'spirit': row.spirit,
+            'size': '750',
+            'proof': float(row.proof) if rng.random() >= missing_rate else None,
+            'average_msrp': float(row.price),
+            'fair_price': round(float(row.price) * 1.05, 2),
+            'shelf_price': round(float(row.price) * 1.15, 2),
+            'popularity': int(rng.integers(0, 200000)),
+            'barrel_pick': False,
+            'private': False,
+            'user_added': False,
+        }
+        bar.append({
+            'id': 1000000 + i,
+            'bar_id': 1000000 + i,
+            'price': None,
+            'note': None,
+            'created_at': '2024-03-14T22:47:31.183Z',
+            'updated_at': '2024-08-26T19:11:25.442Z',
+            'user_id': 100000,
+            'release_id': product['id'],
+            'fill_percentage': 0,
+            'added': '2024-03-12T00:00:00.000Z',
+            'user': {'user_name': username},
+            'product': product,
+        })
+    return bar
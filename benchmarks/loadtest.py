@@ -0,0 +1,445 @@
+"""
+End-to-end load test of the web app against local stand-ins for BAXUS and the LLM.
+
+Usage (from the repository root):
+
+    python -m benchmarks.loadtest --concurrency 20 --duration 60
+    python -m benchmarks.loadtest --catalog-size 50000 --bar-sizes 10,50,500:0.1 \\
+        --baxus-latency 0.15 --llm-latency 0.8 --llm-error-rate 0.05 --output benchmarks/results/load.json
+
+Runs offline on one machine. A stub server serves the catalog CSV, the BAXUS bar
+API (/api/bar/user/<username>) and an OpenAI-style chat completions endpoint, each
+with its own latency, jitter and error rate (batched LLM prompts get a JSON reply,
+optionally missing some bottles). The app runs in a subprocess (Gunicorn by
+default, or the Flask server) pointed at the stubs, with a temporary catalog
+snapshot. Virtual users then run closed-loop sessions: analyze a bar, open
+the recommendations page, fetch the chart data and wait for the streamed LLM
+explanations. The report has throughput and latency percentiles per session step,
+and per server stage from the /metrics histograms (with several Gunicorn workers,
+/metrics shows one worker's share).
+"""
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import logging
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_loader import preprocess_whisky_data
+from benchmarks.generators import make_catalog, catalog_csv, make_bar
+from benchmarks.run import git_revision
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEPS = ['analyze', 'recommendations', 'bar_stats', 'explanations', 'session']
+
+
+class StubService:
+    """Simulated latency (normal, in seconds) and error rate of one upstream"""
+
+    def __init__(self, latency, jitter, error_rate, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Sleep for one call; returns True if the call should fail"""
+        with self._lock:
+            delay = max(0.0, self._rng.gauss(self.latency, self.jitter))
+            failed = self._rng.random() < self.error_rate
+            self.calls += 1
+            self.errors += failed
+        time.sleep(delay)
+        return failed
+
+
+class BarPool:
+    """BAXUS bar payloads, one per username, with sizes drawn from a weighted list"""
+
+    def __init__(self, catalog, sizes, weights, seed):
+        self.catalog = catalog
+        self.sizes = sizes
+        self.weights = weights
+        self.seed = seed
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def payload(self, username):
+        with self._lock:
+            body = self._payloads.get(username)
+        if body is None:
+            # Mesmo usuário, mesmo bar: o tamanho e as garrafas dependem só do nome
+            seed = self.seed + zlib.crc32(username.encode())
+            size = random.Random(seed).choices(self.sizes, self.weights)[0]
+            bar = make_bar(self.catalog, size, seed=seed, username=username)
+            body = json.dumps(bar).encode()
+            with self._lock:
+                self._payloads[username] = body
+        return body
+
+
+# Items of a batched prompt, as written by WhiskyRecommender.build_llm_batch_prompt
+BATCH_ITEM = re.compile(r'^- id (\S+?):', re.MULTILINE)
+
+
+def stub_completion(prompt, drop_rate, rng):
+    """Reply of the stub LLM: a JSON array for batched prompts (items dropped at drop_rate), else one sentence"""
+    ids = BATCH_ITEM.findall(prompt)
+    if not ids:
+        return f"Stub explanation for a {len(prompt)}-character prompt."
+    return json.dumps([{'id': item_id, 'message': f"Stub explanation for bottle {item_id}."}
+                       for item_id in ids if rng.random() >= drop_rate])
+
+
+def make_stub_handler(catalog_body, bars, baxus, llm, llm_drop_rate=0.0):
+    rng = random.Random(0)
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body, content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/catalog.csv':
+                self._send(200, catalog_body, 'text/csv')
+            elif self.path.startswith('/api/bar/user/'):
+                username = unquote(self.path[len('/api/bar/user/'):])
+                if baxus.wait():
+                    self._send(503, b'{"error":"stub failure"}')
+                else:
+                    self._send(200, bars.payload(username))
+            else:
+                self._send(404, b'{"error":"not found"}')
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if self.path != '/v1/chat/completions':
+                self._send(404, b'{"error":"not found"}')
+                return
+            if llm.wait():
+                self._send(500, b'{"error":{"message":"stub failure"}}')
+                return
+            prompt = json.loads(body)['messages'][-1]['content']
+            content = stub_completion(prompt, llm_drop_rate, rng)
+            self._send(200, json.dumps({
+                'object': 'chat.completion',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4},
+            }).encode())
+
+    return StubHandler
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(args, stub_url, port, snapshot_dir, log_file):
+    env = dict(
+        os.environ,
+        BAXUS_API_URL=f"{stub_url}/api",
+        BAXUS_CACHE_TTL=str(args.baxus_cache_ttl),
+        LLM_API_URL=f"{stub_url}/v1/chat/completions",
+        LLM_API_KEY='stub',
+        LLM_STREAMING='1',
+        LLM_BATCH=args.llm_batch,
+        CATALOG_URL=f"{stub_url}/catalog.csv",
+        CATALOG_SNAPSHOT_DIR=snapshot_dir,
+        CATALOG_OFFLINE='0',
+        CATALOG_REFRESH_INTERVAL='0',
+        LOG_LEVEL='WARNING',
+    )
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', 'main:app', '--bind', f'127.0.0.1:{port}',
+                   '--workers', str(args.workers), '--threads', str(args.threads), '--worker-class', 'gthread',
+                   '--timeout', '120', '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-c', f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def wait_until_ready(base_url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with status {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/readyz", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"The app was not ready after {timeout}s")
+
+
+def run_session(http, base_url, username, timeout):
+    """One user visit; returns {step: (seconds, ok)}"""
+    timings = {}
+    started = time.perf_counter()
+
+    def timed(step, function, check=None):
+        start = time.perf_counter()
+        try:
+            response = function()
+            ok = response.status_code < 400 if check is None else check(response)
+        except requests.RequestException:
+            response, ok = None, False
+        timings[step] = (time.perf_counter() - start, ok)
+        return response if ok else None
+
+    response = timed('analyze', lambda: http.post(f"{base_url}/analyze", data={'username': username},
+                                                  allow_redirects=False, timeout=timeout))
+    if response is not None and not response.headers.get('Location', '').endswith('/recommendations'):
+        # Redirected back to the form with an error message
+        timings['analyze'] = (timings['analyze'][0], False)
+        response = None
+    # Sem resultados a página redireciona para o formulário ("expired"): conta como falha
+    page = response and timed(
+        'recommendations',
+        lambda: http.get(f"{base_url}/recommendations", allow_redirects=False, timeout=timeout),
+        lambda page: page.status_code == 200 and 'id="barStatsData"' in page.text
+    )
+    if page is not None:
+        match = re.search(r'id="barStatsData" data-url="([^"]+)"', page.text)
+        if match:
+            timed('bar_stats', lambda: http.get(f"{base_url}{match.group(1)}", timeout=timeout))
+        if 'id="explanationStream"' in page.text:
+            def read_stream():
+                stream = http.get(f"{base_url}/recommendations/stream", stream=True, timeout=timeout)
+                for line in stream.iter_lines(decode_unicode=True):
+                    if line == 'event: done':
+                        break
+                stream.close()
+                return stream
+            timed('explanations', read_stream)
+    timings['session'] = (time.perf_counter() - started, all(ok for _, ok in timings.values()))
+    return timings
+
+
+def drive(args, base_url):
+    """Closed-loop virtual users; returns ({step: [(seconds, ok), ...]}, elapsed seconds)"""
+    samples = {step: [] for step in STEPS}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + args.duration
+    sessions_left = [args.sessions or float('inf')]
+
+    def virtual_user(number):
+        rng = random.Random(args.seed + number)
+        http = requests.Session()
+        if args.new_connections:
+            # Cookies mantidos, mas uma conexão nova por pedido (os pedidos espalham-se pelos workers)
+            http.headers['Connection'] = 'close'
+        while time.monotonic() < stop_at:
+            with lock:
+                if sessions_left[0] <= 0:
+                    break
+                sessions_left[0] -= 1
+            timings = run_session(http, base_url, f"loaduser{rng.randrange(args.users)}", args.timeout)
+            with lock:
+                for step, sample in timings.items():
+                    samples[step].append(sample)
+            if args.think_time:
+                time.sleep(rng.expovariate(1 / args.think_time))
+        http.close()
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=virtual_user, args=(number,), daemon=True) for number in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.monotonic() - started
+
+
+def scrape_stage_histograms(base_url):
+    """{stage: (bucket bounds, cumulative counts)} from the app's /metrics"""
+    histograms = {}
+    pattern = re.compile(r'^whisky_stage_duration_seconds_bucket\{stage="([^"]+)",le="([^"]+)"\} (\d+)$')
+    for line in requests.get(f"{base_url}/metrics", timeout=10).text.splitlines():
+        match = pattern.match(line)
+        if match:
+            stage, le, count = match.groups()
+            bounds, counts = histograms.setdefault(stage, ([], []))
+            bounds.append(float(le))
+            counts.append(int(count))
+    return histograms
+
+
+def histogram_quantile(bounds, counts, quantile):
+    """Upper bound of the bucket holding the quantile (as Prometheus without interpolation)"""
+    total = counts[-1] if counts else 0
+    if total == 0:
+        return None
+    for bound, count in zip(bounds, counts):
+        if count >= quantile * total:
+            return bound
+    return bounds[-1]
+
+
+def stage_report(before, after):
+    rows = []
+    for stage, (bounds, counts) in sorted(after.items()):
+        previous = before.get(stage, (bounds, [0] * len(counts)))[1]
+        delta = [count - old for count, old in zip(counts, previous)]
+        if delta and delta[-1] > 0:
+            rows.append((stage, delta[-1], *(histogram_quantile(bounds, delta, q) for q in (0.5, 0.9, 0.99))))
+    return rows
+
+
+def summarize(samples, elapsed, catalog_size):
+    results = []
+    for step in STEPS:
+        if not samples[step]:
+            continue
+        seconds = np.array([value for value, _ in samples[step]]) * 1000
+        errors = sum(not ok for _, ok in samples[step])
+        p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+        results.append({
+            'stage': f"load {step}",
+            'catalog_size': catalog_size,
+            'bar_size': None,
+            'repeat': len(seconds),
+            'errors': errors,
+            'rps': len(seconds) / elapsed,
+            'min_ms': float(seconds.min()),
+            'median_ms': float(p50),
+            'p90_ms': float(p90),
+            'p99_ms': float(p99),
+            'max_ms': float(seconds.max()),
+        })
+    return results
+
+
+def parse_bar_sizes(value):
+    """"10,50,500:0.1" -> sizes and weights (default weight 1)"""
+    sizes, weights = [], []
+    for item in value.split(','):
+        size, _, weight = item.strip().partition(':')
+        sizes.append(int(size))
+        weights.append(float(weight) if weight else 1.0)
+    return sizes, weights
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the web app against local BAXUS and LLM stubs")
+    parser.add_argument('--server', choices=['gunicorn', 'flask'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=1, help="Gunicorn workers")
+    parser.add_argument('--threads', type=int, default=16, help="Threads per Gunicorn worker")
+    parser.add_argument('--concurrency', type=int, default=10, help="Virtual users running sessions in parallel")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds of load")
+    parser.add_argument('--sessions', type=int, default=None, help="Stop after this many sessions")
+    parser.add_argument('--think-time', type=float, default=0, help="Mean pause between a user's sessions (s)")
+    parser.add_argument('--users', type=int, default=500, help="Distinct usernames (repeat visits reuse results)")
+    parser.add_argument('--catalog-size', type=int, default=20000)
+    parser.add_argument('--bar-sizes', type=parse_bar_sizes, default=parse_bar_sizes('10,50,200:0.3'),
+                        help="Bottles per bar, with optional weights (e.g. 10,50,500:0.1)")
+    parser.add_argument('--baxus-latency', type=float, default=0.1, help="Mean BAXUS latency (s)")
+    parser.add_argument('--baxus-jitter', type=float, default=0.03, help="Standard deviation of the BAXUS latency (s)")
+    parser.add_argument('--baxus-error-rate', type=float, default=0.0)
+    parser.add_argument('--baxus-cache-ttl', type=float, default=0, help="App-side BAXUS cache (s)")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="Mean LLM latency per call (s)")
+    parser.add_argument('--llm-jitter', type=float, default=0.2, help="Standard deviation of the LLM latency (s)")
+    parser.add_argument('--llm-error-rate', type=float, default=0.0)
+    parser.add_argument('--llm-batch-drop-rate', type=float, default=0.0,
+                        help="Share of bottles left out of batched LLM replies (answered one by one)")
+    parser.add_argument('--llm-batch', choices=['1', '0'], default='1', help="LLM_BATCH of the app")
+    parser.add_argument('--new-connections', action='store_true',
+                        help="Open a new connection for every request instead of keeping one per virtual user")
+    parser.add_argument('--timeout', type=float, default=60, help="Client timeout per request (s)")
+    parser.add_argument('--ready-timeout', type=float, default=600, help="Seconds to wait for the catalog")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="Result file (same format as benchmarks.run)")
+    args = parser.parse_args(argv)
+    logging.disable(logging.CRITICAL)
+
+    print(f"Generating a {args.catalog_size}-bottle catalog", flush=True)
+    raw = make_catalog(args.catalog_size, seed=args.seed)
+    catalog_body = catalog_csv(raw).encode()
+    bars = BarPool(preprocess_whisky_data(raw), *args.bar_sizes, seed=args.seed)
+    baxus = StubService(args.baxus_latency, args.baxus_jitter, args.baxus_error_rate, args.seed)
+    llm = StubService(args.llm_latency, args.llm_jitter, args.llm_error_rate, args.seed + 1)
+
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(catalog_body, bars, baxus, llm,
+                                                                      args.llm_batch_drop_rate))
+    stub.daemon_threads = True
+    threading.Thread(target=stub.serve_forever, name="stubs", daemon=True).start()
+    stub_url = f"http://127.0.0.1:{stub.server_port}"
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory(prefix='whisky-loadtest-') as workdir:
+        log_path = os.path.join(workdir, 'app.log')
+        with open(log_path, 'w') as log_file:
+            process = start_app(args, stub_url, port, os.path.join(workdir, 'snapshot'), log_file)
+            try:
+                print(f"Starting the app ({args.server}) on {base_url}", flush=True)
+                try:
+                    wait_until_ready(base_url, process, args.ready_timeout)
+                except RuntimeError:
+                    log_file.flush()
+                    with open(log_path) as f:
+                        print(f.read()[-4000:])
+                    raise
+                before = scrape_stage_histograms(base_url)
+                print(f"Running {args.concurrency} virtual users for {args.duration:g}s", flush=True)
+                samples, elapsed = drive(args, base_url)
+                after = scrape_stage_histograms(base_url)
+            finally:
+                process.terminate()
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+    stub.shutdown()
+
+    results = summarize(samples, elapsed, args.catalog_size)
+    print(f"\n{'step':<18} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for entry in results:
+        print(f"{entry['stage'][5:]:<18} {entry['repeat']:>7} {entry['errors']:>7} {entry['rps']:>8.2f} "
+              f"{entry['median_ms']:>9.1f} {entry['p90_ms']:>9.1f} {entry['p99_ms']:>9.1f} {entry['max_ms']:>9.1f}")
+    print(f"\n{'server stage':<18} {'count':>7} {'p50 <=':>9} {'p90 <=':>9} {'p99 <=':>9}  (seconds, histogram buckets)")
+    for stage, count, p50, p90, p99 in stage_report(before, after):
+        print(f"{stage:<18} {count:>7} {p50:>9g} {p90:>9g} {p99:>9g}")
+    print(f"\nStub calls: BAXUS {baxus.calls} ({baxus.errors} failed), LLM {llm.calls} ({llm.errors} failed)")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        options = {key: value for key, value in vars(args).items() if key != 'output'}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'git_revision': git_revision(),
+                                'options': options, 'elapsed_s': elapsed,
+                                'stub_calls': {'baxus': baxus.calls, 'llm': llm.calls}},
+                       'results': results}, f, indent=2, default=str)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
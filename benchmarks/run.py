@@ -0,0 +1,207 @@
+"""
+Benchmark the catalog preprocessing and the recommendation pipeline.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run --sizes 1000,10000,100000 --output benchmarks/results/current.json
+    python -m benchmarks.run --sizes 1000000 --bar-sizes 50 --repeat 3
+    python -m benchmarks.run --baseline benchmarks/results/baseline.json
+
+The LLM is replaced by a stub, so get_recommendations runs the whole pipeline
+(including explanation assembly) without network calls.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import statistics
+import subprocess
+import logging
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_loader import preprocess_whisky_data, read_catalog_csv
+from recommendation_engine import WhiskyRecommender
+from benchmarks.generators import make_catalog, catalog_csv, make_bar
+from benchmarks.compare import compare_results, print_comparison
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class StubLLMClient:
+    """Answers every prompt immediately, like an LLM endpoint with zero latency"""
+    batch = True
+
+    def iter_many(self, prompts, deadline=None):
+        for position, prompt in enumerate(prompts):
+            yield position, f"Stub explanation ({len(prompt)} characters of prompt)"
+
+    def iter_batched(self, prompts, ids, build_batch_prompt, deadline=None):
+        prompt = build_batch_prompt(list(range(len(prompts))))
+        for position in range(len(prompts)):
+            yield position, f"Stub explanation ({len(prompt)} characters of batched prompt)"
+
+
+class NullCache:
+    """Explanation cache that never hits, so every run builds all prompts"""
+
+    @staticmethod
+    def make_key(bottle_id, user_profile, catalog_version=None):
+        return bottle_id
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+def time_call(function, repeat, setup=None):
+    """Wall-clock times in ms of `repeat` calls (after one warm-up call)"""
+    timings = []
+    for run in range(repeat + 1):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        function(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        if run > 0:
+            timings.append(elapsed)
+    return timings
+
+
+def record(results, stage, catalog_size, timings, bar_size=None):
+    entry = {
+        'stage': stage,
+        'catalog_size': catalog_size,
+        'bar_size': bar_size,
+        'repeat': len(timings),
+        'min_ms': min(timings),
+        'median_ms': statistics.median(timings),
+        'max_ms': max(timings),
+    }
+    results.append(entry)
+    bar = f" bar={bar_size}" if bar_size is not None else ""
+    print(f"{stage:<28} catalog={catalog_size:<8}{bar:<10} median {entry['median_ms']:10.2f} ms  "
+          f"min {entry['min_ms']:10.2f} ms", flush=True)
+
+
+def benchmark_catalog(size, args, results):
+    raw = make_catalog(size, num_brands=args.brands, num_spirits=args.spirits, num_regions=args.regions,
+                       missing_rate=args.missing_rate, seed=args.seed)
+    # O catálogo grande é caro de gerar: menos repetições para as etapas de carga
+    load_repeat = max(1, args.repeat if size <= 100000 else args.repeat // 2)
+
+    if not args.skip_csv:
+        text = catalog_csv(raw)
+        record(results, 'read_csv', size, time_call(lambda: pd.read_csv(io.StringIO(text)), load_repeat))
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write(text)
+        del text
+        try:
+            record(results, 'read_catalog_csv', size, time_call(lambda: read_catalog_csv(f.name), load_repeat))
+        finally:
+            os.remove(f.name)
+
+    record(results, 'preprocess_whisky_data', size,
+           time_call(preprocess_whisky_data, load_repeat, setup=lambda: (raw.copy(),)))
+    catalog = preprocess_whisky_data(raw.copy())
+    del raw
+
+    record(results, 'WhiskyRecommender.__init__', size,
+           time_call(WhiskyRecommender, load_repeat, setup=lambda: (catalog.copy(),)))
+    recommender = WhiskyRecommender(catalog, llm_client=StubLLMClient(), explanation_cache=NullCache())
+
+    for bar_size in args.bar_sizes:
+        bar = make_bar(recommender.whisky_data, bar_size, seed=args.seed + bar_size)
+        user_df = recommender.build_user_dataframe(bar)
+        user_profile = recommender.analyze_user_preferences(user_df)
+        record(results, 'find_similar_bottles', size, time_call(
+            lambda: recommender.find_similar_bottles(user_df, 5, user_profile, explain=False), args.repeat
+        ), bar_size)
+        record(results, 'find_complementary_bottles', size, time_call(
+            lambda: recommender.find_complementary_bottles(user_df, user_profile, 5, explain=False), args.repeat
+        ), bar_size)
+        record(results, 'calculate_bar_stats', size, time_call(
+            lambda: recommender.calculate_bar_stats(user_df), args.repeat
+        ), bar_size)
+        record(results, 'get_recommendations', size, time_call(
+            lambda: recommender.get_recommendations(bar, 5), args.repeat
+        ), bar_size)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(RESULTS_DIR)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_sizes(value):
+    return [int(float(size)) for size in value.split(',') if size.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the whisky recommender")
+    parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes('1000,10000,100000'),
+                        help="Catalog sizes, comma separated (e.g. 1000,10000,1e6)")
+    parser.add_argument('--bar-sizes', type=parse_sizes, default=parse_sizes('10,100,1000'),
+                        help="Bottles per user bar, comma separated")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per stage (after one warm-up)")
+    parser.add_argument('--brands', type=int, default=None, help="Distinct brands (default: catalog size / 10)")
+    parser.add_argument('--spirits', type=int, default=12, help="Distinct spirits")
+    parser.add_argument('--regions', type=int, default=16, help="Distinct regions")
+    parser.add_argument('--missing-rate', type=float, default=0.1, help="Share of empty optional cells")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-csv', action='store_true', help="Do not time the catalog CSV reading stages")
+    parser.add_argument('--output', default=None,
+                        help="Result file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument('--baseline', default=None, help="Result file to compare against")
+    parser.add_argument('--max-slowdown', type=float, default=None,
+                        help="Exit with status 1 if a stage is this many times slower than the baseline")
+    args = parser.parse_args(argv)
+
+    # As etapas registram em DEBUG/WARNING; aqui só interessa o tempo
+    logging.disable(logging.CRITICAL)
+
+    results = []
+    for size in args.sizes:
+        benchmark_catalog(size, args, results)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'options': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        },
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare_results(baseline, report)
+        print_comparison(rows)
+        if args.max_slowdown and any(row['ratio'] > args.max_slowdown for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
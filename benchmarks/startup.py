@@ -0,0 +1,117 @@
+"""
+Measure the web process startup: importing app and answering the first health check.
+
+Usage (from the repository root):
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --repeat 10 --budget-ms 500 --output benchmarks/results/startup.json
+
+Every run is a fresh interpreter with CATALOG_LOAD=lazy, so only the web layer is
+timed (the catalog loading stages are measured by benchmarks.run). The run fails
+(exit status 1) when the median import time is over the budget or when one of the
+heavy modules is imported on the startup path.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+from benchmarks.run import record, git_revision
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import time budget of the startup path (median, ms)
+IMPORT_BUDGET_MS = float(os.environ.get("STARTUP_IMPORT_BUDGET_MS", 750))
+# Modules that must only be imported when the catalog is loaded
+HEAVY_MODULES = ('pandas', 'sklearn', 'scipy')
+
+PROBE = """
+import sys, json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/healthz')
+answered = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'healthz_ms': (answered - start) * 1000,
+    'status': response.status_code,
+    'modules': sorted({name.split('.')[0] for name in sys.modules}),
+}))
+"""
+
+
+def run_probe(importtime=False):
+    env = dict(os.environ, CATALOG_LOAD='lazy', CATALOG_REFRESH_INTERVAL='0', LOG_LEVEL='WARNING')
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', PROBE]
+    completed = subprocess.run(command, capture_output=True, text=True, cwd=ROOT, env=env, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+
+def slowest_imports(importtime_output, limit):
+    """Modules imported directly by app, by cumulative import time (us)"""
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Children are listed before their parent, indented two more spaces (after the separator's one)
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level == 0:
+            if name.strip() == 'app':
+                break
+            imports = []
+        elif level == 1:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the web process startup")
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters timed")
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS,
+                        help="Maximum median time to import app (default: STARTUP_IMPORT_BUDGET_MS or 750)")
+    parser.add_argument('--top', type=int, default=10, help="Slowest imports listed")
+    parser.add_argument('--output', default=None, help="Result file (same format as benchmarks.run)")
+    args = parser.parse_args(argv)
+
+    probes = [run_probe()[0] for _ in range(args.repeat)]
+    results = []
+    record(results, 'import app', 0, [probe['import_ms'] for probe in probes])
+    record(results, 'first /healthz', 0, [probe['healthz_ms'] for probe in probes])
+
+    probe, importtime_output = run_probe(importtime=True)
+    print("\nSlowest imports of app:")
+    for cumulative, name in slowest_imports(importtime_output, args.top):
+        print(f"  {name:<28} {cumulative / 1000:8.1f} ms")
+
+    problems = []
+    if any(probe['status'] != 200 for probe in probes):
+        problems.append("/healthz did not answer 200")
+    import_ms = statistics.median(probe['import_ms'] for probe in probes)
+    if import_ms > args.budget_ms:
+        problems.append(f"importing app took {import_ms:.0f} ms, budget is {args.budget_ms:.0f} ms")
+    heavy = [name for name in HEAVY_MODULES if name in probe['modules']]
+    if heavy:
+        problems.append(f"heavy modules imported on the startup path: {', '.join(heavy)}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'git_revision': git_revision(),
+                                'python': sys.version.split()[0], 'budget_ms': args.budget_ms},
+                       'results': results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print(f"OK: app imports in {import_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogManager:
+    """
+    Holds the current WhiskyRecommender and replaces it when the catalog changes.
+
+    New recommenders are built off the request path (in a background thread) and
+    swapped in with a single reference assignment, so a request that already took a
+    recommender with get() finishes on it, and no request sees a half-built one.
+    """
+
+    def __init__(self, loader, refresh_interval=None, retry_interval=None, max_retry_interval=None):
+        """
+        loader: callable(current_version) returning a new, fully built recommender,
+            or None when the catalog is still at current_version
+        refresh_interval: seconds between scheduled reloads (None or 0 disables them)
+        retry_interval: seconds before a failed load is retried while no catalog is
+            loaded; doubled after each consecutive failure up to max_retry_interval
+        """
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.retry_interval = float(retry_interval if retry_interval is not None
+                                    else os.environ.get("CATALOG_RETRY_INTERVAL", 10))
+        self.max_retry_interval = float(max_retry_interval if max_retry_interval is not None
+                                        else os.environ.get("CATALOG_MAX_RETRY_INTERVAL", 300))
+        self.last_reload = None
+        self.last_error = None
+        self.failures = 0
+        self._last_error_at = None
+        self._recommender = None
+        self._reload_lock = threading.Lock()
+        # Set once the first load finished (successfully or not)
+        self._first_load = threading.Event()
+        self._stop = threading.Event()
+        self._scheduler = None
+
+    def get(self):
+        """Current recommender (None while no catalog has been loaded)"""
+        return self._recommender
+
+    def wait(self, timeout=None):
+        """
+        Current recommender, waiting up to `timeout` seconds for the first catalog load.
+
+        Starts that load in the background if nothing did yet (catalog loaded on first use),
+        or retries it once the backoff after a failed load has passed. Returns None if no
+        catalog is loaded by then.
+        """
+        if self._recommender is None:
+            if self._load_due():
+                # O próximo wait espera por esta nova tentativa
+                self._first_load.clear()
+                self.trigger_reload()
+            self._first_load.wait(timeout)
+        return self._recommender
+
+    def retry_delay(self):
+        """Seconds between the last failed load and the next retry"""
+        return min(self.retry_interval * 2 ** max(self.failures - 1, 0), self.max_retry_interval)
+
+    def _load_due(self):
+        if self.reloading:
+            return False
+        if self.last_reload is None and self.last_error is None:
+            return True
+        return self.last_error is not None and time.monotonic() - self._last_error_at >= self.retry_delay()
+
+    @property
+    def catalog_version(self):
+        recommender = self._recommender
+        return recommender.catalog_version if recommender is not None else None
+
+    @property
+    def reloading(self):
+        return self._reload_lock.locked()
+
+    def reload(self):
+        """
+        Load the catalog and swap the recommender if its version changed.
+
+        Runs in the caller's thread; concurrent calls are skipped. Returns True when
+        a new recommender was swapped in.
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            logger.info("Catalog reload already in progress, skipping")
+            return False
+        try:
+            started = time.monotonic()
+            new_recommender = self.loader(self.catalog_version)
+            self.last_reload = time.time()
+            self.last_error = None
+            self.failures = 0
+            if new_recommender is None:
+                logger.info(f"Catalog unchanged (version {self.catalog_version})")
+                return False
+            old_version = self.catalog_version
+            self._recommender = new_recommender
+            logger.info(f"Catalog swapped from version {old_version} to {new_recommender.catalog_version} "
+                        f"in {time.monotonic() - started:.1f}s")
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            self._last_error_at = time.monotonic()
+            self.failures += 1
+            logger.error(f"Catalog reload failed, keeping version {self.catalog_version}: {e}", exc_info=True)
+            return False
+        finally:
+            self._reload_lock.release()
+            self._first_load.set()
+
+    def trigger_reload(self):
+        """Start a reload in a background thread; returns False if one is already running"""
+        if self.reloading:
+            return False
+        threading.Thread(target=self.reload, name="catalog-reload", daemon=True).start()
+        return True
+
+    def start(self):
+        """Start the scheduled reloads (no-op without a refresh interval)"""
+        if not self.refresh_interval or self._scheduler is not None:
+            return
+        self._scheduler = threading.Thread(target=self._run_schedule, name="catalog-refresher", daemon=True)
+        self._scheduler.start()
+        logger.info(f"Catalog refresher started, interval {self.refresh_interval}s")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run_schedule(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.reload()
+
+    def status(self):
+        return {
+            'ready': self._recommender is not None,
+            'catalog_version': self.catalog_version,
+            'bottles': len(self._recommender.catalog) if self._recommender is not None else 0,
+            'retrieval': self._recommender.retriever.name if self._recommender is not None else None,
+            'reloading': self.reloading,
+            'last_reload': self.last_reload,
+            'last_error': self.last_error,
+            'failures': self.failures,
+            'refresh_interval': self.refresh_interval,
+        }
+
+
+def refresh_interval_from_env():
+    """CATALOG_REFRESH_INTERVAL in seconds, None when unset or 0"""
+    value = float(os.environ.get("CATALOG_REFRESH_INTERVAL", 0) or 0)
+    return value or None
@@ -0,0 +1,355 @@
+import sys
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Colunas do catálogo usadas pelo recomendador; as demais não são mantidas em memória
+CATALOG_COLUMNS = ['id', 'name', 'brand', 'spirit', 'region', 'price', 'proof', 'age', 'image_url',
+                   'average_msrp', 'fair_price', 'shelf_price']
+# Repeated values, stored as integer codes into one (interned) string per category
+CATEGORY_COLUMNS = ['brand', 'spirit', 'region']
+
+
+def _smallest_int(max_value):
+    for dtype in (np.int8, np.int16, np.int32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def _native(value):
+    """Python scalar for a stored value; float32 values keep their shortest decimal form (12.99, not 12.9899...)"""
+    if isinstance(value, np.float32):
+        return float(str(value))
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class CategoryColumn:
+    """Integer codes (-1 for missing) into a sorted array of interned strings"""
+    __slots__ = ('codes', 'categories')
+
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    @classmethod
+    def from_values(cls, values):
+        codes, uniques = pd.factorize(values, sort=True)
+        categories = np.array([sys.intern(value) if isinstance(value, str) else value for value in uniques],
+                              dtype=object)
+        return cls(codes.astype(_smallest_int(len(categories))), categories)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, position):
+        code = self.codes[position]
+        return np.nan if code < 0 else self.categories[code]
+
+    def to_numpy(self):
+        return np.append(self.categories, np.nan)[self.codes]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + sum(sys.getsizeof(value) for value in self.categories)
+
+
+class TextColumn:
+    """Strings packed in one UTF-8 buffer plus row offsets, instead of one Python object per row"""
+    __slots__ = ('data', 'offsets', 'missing')
+
+    def __init__(self, data, offsets, missing):
+        self.data = data
+        self.offsets = offsets
+        self.missing = missing
+
+    @classmethod
+    def from_values(cls, values):
+        missing = np.asarray(pd.isna(values), dtype=bool)
+        encoded = [b'' if absent else str(value).encode('utf-8') for value, absent in zip(values, missing)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, missing)
+
+    def __len__(self):
+        return len(self.missing)
+
+    def __getitem__(self, position):
+        if self.missing[position]:
+            return np.nan
+        return self.data[self.offsets[position]:self.offsets[position + 1]].tobytes().decode('utf-8')
+
+    def to_numpy(self):
+        buffer, offsets = self.data.tobytes(), self.offsets
+        values = np.array([buffer[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(self))],
+                          dtype=object)
+        values[np.asarray(self.missing)] = np.nan
+        return values
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.offsets.nbytes + self.missing.nbytes
+
+
+def _join_categories(pieces, seen):
+    """CategoryColumn from per-block codes into the values in `seen` (in arrival order), with sorted categories"""
+    values = np.empty(len(seen), dtype=object)
+    values[:] = list(seen)
+    order = np.argsort(values, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    codes = np.concatenate(pieces) if pieces else np.array([], dtype=np.int64)
+    codes = np.where(codes >= 0, rank[np.maximum(codes, 0)] if len(rank) else -1, -1)
+    categories = np.array([sys.intern(value) if isinstance(value, str) else value for value in values[order]],
+                          dtype=object)
+    return CategoryColumn(codes.astype(_smallest_int(len(categories))), categories)
+
+
+def _join_text(pieces):
+    """One TextColumn from consecutive blocks"""
+    starts = np.cumsum([0] + [len(piece.data) for piece in pieces[:-1]])
+    offsets = np.concatenate([[0]] + [piece.offsets[1:] + start for piece, start in zip(pieces, starts)])
+    return TextColumn(np.concatenate([piece.data for piece in pieces]), offsets.astype(np.int64),
+                      np.concatenate([piece.missing for piece in pieces]))
+
+
+class BottleRecord:
+    """One catalog bottle, read from a CatalogStore; supports bottle['brand'] and bottle.get('region')"""
+    __slots__ = ('id', 'name', 'brand', 'spirit', 'region', 'price', 'proof', 'age', 'image_url')
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__ if hasattr(self, key)}
+
+    def __repr__(self):
+        return f"BottleRecord({self.to_dict()})"
+
+
+class CatalogStore:
+    """
+    Compact columnar catalog
+
+    Numeric columns are float32 (the id keeps its integer type), brand/spirit/region
+    are category codes and the other text columns are packed UTF-8 buffers. All
+    columns are plain NumPy arrays, so a store can be saved with get_state and
+    memory-mapped back with from_state.
+    """
+
+    def __init__(self, columns):
+        # nome -> ndarray (numeric), CategoryColumn (category) ou TextColumn (text)
+        self.columns = columns
+        self.num_rows = len(next(iter(columns.values()))) if columns else 0
+        self._id_lookup = None
+
+    @classmethod
+    def from_dataframe(cls, data):
+        """Store with the CATALOG_COLUMNS of a preprocessed catalog DataFrame"""
+        return cls.from_chunks([data])
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """
+        Store with the CATALOG_COLUMNS of preprocessed catalog DataFrames, in order
+
+        Each block is converted to compact columns as it arrives (category codes,
+        packed text, float32 numbers), so with a generator only one block is held
+        as a DataFrame at a time.
+        """
+        parts = {}
+        categories = {col: {} for col in CATEGORY_COLUMNS}
+        for data in chunks:
+            for col in CATALOG_COLUMNS:
+                if col not in data.columns:
+                    continue
+                values = data[col]
+                if col in CATEGORY_COLUMNS:
+                    # Códigos globais pela ordem de chegada; ordenados no fim
+                    codes, uniques = pd.factorize(values)
+                    seen = categories[col]
+                    lookup = np.array([seen.setdefault(value, len(seen)) for value in uniques], dtype=np.int64)
+                    part = np.where(codes >= 0, lookup[np.maximum(codes, 0)] if len(lookup) else -1, -1)
+                elif col == 'id':
+                    part = values.to_numpy() if values.dtype.kind in 'biuf' else values.to_numpy(dtype=object)
+                elif values.dtype.kind in 'biuf':
+                    # The other numbers only need float32 precision
+                    part = values.to_numpy(dtype=np.float32)
+                else:
+                    part = TextColumn.from_values(values.to_numpy(dtype=object))
+                parts.setdefault(col, []).append(part)
+
+        columns = {}
+        for col, pieces in parts.items():
+            if col in CATEGORY_COLUMNS:
+                columns[col] = _join_categories(pieces, categories[col])
+            elif col == 'id':
+                if all(piece.dtype.kind in 'biuf' for piece in pieces):
+                    columns[col] = np.concatenate(pieces)
+                else:
+                    columns[col] = TextColumn.from_values(np.concatenate([piece.astype(object) for piece in pieces]))
+            elif all(isinstance(piece, TextColumn) for piece in pieces):
+                columns[col] = _join_text(pieces)
+            else:
+                columns[col] = np.concatenate([
+                    piece if isinstance(piece, np.ndarray)
+                    else pd.to_numeric(pd.Series(piece.to_numpy()), errors='coerce').to_numpy(dtype=np.float32)
+                    for piece in pieces
+                ])
+        store = cls(columns)
+        logger.debug(f"Catalog store with {len(store)} bottles uses {store.nbytes // 2 ** 20} MB")
+        return store
+
+    def __len__(self):
+        return self.num_rows
+
+    def __contains__(self, col):
+        return col in self.columns
+
+    def kind(self, col):
+        column = self.columns[col]
+        if isinstance(column, CategoryColumn):
+            return 'category'
+        if isinstance(column, TextColumn):
+            return 'text'
+        return 'numeric'
+
+    def column(self, col):
+        return self.columns[col]
+
+    def values(self, col):
+        """Column as a NumPy array (object array for category and text columns)"""
+        column = self.columns[col]
+        return column if isinstance(column, np.ndarray) else column.to_numpy()
+
+    def value(self, position, col):
+        return _native(self.columns[col][position])
+
+    def record(self, position):
+        """BottleRecord for a row position"""
+        bottle = BottleRecord()
+        for col in BottleRecord.__slots__:
+            if col in self.columns:
+                setattr(bottle, col, _native(self.columns[col][position]))
+        return bottle
+
+    def to_dataframe(self):
+        return pd.DataFrame({col: self.values(col) for col in self.columns})
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def build_id_index(self):
+        """Build the id -> row position lookup (done on first use otherwise; kept if loaded with the state)"""
+        if self._id_lookup is not None:
+            return
+        ids = self.columns.get('id')
+        if ids is None:
+            self._id_lookup = ('dict', {}, {})
+        elif isinstance(ids, np.ndarray) and ids.dtype.kind in 'iu':
+            # Integer ids: sorted copy + binary search instead of a dict with one entry per bottle
+            order = np.argsort(ids, kind='stable')
+            self._id_lookup = ('sorted', ids[order], order)
+        else:
+            keys = pd.Index(np.asarray(self.values('id'), dtype=object).astype(str))
+            positions = pd.Series(np.arange(len(keys)), index=keys)
+            first = ~keys.duplicated(keep='first')
+            repeated = positions[keys.duplicated(keep=False)]
+            self._id_lookup = ('dict', dict(zip(keys[first], positions.to_numpy()[first])),
+                               {key: group.to_numpy() for key, group in repeated.groupby(level=0)})
+
+    def _integer_keys(self, bottle_ids):
+        keys = []
+        for bottle_id in {str(bottle_id) for bottle_id in bottle_ids}:
+            try:
+                key = int(bottle_id)
+            except ValueError:
+                continue
+            # Same matching as str(catalog id) == str(bottle id): "013" or "13.0" are not 13
+            if str(key) == bottle_id:
+                keys.append(key)
+        return np.array(keys, dtype=np.int64)
+
+    def positions(self, bottle_ids):
+        """Row positions of all bottles whose id (compared as str) is in bottle_ids"""
+        self.build_id_index()
+        kind, first, repeated = self._id_lookup
+        if kind == 'sorted':
+            keys = self._integer_keys(bottle_ids)
+            left = np.searchsorted(first, keys, side='left')
+            right = np.searchsorted(first, keys, side='right')
+            return np.concatenate([repeated[start:end] for start, end in zip(left, right)] + [np.array([], dtype=int)])
+        positions = []
+        for bottle_id in {str(bottle_id) for bottle_id in bottle_ids}:
+            if bottle_id in repeated:
+                positions.extend(repeated[bottle_id])
+            elif bottle_id in first:
+                positions.append(first[bottle_id])
+        return np.array(positions, dtype=int)
+
+    def position(self, bottle_id):
+        """Row position of the first bottle with this id, or None"""
+        self.build_id_index()
+        kind, first, repeated = self._id_lookup
+        if kind == 'sorted':
+            keys = self._integer_keys([bottle_id])
+            if len(keys) == 0:
+                return None
+            start = np.searchsorted(first, keys[0], side='left')
+            return int(repeated[start]) if start < len(first) and first[start] == keys[0] else None
+        return first.get(str(bottle_id))
+
+    def get_state(self):
+        """(schema, arrays): column kinds and the NumPy arrays that hold them (see from_state)"""
+        schema, arrays = [], {}
+        for col, column in self.columns.items():
+            kind = self.kind(col)
+            schema.append({'name': col, 'kind': kind})
+            if kind == 'category':
+                arrays[f'{col}_codes'] = column.codes
+                arrays[f'{col}_categories'] = np.asarray([str(value) for value in column.categories], dtype=str)
+            elif kind == 'text':
+                arrays[f'{col}_data'] = column.data
+                arrays[f'{col}_offsets'] = column.offsets
+                arrays[f'{col}_missing'] = column.missing
+            else:
+                arrays[col] = column
+        if self._id_lookup is not None and self._id_lookup[0] == 'sorted':
+            # Saved so that processes loading the state share it instead of sorting the ids again
+            arrays['id_sorted'], arrays['id_order'] = self._id_lookup[1], self._id_lookup[2]
+        return schema, arrays
+
+    @classmethod
+    def from_state(cls, schema, arrays):
+        """Store from get_state output; the arrays may be read-only memory maps"""
+        columns = {}
+        for entry in schema:
+            col, kind = entry['name'], entry['kind']
+            if kind == 'category':
+                categories = np.array([sys.intern(str(value)) for value in arrays[f'{col}_categories']], dtype=object)
+                columns[col] = CategoryColumn(arrays[f'{col}_codes'], categories)
+            elif kind == 'text':
+                columns[col] = TextColumn(arrays[f'{col}_data'], arrays[f'{col}_offsets'], arrays[f'{col}_missing'])
+            else:
+                columns[col] = arrays[col]
+        store = cls(columns)
+        if 'id_sorted' in arrays:
+            store._id_lookup = ('sorted', arrays['id_sorted'], arrays['id_order'])
+        return store
@@ -1,30 +1,54 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy as np
 import pandas as pd
-import io
 import requests
-import logging
 
 logger = logging.getLogger(__name__)
 
+# Google Sheets URL
+SHEET_URL = os.environ.get(
+    "CATALOG_URL",
+    "https://docs.google.com/spreadsheets/d/1yXIJo5f00clyrFHlRyKuIwrNCQw_cNcoVbSvtKO_bTs/export?format=csv"
+)
+
+# Diretório do snapshot local do catálogo (dados + features já ajustadas)
+SNAPSHOT_DIR = os.environ.get("CATALOG_SNAPSHOT_DIR", "catalog_snapshot")
+SNAPSHOT_FORMAT = 2
+
+# Leitura do CSV em blocos: linhas por bloco e bytes por bloco do download
+CATALOG_CHUNK_SIZE = int(os.environ.get("CATALOG_CHUNK_SIZE", 100000))
+DOWNLOAD_BLOCK_SIZE = 1 << 20
+
+# Dtypes of the known catalog columns (by normalized name); other columns are inferred
+CATALOG_DTYPES = {
+    'name': 'str', 'brand': 'str', 'spirit': 'str', 'spirit_type': 'str', 'category': 'str',
+    'type': 'str', 'region': 'str', 'image_url': 'str',
+    'price': 'float64', 'proof': 'float64', 'age': 'float64', 'abv': 'float64',
+    'average_msrp': 'float64', 'fair_price': 'float64', 'shelf_price': 'float64',
+}
+
 def load_whisky_data():
     """
     Load whisky data from the Google Sheets URL
     
     Returns:
-        DataFrame: Pandas DataFrame containing whisky data
+        CatalogStore: Preprocessed whisky catalog
     """
     try:
-        # Google Sheets URL
-        sheet_url = "https://docs.google.com/spreadsheets/d/1yXIJo5f00clyrFHlRyKuIwrNCQw_cNcoVbSvtKO_bTs/export?format=csv"
-        
-        # Download the CSV data
-        response = requests.get(sheet_url)
-        response.raise_for_status()  # Raise exception for HTTP errors
+        # Download the CSV data to a temporary file
+        csv_path, _ = fetch_catalog_csv()
         
-        # Read the CSV data into a DataFrame
-        data = pd.read_csv(io.StringIO(response.text))
-        
-        # Clean and preprocess the data
-        data = preprocess_whisky_data(data)
+        # Read it in blocks and preprocess the data into a CatalogStore
+        try:
+            data = read_catalog_csv(csv_path)
+        finally:
+            os.remove(csv_path)
         
         logger.info(f"Successfully loaded whisky data with {len(data)} bottles")
         return data
@@ -33,12 +57,39 @@ def load_whisky_data():
         logger.error(f"Error loading whisky data: {e}")
         raise
 
-def preprocess_whisky_data(data):
+def _valid_text(values):
+    """True where a text cell holds a usable value (not empty, not 'none')"""
+    text = values.astype(str).str.strip()
+    return values.notna() & (text != '') & (text.str.lower() != 'none')
+
+def _valid_number(values):
+    return values.notna() & (values != 0)
+
+def _coalesce(candidates, is_valid, default):
+    """
+    Column-wise coalesce: the first candidate value that passes is_valid, else default
+    
+    Args:
+        candidates (list): Series aligned on the same index, in priority order
+        is_valid (callable): Series -> boolean Series
+    """
+    result = candidates[0].where(is_valid(candidates[0]))
+    missing = result.isna()
+    for candidate in candidates[1:]:
+        if not missing.any():
+            break
+        take = missing & is_valid(candidate)
+        result = result.where(~take, candidate)
+        missing &= ~take
+    return result.where(~missing, default)
+
+def preprocess_whisky_data(data, first_generated_id=0):
     """
     Clean and preprocess the whisky data
     
     Args:
         data (DataFrame): Raw whisky data
+        first_generated_id (int): Number of the first generated id (gen_<n>) for rows without one
     
     Returns:
         DataFrame: Cleaned and preprocessed whisky data
@@ -57,42 +108,367 @@ def preprocess_whisky_data(data):
             data[col] = None
     
     # Convert numeric columns
-    if 'price' in data.columns:
-        data['price'] = pd.to_numeric(data['price'], errors='coerce')
-    if 'proof' in data.columns:
-        data['proof'] = pd.to_numeric(data['proof'], errors='coerce')
-    if 'age' in data.columns:
-        data['age'] = pd.to_numeric(data['age'], errors='coerce')
-    # Preencher 'spirit' com alternativas se disponível
+    for col in ['price', 'proof', 'age']:
+        if col in data.columns:
+            data[col] = pd.to_numeric(data[col], errors='coerce')
+    # Preencher 'spirit' com o primeiro valor válido entre spirit, spirit_type, category, type
     if 'spirit' in data.columns:
-        # Preencher spirit com o primeiro valor válido entre spirit, category, type
-        def fill_spirit(row):
-            for col in ['spirit', 'spirit_type', 'category', 'type']:
-                val = row.get(col, None)
-                if pd.notna(val) and str(val).strip() != '' and str(val).strip().lower() != 'none':
-                    return val
-            return 'Unknown'
-        data['spirit'] = data.apply(fill_spirit, axis=1)
+        candidates = [data[col] for col in ['spirit', 'spirit_type', 'category', 'type'] if col in data.columns]
+        data['spirit'] = _coalesce(candidates, _valid_text, default='Unknown')
 
     # Preencher preço e proof com alternativas se disponível
     if 'price' in data.columns:
-        for alt in ['average_msrp', 'fair_price', 'shelf_price']:
-            if alt in data.columns:
-                mask = (data['price'].isna()) | (data['price'] == 0)
-                data.loc[mask, 'price'] = data.loc[mask, alt]
-        data.loc[data['price'].isna(), 'price'] = 0
+        alternatives = [pd.to_numeric(data[alt], errors='coerce')
+                        for alt in ['average_msrp', 'fair_price', 'shelf_price'] if alt in data.columns]
+        data['price'] = _coalesce([data['price']] + alternatives, _valid_number, default=0)
     if 'proof' in data.columns:
-        if 'abv' in data.columns:
-            mask = (data['proof'].isna()) | (data['proof'] == 0)
-            data.loc[mask, 'proof'] = data.loc[mask, 'abv'] * 2
-        data.loc[data['proof'].isna(), 'proof'] = 0
+        alternatives = [pd.to_numeric(data['abv'], errors='coerce') * 2] if 'abv' in data.columns else []
+        data['proof'] = _coalesce([data['proof']] + alternatives, _valid_number, default=0)
     if 'age' in data.columns:
-        data.loc[data['age'].isna(), 'age'] = 0
+        data['age'] = data['age'].fillna(0)
     
     # Generate unique IDs if missing
     if 'id' not in data.columns or data['id'].isna().any():
         logger.warning("Some or all ID values are missing, generating unique IDs")
         missing_id_mask = data['id'].isna() if 'id' in data.columns else pd.Series([True] * len(data))
-        data.loc[missing_id_mask, 'id'] = [f"gen_{i}" for i in range(sum(missing_id_mask))]
+        # Colunas numéricas não aceitam os ids gerados (texto)
+        data['id'] = data['id'].astype(object)
+        data.loc[missing_id_mask, 'id'] = [f"gen_{first_generated_id + i}" for i in range(sum(missing_id_mask))]
     
     return data
+
+def fetch_catalog_csv(previous_meta=None, directory=None):
+    """
+    Download the catalog CSV to a temporary file, skipping it when the source has not changed
+    
+    The response is streamed to disk in blocks while its hash is computed, so the
+    whole CSV is never held in memory.
+    
+    Args:
+        previous_meta (dict): Metadata of the current snapshot, if any. Its ETag and
+            Last-Modified are sent as conditional headers and its content hash is
+            compared with the downloaded content.
+        directory (str): Where the temporary file is created (default: system temp dir)
+    
+    Returns:
+        tuple: (csv_path, source_info). csv_path is None when the source is unchanged;
+        otherwise the caller must delete the file.
+    """
+    previous_meta = previous_meta or {}
+    headers = {}
+    if previous_meta.get('etag'):
+        headers['If-None-Match'] = previous_meta['etag']
+    if previous_meta.get('last_modified'):
+        headers['If-Modified-Since'] = previous_meta['last_modified']
+    
+    with requests.get(SHEET_URL, headers=headers, timeout=60, stream=True) as response:
+        if response.status_code == 304:
+            logger.info("Catalog source not modified (HTTP 304)")
+            return None, previous_meta
+        response.raise_for_status()
+        
+        digest = hashlib.sha256()
+        fd, csv_path = tempfile.mkstemp(prefix='catalog-', suffix='.csv', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in response.iter_content(chunk_size=DOWNLOAD_BLOCK_SIZE):
+                    digest.update(block)
+                    f.write(block)
+        except BaseException:
+            os.remove(csv_path)
+            raise
+        source_info = {
+            'source_url': SHEET_URL,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': digest.hexdigest(),
+        }
+    if source_info['sha256'] == previous_meta.get('sha256'):
+        logger.info("Catalog source content unchanged (same hash)")
+        os.remove(csv_path)
+        return None, previous_meta
+    return csv_path, source_info
+
+def _normalize_column(name):
+    return name.lower().replace(' ', '_')
+
+def read_catalog_csv(source, chunksize=None):
+    """
+    Read and preprocess a catalog CSV in blocks of `chunksize` rows
+    
+    Known columns are parsed with explicit dtypes (no type inference). Each block is
+    preprocessed on its own and appended to the compact columns of a CatalogStore,
+    so the whole catalog never exists as a DataFrame of Python objects: peak memory
+    is the store plus one block.
+    
+    Args:
+        source (str): Path of the CSV file
+    
+    Returns:
+        CatalogStore: Preprocessed catalog (see preprocess_whisky_data)
+    """
+    from catalog_store import CatalogStore
+    chunksize = chunksize or CATALOG_CHUNK_SIZE
+    header = pd.read_csv(source, nrows=0, encoding='utf-8', encoding_errors='replace').columns
+    dtypes = {col: CATALOG_DTYPES[_normalize_column(col)] for col in header
+              if _normalize_column(col) in CATALOG_DTYPES}
+    try:
+        return CatalogStore.from_chunks(_preprocessed_chunks(source, chunksize, dtypes))
+    except ValueError as e:
+        # Valor não numérico numa coluna numérica: deixa o pandas inferir os tipos
+        logger.warning(f"Catalog CSV does not match the expected dtypes ({e}), reading with inferred dtypes")
+        dtypes = {col: dtype for col, dtype in dtypes.items() if dtype == 'str'}
+        return CatalogStore.from_chunks(_preprocessed_chunks(source, chunksize, dtypes))
+
+def _preprocessed_chunks(source, chunksize, dtypes):
+    generated_ids = 0
+    reader = pd.read_csv(source, chunksize=chunksize, dtype=dtypes, encoding='utf-8', encoding_errors='replace')
+    with reader:
+        for chunk in reader:
+            id_column = next((col for col in chunk.columns if _normalize_column(col) == 'id'), None)
+            ids = None if id_column is None else chunk[id_column]
+            missing_ids = len(chunk) if ids is None else int(ids.isna().sum())
+            if ids is not None and ids.dtype.kind == 'f' and (ids.dropna() % 1 == 0).all():
+                # Ids inteiros lidos como float por causa de células vazias: 123, não "123.0",
+                # e o mesmo tipo em todos os blocos
+                chunk[id_column] = ids.astype('Int64').astype(object) if missing_ids else ids.astype(np.int64)
+            # Ids gerados continuam a numeração dos blocos anteriores
+            yield preprocess_whisky_data(chunk, first_generated_id=generated_ids)
+            generated_ids += missing_ids
+
+def _save_arrays(directory, arrays):
+    os.makedirs(directory)
+    for key, array in arrays.items():
+        np.save(os.path.join(directory, f"{key}.npy"), np.asarray(array))
+
+def _load_arrays(directory, mmap_mode):
+    return {
+        entry.name[:-len('.npy')]: np.load(entry.path, mmap_mode=mmap_mode)
+        for entry in os.scandir(directory) if entry.name.endswith('.npy')
+    }
+
+def _read_current_version(snapshot_dir):
+    try:
+        with open(os.path.join(snapshot_dir, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def read_snapshot_meta(snapshot_dir=None):
+    """
+    Metadata of the current catalog snapshot
+    
+    Returns:
+        dict: Snapshot metadata, or None if there is no usable snapshot
+    """
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    version = _read_current_version(snapshot_dir)
+    if not version:
+        return None
+    try:
+        with open(os.path.join(snapshot_dir, version, 'meta.json')) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError) as e:
+        logger.warning(f"Invalid catalog snapshot {version}: {e}")
+        return None
+    if meta.get('format') != SNAPSHOT_FORMAT:
+        logger.warning(f"Ignoring catalog snapshot {version} with format {meta.get('format')}")
+        return None
+    return meta
+
+def save_catalog_snapshot(recommender, source_info, snapshot_dir=None, keep=2):
+    """
+    Write the preprocessed catalog and the fitted features of a WhiskyRecommender
+    
+    Each snapshot goes to its own version directory; the CURRENT file is switched
+    atomically once the directory is complete, so readers never see a partial snapshot.
+    
+    Args:
+        recommender (WhiskyRecommender): Recommender built from the catalog
+        source_info (dict): Source metadata from fetch_catalog_csv
+        snapshot_dir (str): Snapshot root directory
+        keep (int): Number of snapshot versions to keep
+    
+    Returns:
+        dict: Metadata of the written snapshot
+    """
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    # O dtype das features faz parte da chave: processos com dtypes diferentes não partilham arrays
+    dtype = recommender.dtype.name
+    version = f"{(source_info.get('sha256') or hashlib.sha256(str(time.time()).encode()).hexdigest())[:16]}-{dtype}"
+    version_dir = os.path.join(snapshot_dir, version)
+    tmp_dir = f"{version_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    
+    columns, arrays = recommender.catalog.get_state()
+    _save_arrays(os.path.join(tmp_dir, 'catalog'), arrays)
+    _save_arrays(os.path.join(tmp_dir, 'features'), recommender.get_feature_state())
+    
+    meta = dict(source_info)
+    meta.update({
+        'format': SNAPSHOT_FORMAT,
+        'version': version,
+        'created_at': time.time(),
+        'num_bottles': len(recommender.catalog),
+        'columns': columns,
+        'dtype': dtype,
+    })
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.replace(tmp_dir, version_dir)
+    current_tmp = os.path.join(snapshot_dir, f"CURRENT.tmp-{os.getpid()}")
+    with open(current_tmp, 'w') as f:
+        f.write(version)
+    os.replace(current_tmp, os.path.join(snapshot_dir, 'CURRENT'))
+    
+    # Remove versões antigas (as mais recentes continuam disponíveis para quem ainda as usa)
+    versions = sorted(
+        (entry for entry in os.scandir(snapshot_dir) if entry.is_dir() and '.tmp-' not in entry.name),
+        key=lambda entry: entry.stat().st_mtime, reverse=True
+    )
+    for entry in versions[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+    
+    logger.info(f"Saved catalog snapshot {version} with {len(recommender.catalog)} bottles")
+    return meta
+
+def load_catalog_snapshot(snapshot_dir=None, mmap_mode='r'):
+    """
+    Load the current catalog snapshot
+    
+    The catalog columns and feature arrays are memory-mapped (read-only) by default.
+    
+    Returns:
+        tuple: (catalog, feature_state, meta), or None if there is no snapshot;
+            catalog is a CatalogStore
+    """
+    from catalog_store import CatalogStore
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    meta = read_snapshot_meta(snapshot_dir)
+    if meta is None:
+        return None
+    version_dir = os.path.join(snapshot_dir, meta['version'])
+    data = CatalogStore.from_state(meta['columns'], _load_arrays(os.path.join(version_dir, 'catalog'), mmap_mode))
+    feature_state = _load_arrays(os.path.join(version_dir, 'features'), mmap_mode)
+    logger.info(f"Loaded catalog snapshot {meta['version']} with {meta['num_bottles']} bottles")
+    return data, feature_state, meta
+
+def load_recommender(snapshot_dir=None, refresh=True, current_version=None, **recommender_options):
+    """
+    Build a WhiskyRecommender, using the local catalog snapshot when possible
+    
+    With refresh=True the source is checked (conditional request / content hash) and
+    the snapshot is rebuilt only when it changed. When the source is unreachable, or
+    refresh=False, the existing snapshot is used, so startup works fully offline.
+    
+    Args:
+        current_version (str): Catalog version already in use; when the catalog is
+            still at this version nothing is loaded and None is returned
+    
+    Returns:
+        WhiskyRecommender: Recommender with the `catalog_version` attribute set
+    """
+    from recommendation_engine import WhiskyRecommender
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    meta = read_snapshot_meta(snapshot_dir)
+    
+    if refresh or meta is None:
+        recommender = _rebuild_from_source(snapshot_dir, meta, recommender_options)
+        if recommender is not None:
+            return recommender
+    
+    if current_version is not None and meta['version'] == current_version:
+        return None
+    if meta.get('dtype') != _feature_dtype(recommender_options):
+        return _rebuild_features(snapshot_dir, recommender_options)
+    data, feature_state, meta = load_catalog_snapshot(snapshot_dir)
+    recommender = WhiskyRecommender(data, feature_state=feature_state, **recommender_options)
+    recommender.catalog_version = meta['version']
+    return recommender
+
+def _rebuild_from_source(snapshot_dir, meta, recommender_options):
+    """
+    Check the catalog source; when it changed, build a recommender from it and save the snapshot
+    
+    Returns:
+        WhiskyRecommender: The new recommender, or None when the snapshot in meta is
+            still current (or the source is unreachable and a snapshot exists)
+    """
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        csv_path, source_info = fetch_catalog_csv(meta, directory=snapshot_dir)
+    except Exception as e:
+        if meta is None:
+            logger.error(f"Error loading whisky data: {e}")
+            raise
+        logger.warning(f"Catalog source unavailable ({e}), using local snapshot {meta['version']}")
+        return None
+    if csv_path is None:
+        return None
+    
+    try:
+        data = read_catalog_csv(csv_path)
+    finally:
+        os.remove(csv_path)
+    return _build_and_save(data, source_info, snapshot_dir, recommender_options)
+
+def _feature_dtype(recommender_options):
+    from recommendation_engine import FEATURE_DTYPE
+    return np.dtype(recommender_options.get('dtype') or FEATURE_DTYPE).name
+
+def _rebuild_features(snapshot_dir, recommender_options):
+    """
+    Refit the features of the current snapshot's catalog with this process's dtype
+    
+    Used when the snapshot was written with another feature dtype (RECOMMENDER_DTYPE);
+    the source is not downloaded again.
+    """
+    data, _, meta = load_catalog_snapshot(snapshot_dir)
+    logger.warning(f"Catalog snapshot {meta['version']} has {meta.get('dtype')} features, "
+                   f"rebuilding them as {_feature_dtype(recommender_options)}")
+    source_info = {key: value for key, value in meta.items()
+                   if key not in ('format', 'version', 'created_at', 'num_bottles', 'columns', 'dtype')}
+    return _build_and_save(data, source_info, snapshot_dir, recommender_options)
+
+def _build_and_save(data, source_info, snapshot_dir, recommender_options):
+    from recommendation_engine import WhiskyRecommender
+    recommender = WhiskyRecommender(data, **recommender_options)
+    from neighbours import NUM_NEIGHBOURS, build_neighbours
+    if NUM_NEIGHBOURS:
+        recommender.neighbour_indices, recommender.neighbour_scores = build_neighbours(recommender, NUM_NEIGHBOURS)
+    try:
+        meta = save_catalog_snapshot(recommender, source_info, snapshot_dir)
+        recommender.catalog_version = meta['version']
+    except OSError as e:
+        logger.warning(f"Could not write catalog snapshot: {e}")
+        recommender.catalog_version = f"{source_info['sha256'][:16]}-{recommender.dtype.name}"
+    return recommender
+
+def refresh_catalog_snapshot(snapshot_dir=None):
+    """
+    Bring the catalog snapshot up to date with the source, without keeping a recommender
+    
+    Run once by the pre-fork server master (see gunicorn.conf.py) so the workers only
+    memory-map the snapshot, or by hand with `python data_loader.py`.
+    
+    Returns:
+        dict: Metadata of the current snapshot (None if none could be written)
+    """
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    _rebuild_from_source(snapshot_dir, read_snapshot_meta(snapshot_dir), {})
+    meta = read_snapshot_meta(snapshot_dir)
+    if meta is not None and meta.get('dtype') != _feature_dtype({}):
+        _rebuild_features(snapshot_dir, {})
+        meta = read_snapshot_meta(snapshot_dir)
+    return meta
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+    meta = refresh_catalog_snapshot()
+    if meta is None:
+        raise SystemExit("No catalog snapshot available")
+    print(f"Catalog snapshot {meta['version']} ({meta['num_bottles']} bottles)")
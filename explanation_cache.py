@@ -0,0 +1,60 @@
+import os
+import math
+import threading
+from ttl_cache import TTLCache
+
+# Limites das faixas de preço usadas na assinatura do perfil
+PRICE_BUCKETS = [25, 50, 75, 100, 150, 200, 300, 500, 1000, 2500]
+
+
+def profile_signature(user_profile):
+    """
+    Coarse signature of the profile fields that go into the LLM prompt.
+
+    Users with the same top spirits and an average price in the same bucket share
+    explanations, since the prompt asks the LLM not to mention values.
+    """
+    spirits = ",".join(sorted(str(spirit) for spirit in (user_profile.get('top_spirits') or {})))
+    avg_price = user_profile.get('avg_price') or 0
+    try:
+        avg_price = float(avg_price)
+    except (TypeError, ValueError):
+        avg_price = 0.0
+    if math.isnan(avg_price):
+        avg_price = 0.0
+    bucket = sum(avg_price >= limit for limit in PRICE_BUCKETS)
+    return f"{spirits}|p{bucket}"
+
+
+class ExplanationCache(TTLCache):
+    """
+    Cache for LLM bottle explanations, keyed by bottle id and profile signature.
+
+    In-memory LRU with TTL, plus an optional SQLite tier (`db_path`) shared by the
+    worker processes.
+    """
+
+    def __init__(self, max_entries=2048, ttl=86400, db_path=None):
+        super().__init__(max_entries=max_entries, ttl=ttl, db_path=db_path, table='explanations')
+
+    @staticmethod
+    def make_key(bottle_id, user_profile, catalog_version=None):
+        key = f"{bottle_id}|{profile_signature(user_profile)}"
+        return f"{catalog_version}|{key}" if catalog_version else key
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_explanation_cache():
+    """Shared ExplanationCache configured from the environment"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ExplanationCache(
+                max_entries=int(os.environ.get("LLM_CACHE_SIZE", 2048)),
+                ttl=float(os.environ.get("LLM_CACHE_TTL", 86400)),
+                db_path=os.environ.get("LLM_CACHE_PATH") or None
+            )
+        return _default_cache
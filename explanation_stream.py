@@ -0,0 +1,128 @@
+import json
+import time
+import logging
+import threading
+from instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+LISTS = [('similar', 'similar_recommendations'), ('complementary', 'complementary_recommendations')]
+
+
+def sse_event(data, event=None):
+    """Format one Server-Sent Events message"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def explanation_events(result):
+    """One event per recommendation of a stored result, with its current llm_message"""
+    events = []
+    for list_name, key in LISTS:
+        for index, rec in enumerate(result.get(key) or []):
+            events.append({'list': list_name, 'index': index, 'id': rec.get('id'), 'llm_message': rec.get('llm_message')})
+    return events
+
+
+class ExplanationJob:
+    """LLM explanations of one result, generated in the background and published as events"""
+
+    def __init__(self, token):
+        self.token = token
+        self.events = []
+        self.done = False
+        self.finished_at = None
+        self._condition = threading.Condition()
+
+    def publish(self, event):
+        with self._condition:
+            self.events.append(event)
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._condition.notify_all()
+
+    def iter_events(self, timeout):
+        """Yield every event (including those already published) until the job is done or timeout"""
+        deadline = time.monotonic() + timeout
+        position = 0
+        while True:
+            with self._condition:
+                while position == len(self.events) and not self.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self._condition.wait(remaining)
+                new_events = self.events[position:]
+                position = len(self.events)
+                done = self.done
+            yield from new_events
+            if done and position == len(self.events):
+                return
+
+
+class ExplanationStreams:
+    """Registry of the background explanation jobs of this process, by result token"""
+
+    def __init__(self, retention=300):
+        self.retention = retention
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            return self._jobs.get(token)
+
+    def start(self, token, recommender, result, on_complete=None):
+        """
+        Generate the LLM explanations of `result` in a background thread.
+
+        Each message is published as soon as it is ready; when all are done,
+        on_complete(result) receives the result with every llm_message filled.
+        """
+        job = ExplanationJob(token)
+        with self._lock:
+            self._purge()
+            self._jobs[token] = job
+        threading.Thread(
+            target=self._run, args=(job, recommender, result, on_complete), name="llm-explanations", daemon=True
+        ).start()
+        return job
+
+    def _run(self, job, recommender, result, on_complete):
+        positions = [
+            (list_name, index) for list_name, key in LISTS for index in range(len(result.get(key) or []))
+        ]
+        recommendations = [rec for _, key in LISTS for rec in (result.get(key) or [])]
+        try:
+            with span('llm'):
+                for position, message in recommender.iter_llm_messages(recommendations, result.get('user_profile') or {}):
+                    rec = recommendations[position]
+                    rec['llm_message'] = message
+                    list_name, index = positions[position]
+                    job.publish({'list': list_name, 'index': index, 'id': rec.get('id'), 'llm_message': message})
+        except Exception as e:
+            logger.error(f"Error generating explanations, keeping the rule-based messages: {e}", exc_info=True)
+            for rec in recommendations:
+                if not rec.get('llm_message'):
+                    rec['llm_message'] = recommender.reasoning_message(rec.get('reasoning') or [])
+        # Mesmo depois de uma falha o resultado guardado deixa de estar pendente: streams de
+        # outros workers e /analyze não ficam à espera de explicações que não vêm
+        result['explanations_pending'] = False
+        try:
+            if on_complete is not None:
+                on_complete(result)
+        except Exception as e:
+            logger.error(f"Error storing explanations: {e}", exc_info=True)
+        finally:
+            job.finish()
+
+    def _purge(self):
+        # Chamado com o lock adquirido
+        now = time.monotonic()
+        for token in [token for token, job in self._jobs.items()
+                      if job.done and now - job.finished_at > self.retention]:
+            del self._jobs[token]
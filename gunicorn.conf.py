@@ -0,0 +1,77 @@
+"""
+Gunicorn settings, read automatically from the working directory.
+
+The catalog is prepared once per server, not once per worker: before forking,
+the master brings the catalog snapshot up to date (download, preprocessing and
+feature fitting run in a helper process, so the master stays small). The workers
+start with CATALOG_SHARED_SNAPSHOT=1 and only memory-map the snapshot read-only,
+so the catalog columns, the feature matrix, the scaler parameters and the id
+index are shared between them through the page cache. With
+CATALOG_REFRESH_INTERVAL set, the master also refreshes the snapshot on that
+schedule and each worker picks up the new version on its own reload.
+
+Workers are threaded (gthread): an explanation stream holds a thread for up to
+LLM_STREAM_TIMEOUT seconds, which a sync worker could not serve without blocking
+every other request. Computed results are shared between the workers through the
+SQLite file in RESULT_STORE_PATH, set here before forking.
+"""
+import os
+import sys
+import time
+import threading
+import subprocess
+
+from catalog_manager import refresh_interval_from_env
+
+# Workers load the catalog themselves (from the shared snapshot) after the fork;
+# preloading the app would start the reload and LLM threads before forking
+preload_app = False
+
+# Um stream de explicações ocupa uma thread do worker (ver app.recommendations_stream)
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+# O mesmo valor limita a duração dos streams em app.py
+timeout = int(float(os.environ.get("WORKER_TIMEOUT", 30)))
+
+
+def refresh_snapshot(server):
+    """Update the catalog snapshot in a child process; failures leave the current snapshot in place"""
+    result = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_loader.py')])
+    if result.returncode != 0:
+        server.log.warning(f"Catalog snapshot refresh failed (exit code {result.returncode})")
+
+
+def on_starting(server):
+    if os.environ.get("CATALOG_OFFLINE") != "1":
+        refresh_snapshot(server)
+    # Herdado pelos workers: só leem o snapshot, sem consultar a planilha
+    os.environ["CATALOG_SHARED_SNAPSHOT"] = "1"
+    share_result_store(server)
+
+
+def share_result_store(server):
+    """Point every worker at the same result store file; refuse to start without one when there are several workers"""
+    # Mesmo padrão que result_store.DEFAULT_RESULT_STORE_PATH, sem importar numpy no master
+    default_path = os.path.join(os.environ.get("CATALOG_SNAPSHOT_DIR", "catalog_snapshot"), "results.db")
+    path = os.environ.setdefault("RESULT_STORE_PATH", os.path.abspath(default_path))
+    if not path:
+        if server.cfg.workers > 1:
+            raise RuntimeError(f"RESULT_STORE_PATH is empty but {server.cfg.workers} workers are configured: "
+                               f"results stored by one worker would not be found by the others")
+        return
+    os.environ["RESULT_STORE_PATH"] = path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    server.log.info(f"Result store shared by the workers: {path}")
+
+
+def when_ready(server):
+    interval = refresh_interval_from_env()
+    if not interval or os.environ.get("CATALOG_OFFLINE") == "1":
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            refresh_snapshot(server)
+
+    threading.Thread(target=run, name="catalog-snapshot-refresher", daemon=True).start()
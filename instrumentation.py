@@ -0,0 +1,201 @@
+import os
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from cache hits to slow LLM calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Fração dos payloads registrados em DEBUG (1.0 registra todos)
+PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", 0.01))
+PAYLOAD_LOG_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", 2000))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    """Prometheus-style histogram with cumulative buckets, one series per label value tuple"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # [contagens por bucket..., +Inf], soma
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = series[0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+                    break
+            else:
+                counts[-1] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        for labelvalues, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, ('le', le))} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return "\n".join(lines)
+
+
+class Counter:
+    """Prometheus-style counter, one series per label value tuple"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for labelvalues, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return "\n".join(lines)
+
+
+class CacheStats:
+    """
+    Hit, miss, eviction and size counters of the registered caches (TTLCache.stats),
+    read when the metrics are rendered
+    """
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def register(self, cache, get_stats):
+        """get_stats() returns the stats dict of the cache named `cache`"""
+        with self._lock:
+            self._sources[cache] = get_stats
+
+    def render(self):
+        counters = [f"# HELP {self.name}_total {self.documentation}", f"# TYPE {self.name}_total counter"]
+        sizes = [f"# HELP {self.name}_entries Entries held in memory by each cache",
+                 f"# TYPE {self.name}_entries gauge"]
+        with self._lock:
+            sources = dict(self._sources)
+        for cache, get_stats in sorted(sources.items()):
+            try:
+                stats = dict(get_stats())
+            except Exception as e:
+                logger.warning(f"Could not read the stats of cache {cache}: {e}")
+                continue
+            size = stats.pop('size', None)
+            for event, value in sorted(stats.items()):
+                counters.append(f"{self.name}_total{_format_labels(('cache', 'event'), (cache, event))} {value}")
+            if size is not None:
+                sizes.append(f"{self.name}_entries{_format_labels(('cache',), (cache,))} {size}")
+        return "\n".join(counters + sizes)
+
+
+STAGE_SECONDS = Histogram(
+    'whisky_stage_duration_seconds',
+    'Duration of each recommendation stage in seconds',
+    labelnames=('stage',)
+)
+REQUEST_SECONDS = Histogram(
+    'whisky_request_duration_seconds',
+    'Duration of HTTP requests in seconds',
+    labelnames=('endpoint', 'method', 'status')
+)
+STAGE_ERRORS = Counter(
+    'whisky_stage_errors_total',
+    'Stages that raised an exception',
+    labelnames=('stage',)
+)
+
+CACHE_EVENTS = CacheStats(
+    'whisky_cache_events',
+    'Cache hits, misses, evictions, expirations and writes'
+)
+
+METRICS = [STAGE_SECONDS, STAGE_ERRORS, REQUEST_SECONDS, CACHE_EVENTS]
+
+# Durations of the stages of the current request (see start_trace)
+_trace = contextvars.ContextVar('trace', default=None)
+
+
+def start_trace():
+    """Start collecting the stage durations of the current request; returns the dict they go to"""
+    timings = {}
+    _trace.set(timings)
+    return timings
+
+
+@contextmanager
+def span(stage):
+    """Time a block as `stage`: recorded in the stage histogram and the current trace"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage)
+        timings = _trace.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+
+class _Truncated:
+    """Formats a payload only when the log record is emitted"""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        text = str(self.payload)
+        if len(text) > PAYLOAD_LOG_MAX_CHARS:
+            return f"{text[:PAYLOAD_LOG_MAX_CHARS]}... ({len(text)} chars)"
+        return text
+
+
+def log_payload(log, label, payload):
+    """Log a (possibly large) payload at DEBUG, for a sample of the calls only"""
+    if log.isEnabledFor(logging.DEBUG) and random.random() < PAYLOAD_LOG_SAMPLE_RATE:
+        log.debug("%s: %s", label, _Truncated(payload))
@@ -1,30 +1,328 @@
-import requests
 import os
+import re
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
-def generate_llm_message(prompt, api_key=None):
+logger = logging.getLogger(__name__)
+
+# Load .env once, when the module is imported
+load_dotenv()
+
+DEFAULT_LLM_URL = "https://api.groq.com/openai/v1/chat/completions"
+DEFAULT_MODEL = "llama3-8b-8192"  # ou "llama3-70b-8192"
+
+
+def _batch_item(item, wanted):
+    """(id, message) of one item of a batched reply, or None"""
+    if not isinstance(item, dict):
+        return None
+    key = str(item.get('id'))
+    message = item.get('message', item.get('explanation'))
+    if key not in wanted or not isinstance(message, str) or not message.strip():
+        return None
+    return key, message.strip()
+
+
+def parse_batch_reply(text, ids):
+    """
+    Messages by id (as str) from the reply to a batched prompt.
+
+    Expects a JSON array of {"id": ..., "message": ...} objects, but also accepts it
+    wrapped in a code fence or prose, inside an object, as a single item object, or
+    as an {id: message} object; complete items are recovered from a truncated array. Ids missing from
+    the reply, or with an empty message, are left out.
+    """
+    wanted = {str(item_id) for item_id in ids}
+    data = None
+    for opening, closing in (('[', ']'), ('{', '}')):
+        start, end = text.find(opening), text.rfind(closing)
+        if 0 <= start < end:
+            try:
+                data = json.loads(text[start:end + 1])
+                break
+            except ValueError:
+                continue
+    if isinstance(data, dict):
+        lists = [value for value in data.values() if isinstance(value, list)]
+        if 'id' in data and ('message' in data or 'explanation' in data):
+            # Um único item (lote de uma garrafa ou resposta incompleta), não um mapa {id: mensagem}
+            data = [data]
+        elif lists:
+            data = lists[0]
+        else:
+            data = [{'id': key, 'message': value} for key, value in data.items()]
+
+    messages = {}
+    items = data if isinstance(data, list) else []
+    if len(items) < len(wanted):
+        # JSON inválido ou cortado por max_tokens: aproveita cada objeto completo
+        items = list(items)
+        for match in re.finditer(r'\{[^{}]*\}', text):
+            try:
+                items.append(json.loads(match.group(0)))
+            except ValueError:
+                continue
+    for item in items:
+        parsed = _batch_item(item, wanted)
+        if parsed is not None:
+            messages.setdefault(*parsed)
+    return messages
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when the circuit breaker is open and the LLM endpoint is not called"""
+
+
+class CircuitBreaker:
     """
-    Sends a prompt to the Groq LLM and returns a personalized message.
+    Stops calling a failing endpoint for a cool-down period.
+
+    After `failure_threshold` consecutive failures the circuit opens and every call
+    is refused for `reset_timeout` seconds. Then a single trial call is let through
+    (half-open): success closes the circuit, failure opens it again.
     """
-    load_dotenv()
-    api_key = api_key or os.environ.get("LLM_API_KEY")
-    url = os.environ.get("LLM_API_URL", "https://api.groq.com/openai/v1/chat/completions")
-    if not api_key:
-        raise ValueError("The environment variable LLM_API_KEY is not set. Please configure it in your .env file.")
-    if not url:
-        raise ValueError("The environment variable LLM_API_URL is not set. Please configure it in your .env file.")
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "model": "llama3-8b-8192",  # ou "llama3-70b-8192"
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 80,
-        "temperature": 0.7
-    }
-    print("Prompt enviado ao LLM:", prompt)
-    print("Payload:", data)
-    response = requests.post(url, headers=headers, json=data, timeout=20)
-    response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"].strip()
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        """True if a call may be made now"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    logger.warning(f"LLM circuit breaker open after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class LLMClient:
+    """
+    Client for an OpenAI-style chat completions endpoint (Groq by default).
+
+    Keeps a connection-pooled HTTP session and a thread pool so several prompts can
+    be sent concurrently under a single deadline (see generate_many). With `batch`
+    (LLM_BATCH=1, the default) callers can ask for many explanations in one prompt
+    instead (see iter_batched).
+    """
+
+    def __init__(self, api_key=None, url=None, model=None, timeout=None, max_workers=None,
+                 circuit_breaker=None, batch=None, batch_size=None):
+        self.api_key = api_key or os.environ.get("LLM_API_KEY")
+        self.url = url or os.environ.get("LLM_API_URL", DEFAULT_LLM_URL)
+        self.model = model or os.environ.get("LLM_MODEL", DEFAULT_MODEL)
+        self.timeout = float(timeout or os.environ.get("LLM_TIMEOUT", 20))
+        self.max_workers = int(max_workers or os.environ.get("LLM_MAX_WORKERS", 10))
+        self.batch = batch if batch is not None else os.environ.get("LLM_BATCH", "1") == "1"
+        self.batch_size = int(batch_size or os.environ.get("LLM_BATCH_SIZE", 20))
+        # Tokens de resposta por item de um lote (frase + sintaxe JSON)
+        self.batch_tokens_per_item = int(os.environ.get("LLM_BATCH_TOKENS_PER_ITEM", 100))
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="llm")
+
+    def generate(self, prompt, max_tokens=80, temperature=0.7, timeout=None):
+        """Send one prompt and return the message content"""
+        if not self.api_key:
+            raise ValueError("The environment variable LLM_API_KEY is not set. Please configure it in your .env file.")
+        if not self.url:
+            raise ValueError("The environment variable LLM_API_URL is not set. Please configure it in your .env file.")
+        if not self.circuit_breaker.allow():
+            raise CircuitOpenError("LLM endpoint is failing, circuit breaker is open")
+
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        data = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+        logger.debug("Prompt enviado ao LLM: %s", prompt)
+        try:
+            response = self.session.post(self.url, headers=headers, json=data, timeout=timeout or self.timeout)
+            response.raise_for_status()
+            content = response.json()["choices"][0]["message"]["content"].strip()
+        except Exception:
+            self.circuit_breaker.record_failure()
+            raise
+        self.circuit_breaker.record_success()
+        return content
+
+    def iter_many(self, prompts, deadline=None):
+        """
+        Send all prompts concurrently and yield (position, message) as each one completes.
+
+        Prompts that fail, are refused by the circuit breaker, or are still pending
+        when `deadline` seconds have passed are yielded last with message None.
+        """
+        prompts = list(prompts)
+        if not prompts:
+            return
+        if not self.api_key:
+            logger.warning("LLM_API_KEY is not set, using rule-based messages")
+            for position in range(len(prompts)):
+                yield position, None
+            return
+        deadline = float(deadline or os.environ.get("LLM_DEADLINE", 8))
+        call_timeout = min(self.timeout, deadline)
+
+        futures = {
+            self._executor.submit(self.generate, prompt, timeout=call_timeout): position
+            for position, prompt in enumerate(prompts)
+        }
+        remaining = set(futures)
+        try:
+            for future in as_completed(futures, timeout=deadline):
+                remaining.discard(future)
+                try:
+                    message = future.result()
+                except Exception as e:
+                    logger.warning(f"LLM call failed, using rule-based message: {e}")
+                    message = None
+                yield futures[future], message
+        except FuturesTimeoutError:
+            logger.warning(f"{len(remaining)} LLM calls missed the {deadline}s deadline, using rule-based messages")
+            for future in remaining:
+                future.cancel()
+                yield futures[future], None
+
+    def generate_many(self, prompts, fallbacks=None, deadline=None):
+        """
+        Send all prompts concurrently and return one message per prompt.
+
+        Prompts that fail, are refused by the circuit breaker, or are still pending
+        when `deadline` seconds have passed get the matching entry of `fallbacks`
+        (None when no fallbacks are given).
+        """
+        prompts = list(prompts)
+        results = list(fallbacks) if fallbacks is not None else [None] * len(prompts)
+        for position, message in self.iter_many(prompts, deadline):
+            if message is not None:
+                results[position] = message
+        return results
+
+    def generate_batch(self, prompt, ids, timeout=None):
+        """
+        Send one prompt covering several items and parse the reply (see parse_batch_reply).
+
+        Returns {id (as str): message} for the items found; empty if the call fails.
+        """
+        try:
+            reply = self.generate(prompt, max_tokens=self.batch_tokens_per_item * len(ids), timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Batched LLM call failed: {e}")
+            return {}
+        messages = parse_batch_reply(reply, ids)
+        if len(messages) < len({str(item_id) for item_id in ids}):
+            logger.warning(f"Batched LLM reply had {len(messages)} of {len(ids)} explanations")
+        return messages
+
+    def iter_batched(self, prompts, ids, build_batch_prompt, deadline=None):
+        """
+        Like iter_many, but answer the prompts with one call per group of batch_size.
+
+        build_batch_prompt(positions) returns the prompt covering those positions, and
+        ids[position] identifies each item in the reply. Positions missing from the
+        replies fall back to their own prompt (iter_many) within what is left of the
+        deadline, and are yielded with None when no time is left.
+        """
+        prompts = list(prompts)
+        if not prompts or not self.api_key:
+            yield from self.iter_many(prompts, deadline)
+            return
+        deadline = float(deadline or os.environ.get("LLM_DEADLINE", 8))
+        started = time.monotonic()
+        call_timeout = min(self.timeout, deadline)
+
+        groups = [list(range(start, min(start + self.batch_size, len(prompts))))
+                  for start in range(0, len(prompts), self.batch_size)]
+        futures = {
+            self._executor.submit(self.generate_batch, build_batch_prompt(group), [ids[p] for p in group],
+                                  call_timeout): group
+            for group in groups
+        }
+        missing = []
+        try:
+            for future in as_completed(futures, timeout=deadline):
+                messages = future.result()
+                for position in futures.pop(future):
+                    message = messages.get(str(ids[position]))
+                    if message is None:
+                        missing.append(position)
+                    else:
+                        yield position, message
+        except FuturesTimeoutError:
+            logger.warning(f"Batched LLM calls missed the {deadline}s deadline, using rule-based messages")
+            for future, group in futures.items():
+                future.cancel()
+                for position in group:
+                    yield position, None
+
+        remaining = deadline - (time.monotonic() - started)
+        if missing and remaining > 0:
+            logger.info(f"{len(missing)} of {len(prompts)} explanations missing from the batched replies, "
+                        f"asking one by one")
+            for offset, message in self.iter_many([prompts[p] for p in missing], remaining):
+                yield missing[offset], message
+        else:
+            for position in missing:
+                yield position, None
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_llm_client():
+    """Shared LLMClient configured from the environment"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = LLMClient()
+        return _default_client
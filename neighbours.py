@@ -0,0 +1,115 @@
+"""
+Item-to-item neighbour lists: the most similar catalog bottles of every bottle.
+
+The lists are built offline, with the catalog snapshot when CATALOG_NEIGHBOURS is
+set, or for the current snapshot with:
+
+    python neighbours.py --neighbours 20
+
+Rows are processed in blocks sized to NEIGHBOUR_BLOCK_MB of scores per thread, on
+NEIGHBOUR_WORKERS threads, using the recommender's retrieval backend. The result is
+two (num_bottles, N) arrays saved with the snapshot features and memory-mapped on
+load, so WhiskyRecommender.similar_to_bottle reads one row instead of scanning.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Vizinhos por garrafa gravados com o snapshot (0 desativa)
+NUM_NEIGHBOURS = int(os.environ.get("CATALOG_NEIGHBOURS", 0))
+NEIGHBOUR_BLOCK_MB = int(os.environ.get("NEIGHBOUR_BLOCK_MB", 256))
+NEIGHBOUR_WORKERS = int(os.environ.get("NEIGHBOUR_WORKERS", 0)) or os.cpu_count() or 1
+
+
+def _neighbour_block(recommender, rows, num_neighbours):
+    """Neighbour lists of the catalog rows `rows` (the bottle itself excluded)"""
+    vectors = recommender.standardized_rows(rows)
+    indices = np.full((len(rows), num_neighbours), -1, dtype=np.int32)
+    scores = np.zeros((len(rows), num_neighbours), dtype=np.float32)
+    if recommender.retriever.name == 'exact':
+        # Top-k of the whole block at once, one column per bottle
+        block_scores = recommender.similarity_scores(vectors)
+        block_scores[rows, np.arange(len(rows))] = -np.inf
+        k = min(num_neighbours, len(block_scores) - 1)
+        if k <= 0:
+            return indices, scores
+        top = np.argpartition(-block_scores, k - 1, axis=0)[:k]
+        top_scores = np.take_along_axis(block_scores, top, axis=0)
+        order = np.argsort(-top_scores, axis=0, kind='stable')
+        indices[:, :k] = np.take_along_axis(top, order, axis=0).T
+        scores[:, :k] = np.take_along_axis(top_scores, order, axis=0).T
+        return indices, scores
+    results = recommender.retriever.search_batch(vectors, num_neighbours + 1, [None] * len(rows))
+    for i, (row, (found, found_scores)) in enumerate(zip(rows, results)):
+        keep = found != row
+        found, found_scores = found[keep][:num_neighbours], found_scores[keep][:num_neighbours]
+        indices[i, :len(found)] = found
+        scores[i, :len(found)] = found_scores
+    return indices, scores
+
+
+def build_neighbours(recommender, num_neighbours, block_size=None, workers=None):
+    """
+    Neighbour lists of every catalog bottle
+
+    Returns:
+        tuple: (indices, scores), (num_bottles, num_neighbours) int32 / float32 arrays,
+            best first; rows with fewer neighbours are padded with -1 / 0
+    """
+    workers = workers or NEIGHBOUR_WORKERS
+    num_bottles = len(recommender.row_norms)
+    if block_size is None:
+        # Each block holds a (num_bottles, block_size) float64 score matrix
+        block_size = NEIGHBOUR_BLOCK_MB * 2 ** 20 // (8 * max(num_bottles, 1) * workers)
+        block_size = int(min(max(block_size, 1), 1024))
+    indices = np.empty((num_bottles, num_neighbours), dtype=np.int32)
+    scores = np.empty((num_bottles, num_neighbours), dtype=np.float32)
+    blocks = [np.arange(start, min(start + block_size, num_bottles)) for start in range(0, num_bottles, block_size)]
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="neighbours") as executor:
+        results = executor.map(lambda rows: _neighbour_block(recommender, rows, num_neighbours), blocks)
+        for rows, (block_indices, block_scores) in zip(blocks, results):
+            indices[rows] = block_indices
+            scores[rows] = block_scores
+    logger.info(f"Built {num_neighbours} neighbours for {num_bottles} bottles in {time.monotonic() - started:.1f}s "
+                f"({len(blocks)} blocks of {block_size}, {workers} threads)")
+    return indices, scores
+
+
+def main(argv=None):
+    from data_loader import SNAPSHOT_DIR, read_snapshot_meta, load_recommender
+
+    parser = argparse.ArgumentParser(description="Add item-to-item neighbour lists to the current catalog snapshot")
+    parser.add_argument('--neighbours', type=int, default=NUM_NEIGHBOURS or 20, help="Neighbours per bottle")
+    parser.add_argument('--block-size', type=int, default=None, help="Catalog rows per block")
+    parser.add_argument('--workers', type=int, default=None, help="Threads (default: NEIGHBOUR_WORKERS or all cores)")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    if read_snapshot_meta(args.snapshot_dir) is None:
+        print(f"No catalog snapshot in {args.snapshot_dir}")
+        return 1
+    recommender = load_recommender(args.snapshot_dir, refresh=False)
+    indices, scores = build_neighbours(recommender, args.neighbours, args.block_size, args.workers)
+
+    # Arquivos novos no snapshot atual; carregados na próxima vez que ele for aberto
+    features_dir = os.path.join(args.snapshot_dir, recommender.catalog_version, 'features')
+    for key, array in (('neighbour_indices', indices), ('neighbour_scores', scores)):
+        tmp_path = os.path.join(features_dir, f"{key}.npy.tmp-{os.getpid()}")
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, os.path.join(features_dir, f"{key}.npy"))
+    print(f"Saved {args.neighbours} neighbours per bottle to snapshot {recommender.catalog_version}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
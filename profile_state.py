@@ -0,0 +1,159 @@
+import os
+import heapq
+import threading
+from operator import itemgetter
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+# Estados de perfil mantidos por recomendador (LRU) e por quanto tempo
+PROFILE_STATE_SIZE = int(os.environ.get("PROFILE_STATE_SIZE", 1024))
+PROFILE_STATE_TTL = float(os.environ.get("PROFILE_STATE_TTL", 86400))
+
+# Fields of an extracted bar bottle (see WhiskyRecommender.extract_user_bottles), in key order
+BOTTLE_FIELDS = ('id', 'name', 'brand', 'spirit', 'price', 'proof', 'region', 'age', 'image_url')
+NUMERIC_FIELDS = ('price', 'proof', 'age')
+CATEGORY_FIELDS = ('spirit', 'region', 'brand')
+
+
+# Identity of a bottle entry in the diff: all of its fields
+bottle_key = itemgetter(*BOTTLE_FIELDS)
+
+
+def _number(value):
+    """Numeric value as in the user DataFrame: missing or non-numeric values count as 0"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return 0.0 if np.isnan(value) else value
+
+
+def _top_counts(counts, values, k=3):
+    """The k most frequent values with their counts, ties in order of first appearance (as value_counts)"""
+    top = heapq.nlargest(k, counts.values())
+    if not top:
+        return {}
+    candidates = [(value, count) for value, count in counts.items() if count >= top[-1]]
+    if len({count for _, count in candidates}) < len(candidates):
+        # Tied counts: order by first appearance in the bar, for the candidates only
+        wanted, first = {value for value, _ in candidates}, {}
+        for value in values:
+            if value in wanted and value not in first:
+                first[value] = len(first)
+                if len(first) == len(wanted):
+                    break
+        candidates.sort(key=lambda item: first[item[0]])
+    candidates.sort(key=lambda item: -item[1])
+    return dict(candidates[:k])
+
+
+class UserProfileState:
+    """
+    Running aggregates of one user's bar (see WhiskyRecommender.get_recommendations)
+
+    Holds the multiset of bottles, sums of the numeric fields, counters of the
+    categorical values and of the one-hot feature positions, so a new bar is applied
+    as the bottles added and removed since the previous one.
+    """
+
+    def __init__(self, catalog_version=None):
+        self.catalog_version = catalog_version
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.bottles = Counter()
+        self.count = 0
+        self.sums = dict.fromkeys(NUMERIC_FIELDS, 0.0)
+        self.category_counts = {field: Counter() for field in CATEGORY_FIELDS}
+        self.feature_counts = Counter()
+        self.prices = Counter()
+        # Heaps with lazy deletion: entries whose price is no longer in self.prices are skipped
+        self._positive_prices, self._negated_prices = [], []
+
+    def update(self, bottles, recommender):
+        """Apply a new bar (list of extracted bottles); returns (added, removed) bottle counts"""
+        keys = [bottle_key(bottle) for bottle in bottles]
+        current = Counter(keys)
+        # Change in copies per bottle; the (key, count) set differences skip the unchanged bottles
+        delta = Counter()
+        for key, copies in current.items() - self.bottles.items():
+            delta[key] += copies
+        for key, copies in self.bottles.items() - current.items():
+            delta[key] -= copies
+        num_added = sum(copies for copies in delta.values() if copies > 0)
+        num_removed = sum(-copies for copies in delta.values() if copies < 0)
+        if num_added + num_removed > len(keys):
+            # Mais mudanças do que garrafas: recomeça do zero
+            self.reset()
+            delta = current
+        by_key = dict(zip(keys, bottles)) if delta else {}
+        for key, copies in delta.items():
+            if copies < 0:
+                self._apply(dict(zip(BOTTLE_FIELDS, key)), copies, recommender)
+        for key, copies in delta.items():
+            if copies > 0:
+                self._apply(by_key[key], copies, recommender)
+        self.bottles = current
+        return num_added, num_removed
+
+    def _apply(self, bottle, copies, recommender):
+        self.count += copies
+        for field in NUMERIC_FIELDS:
+            self.sums[field] += copies * _number(bottle.get(field))
+        for field in CATEGORY_FIELDS:
+            value = bottle.get(field)
+            if pd.isna(value):
+                continue
+            self.category_counts[field][value] += copies
+            if self.category_counts[field][value] <= 0:
+                del self.category_counts[field][value]
+            position = recommender.feature_index.get(f"{field}_{value}")
+            if position is not None:
+                self.feature_counts[position] += copies
+                if self.feature_counts[position] <= 0:
+                    del self.feature_counts[position]
+        price = _number(bottle.get('price'))
+        self.prices[price] += copies
+        if self.prices[price] <= 0:
+            del self.prices[price]
+        elif copies > 0:
+            heapq.heappush(self._negated_prices, -price)
+            if price > 0:
+                heapq.heappush(self._positive_prices, price)
+            if len(self._negated_prices) > 2 * len(self.prices) + 64:
+                self._negated_prices = [-price for price in self.prices]
+                self._positive_prices = [price for price in self.prices if price > 0]
+                heapq.heapify(self._negated_prices)
+                heapq.heapify(self._positive_prices)
+
+    def _peek(self, heap, sign=1):
+        while heap and sign * heap[0] not in self.prices:
+            heapq.heappop(heap)
+        return sign * heap[0] if heap else 0
+
+    def user_profile(self, bottles):
+        """Same dict as WhiskyRecommender.analyze_user_preferences, from the running aggregates"""
+        return {
+            'avg_price': self.sums['price'] / self.count,
+            'min_price': self._peek(self._positive_prices),
+            'max_price': self._peek(self._negated_prices, -1),
+            'top_spirits': _top_counts(self.category_counts['spirit'], (bottle.get('spirit') for bottle in bottles)),
+            'top_regions': _top_counts(self.category_counts['region'], (bottle.get('region') for bottle in bottles)),
+            'top_brands': _top_counts(self.category_counts['brand'], (bottle.get('brand') for bottle in bottles)),
+            'avg_age': self.sums['age'] / self.count,
+            'avg_proof': self.sums['proof'] / self.count,
+        }
+
+    def profile_vector(self, recommender):
+        """Same vector as WhiskyRecommender.build_user_profile_vector"""
+        mean_features = np.zeros(len(recommender.feature_names))
+        for field in recommender.feature_columns:
+            mean_features[recommender.feature_index[field]] = self.sums[field]
+        if self.feature_counts:
+            positions = np.fromiter(self.feature_counts.keys(), dtype=np.int64, count=len(self.feature_counts))
+            mean_features[positions] = np.fromiter(self.feature_counts.values(), dtype=np.float64,
+                                                   count=len(self.feature_counts))
+        mean_features /= self.count
+        return (mean_features - recommender.scaler.mean_) / recommender.scaler.scale_
@@ -1,95 +1,283 @@
+import os
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
 import logging
+from retrieval import top_k_indices, make_retriever
+from catalog_store import CatalogStore
+from ttl_cache import TTLCache
+from profile_state import UserProfileState, PROFILE_STATE_SIZE, PROFILE_STATE_TTL
+from instrumentation import span, log_payload
 
 logger = logging.getLogger(__name__)
 
+# Precisão da matriz de features: "float64" (padrão) ou "float32" para reduzir memória
+FEATURE_DTYPE = os.environ.get("RECOMMENDER_DTYPE", "float64")
+
+# Bins (right-closed) and labels of the bar charts
+BAR_STAT_BINS = {
+    'price': ([0, 50, 100, 200, 500, 1000, float('inf')], ['<$50', '$50-100', '$100-200', '$200-500', '$500-1000', '$1000+']),
+    'age': ([0, 5, 10, 15, 20, 25, float('inf')], ['NAS/≤5', '6-10', '11-15', '16-20', '21-25', '25+']),
+    'proof': ([0, 80, 90, 100, 110, 120, float('inf')], ['≤80', '80-90', '90-100', '100-110', '110-120', '120+']),
+}
+
+
+class ScalerParams:
+    """Fitted StandardScaler parameters; a snapshot is loaded without importing scikit-learn"""
+    __slots__ = ('mean_', 'scale_', 'var_')
+
+    def __init__(self, mean, scale, var):
+        self.mean_ = np.asarray(mean)
+        self.scale_ = np.asarray(scale)
+        self.var_ = np.asarray(var)
+
+
 class WhiskyRecommender:
     def _get_price_from_master(self, bottle_id):
         try:
-            if 'id' in self.whisky_data.columns:
-                bottle_id_str = str(bottle_id)
-                ids_str = self.whisky_data['id'].astype(str)
-                row = self.whisky_data[ids_str == bottle_id_str]
-                logger.warning(f"Buscando preço para id {bottle_id_str}. Encontrei linhas: {row.shape[0]}")
-                if not row.empty:
-                    val = row.iloc[0]['price']
-                    # Se price for válido (>0), retorna
-                    if not pd.isna(val) and float(val) > 0:
-                        logger.warning(f"Preço encontrado na base mestre para id {bottle_id_str}: {val}")
-                        return float(val)
-                    # Se price for 0 ou NaN, tenta outros campos
-                    for alt_field in ['average_msrp', 'fair_price', 'shelf_price']:
-                        if alt_field in row.columns:
-                            alt_val = row.iloc[0][alt_field]
-                            if not pd.isna(alt_val) and float(alt_val) > 0:
-                                logger.warning(f"Usando {alt_field} para id {bottle_id_str}: {alt_val}")
-                                return float(alt_val)
+            position = self.catalog.position(bottle_id)
+            if position is not None:
+                val = self.catalog.value(position, 'price')
+                # Se price for válido (>0), retorna
+                if not pd.isna(val) and float(val) > 0:
+                    return float(val)
+                # Se price for 0 ou NaN, tenta outros campos
+                for alt_field in ['average_msrp', 'fair_price', 'shelf_price']:
+                    if alt_field in self.catalog:
+                        alt_val = self.catalog.value(position, alt_field)
+                        if not pd.isna(alt_val) and float(alt_val) > 0:
+                            return float(alt_val)
         except Exception as e:
             logger.warning(f"Erro ao buscar preço para id {bottle_id}: {e}")
         return None
+    
+    @property
+    def whisky_data(self):
+        """The catalog as a DataFrame (built on each access from the compact store; for export and tooling)"""
+        return self.catalog.to_dataframe()
+    
+    def get_catalog_positions(self, bottle_ids):
+        """Row positions of all catalog bottles matching the given ids"""
+        return self.catalog.positions(bottle_ids)
+    
+    def owned_mask(self, user_df):
+        """Boolean mask over the catalog rows, True for bottles the user already owns"""
+        mask = np.zeros(len(self.catalog), dtype=bool)
+        mask[self.get_catalog_positions(user_df['id'].tolist())] = True
+        return mask
+    
+    def get_bottle(self, bottle_id):
+        """Catalog record (BottleRecord) for a bottle id, or None if the id is unknown"""
+        position = self.catalog.position(bottle_id)
+        return None if position is None else self.catalog.record(position)
+    
+    def _recommendation_record(self, bottle, **extra):
+        """Recommendation dict for a catalog row"""
+        record = {
+            'id': bottle['id'],
+            'name': bottle['name'],
+            'brand': bottle['brand'],
+            'spirit': bottle['spirit'],
+            'region': bottle.get('region', 'Unknown'),
+            'age': bottle.get('age', 'NAS'),
+            'price': bottle['price'],
+            'proof': bottle['proof'],
+            'image_url': bottle.get('image_url', ''),
+        }
+        record.update(extra)
+        return record
 
-    def __init__(self, whisky_data):
-        """Initialize the recommender with whisky dataset"""
-        self.whisky_data = whisky_data
-        self.preprocess_data()
-        logger.debug(f"Initialized recommender with {len(whisky_data)} bottles")
-    
-    def preprocess_data(self):
-        """Prepare whisky data for recommendations"""
+    def __init__(self, whisky_data, dtype=None, llm_client=None, explanation_cache=None, feature_state=None,
+                 retrieval=None):
+        """
+        Initialize the recommender with whisky dataset
+        
+        whisky_data is a catalog DataFrame or a CatalogStore; it is kept as a compact
+        CatalogStore (self.catalog). When feature_state (from get_feature_state, e.g.
+        loaded from a catalog snapshot) is given, whisky_data must be the already
+        preprocessed catalog and the fitting step is skipped. retrieval selects the
+        similar-bottle search backend ("exact" or "ivf", see retrieval.py; default
+        RECOMMENDER_RETRIEVAL).
+        """
+        self.dtype = np.dtype(dtype or FEATURE_DTYPE)
+        self.llm_client = llm_client
+        self.explanation_cache = explanation_cache
+        self.retrieval = retrieval
+        # Identifies the catalog the features were built from (set by data_loader.load_recommender)
+        self.catalog_version = None
+        # Per-user running profile aggregates (see get_recommendations), LRU by user
+        self.profile_states = TTLCache(max_entries=PROFILE_STATE_SIZE, ttl=PROFILE_STATE_TTL)
+        # Precomputed item-to-item neighbour lists (see neighbours.py), when the catalog has them
+        self.neighbour_indices = self.neighbour_scores = None
+        if feature_state is not None:
+            self.catalog = whisky_data if isinstance(whisky_data, CatalogStore) else CatalogStore.from_dataframe(whisky_data)
+            self.load_feature_state(feature_state)
+        else:
+            self.preprocess_data(whisky_data)
+        logger.debug(f"Initialized recommender with {len(self.catalog)} bottles")
+    
+    def preprocess_data(self, whisky_data):
+        """Prepare whisky data (a DataFrame or a CatalogStore) for recommendations"""
         # Ensure essential columns exist
         essential_columns = ['name', 'brand', 'spirit', 'price', 'proof', 'region']
-        for col in essential_columns:
-            if col not in self.whisky_data.columns:
-                logger.warning(f"Missing column: {col}, adding it with default values")
-                self.whisky_data[col] = 'Unknown' if col not in ['price', 'proof', 'age'] else 0
-                
-        # Add age column if not present
-        if 'age' not in self.whisky_data.columns:
-            logger.warning("Missing column: age, adding it with default values")
-            self.whisky_data['age'] = 0
+        catalog = None
+        if isinstance(whisky_data, CatalogStore):
+            if all(col in whisky_data for col in essential_columns + ['age']):
+                # Só as colunas numéricas saem do store; o texto continua compacto
+                catalog = whisky_data
+                whisky_data = pd.DataFrame({col: catalog.values(col) for col in ['price', 'proof', 'age']})
+            else:
+                whisky_data = whisky_data.to_dataframe()
+        if catalog is None:
+            for col in essential_columns:
+                if col not in whisky_data.columns:
+                    logger.warning(f"Missing column: {col}, adding it with default values")
+                    whisky_data[col] = 'Unknown' if col not in ['price', 'proof', 'age'] else 0
+                    
+            # Add age column if not present
+            if 'age' not in whisky_data.columns:
+                logger.warning("Missing column: age, adding it with default values")
+                whisky_data['age'] = 0
                 
         # Ensure numeric columns are properly formatted
-        self.whisky_data['price'] = pd.to_numeric(self.whisky_data['price'], errors='coerce')
-        self.whisky_data['proof'] = pd.to_numeric(self.whisky_data['proof'], errors='coerce')
-        self.whisky_data['age'] = pd.to_numeric(self.whisky_data['age'], errors='coerce')
+        whisky_data['price'] = pd.to_numeric(whisky_data['price'], errors='coerce')
+        whisky_data['proof'] = pd.to_numeric(whisky_data['proof'], errors='coerce')
+        whisky_data['age'] = pd.to_numeric(whisky_data['age'], errors='coerce')
         
         # Fill missing values
-        self.whisky_data['price'] = self.whisky_data['price'].fillna(self.whisky_data['price'].median() if not self.whisky_data['price'].empty else 0)
-        self.whisky_data['proof'] = self.whisky_data['proof'].fillna(self.whisky_data['proof'].median() if not self.whisky_data['proof'].empty else 0)
-        self.whisky_data['age'] = self.whisky_data['age'].fillna(0)  # 0 for NAS (No Age Statement)
+        whisky_data['price'] = whisky_data['price'].fillna(whisky_data['price'].median() if not whisky_data['price'].empty else 0)
+        whisky_data['proof'] = whisky_data['proof'].fillna(whisky_data['proof'].median() if not whisky_data['proof'].empty else 0)
+        whisky_data['age'] = whisky_data['age'].fillna(0)  # 0 for NAS (No Age Statement)
+        
+        # Compact copy of the catalog; the DataFrame is not kept
+        if catalog is None:
+            self.catalog = CatalogStore.from_dataframe(whisky_data)
+        else:
+            for col in ['price', 'proof', 'age']:
+                if catalog.kind(col) != 'numeric' or pd.isna(catalog.values(col)).any():
+                    catalog.columns[col] = whisky_data[col].to_numpy(dtype=np.float32)
+            self.catalog = catalog
         
         # Extract features for similarity calculation
         self.feature_columns = ['price', 'proof', 'age']
         
-        # Create vectorized features
-        self.spirit_dummies = pd.get_dummies(self.whisky_data['spirit'], prefix='spirit')
-        self.region_dummies = pd.get_dummies(self.whisky_data['region'], prefix='region')
-        self.brand_dummies = pd.get_dummies(self.whisky_data['brand'], prefix='brand')
+        self.categorical_columns = ['spirit', 'region', 'brand']
+        num_bottles = len(whisky_data)
+        
+        # Dense block with the numeric features
+        self.numeric_features = whisky_data[self.feature_columns].to_numpy(dtype=self.dtype)
+        
+        # Sparse one-hot block (CSR) for spirit, region and brand, with the same columns as pd.get_dummies
+        # Category codes (-1 for missing values) come from the catalog store, for column-wise scoring
+        self.feature_names = list(self.feature_columns)
+        self._set_category_codes()
+        rows, cols = [], []
+        for col in self.categorical_columns:
+            codes, categories = self.category_codes[col], self.category_values[col]
+            known = codes >= 0
+            rows.append(np.flatnonzero(known))
+            cols.append(codes[known] + len(self.feature_names) - len(self.feature_columns))
+            self.feature_names.extend(f"{col}_{value}" for value in categories)
+        rows = np.concatenate(rows)
+        self.categorical_features = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=self.dtype), (rows, np.concatenate(cols))),
+            shape=(num_bottles, len(self.feature_names) - len(self.feature_columns))
+        )
+        
+        # Column position of every feature, used to vectorize user bottles in one step
+        self.feature_index = {col: pos for pos, col in enumerate(self.feature_names)}
+        
+        # Fit the scaler without centering so the matrix stays sparse; centering is folded
+        # into the similarity math (see similarity_scores)
+        from sklearn.preprocessing import StandardScaler
+        scaler = StandardScaler(with_mean=False)
+        scaler.fit(sparse.hstack([
+            sparse.csr_matrix(self.numeric_features),
+            self.categorical_features
+        ], format='csr', dtype=np.float64))
+        self.scaler = ScalerParams(scaler.mean_, scaler.scale_, scaler.var_)
+        num_numeric = len(self.feature_columns)
+        mean, inv_var = self.scaler.mean_, 1.0 / self.scaler.scale_ ** 2
+        
+        # Norm of every standardized row: ||(x - mean) / scale||
+        numeric_part = ((self.numeric_features - mean[:num_numeric]) / self.scaler.scale_[:num_numeric]) ** 2
+        categorical_part = (
+            self.categorical_features.power(2) @ inv_var[num_numeric:]
+            - 2 * (self.categorical_features @ (mean * inv_var)[num_numeric:])
+            + np.sum(mean[num_numeric:] ** 2 * inv_var[num_numeric:])
+        )
+        self.row_norms = np.sqrt(np.maximum(numeric_part.sum(axis=1) + categorical_part, 0)).astype(self.dtype)
         
-        # Combine features
-        self.features_df = pd.concat([
-            self.whisky_data[self.feature_columns],
-            self.spirit_dummies,
-            self.region_dummies,
-            self.brand_dummies
-        ], axis=1)
+        self.catalog.build_id_index()
         
-        # Normalize features
-        self.scaler = StandardScaler()
-        self.normalized_features = self.scaler.fit_transform(self.features_df)
+        # Similar-bottle search backend (builds the approximate index, if any)
+        self.retriever = make_retriever(self, self.retrieval)
         
         logger.debug("Data preprocessing complete")
     
-    def get_recommendations(self, bar_data, num_recommendations=5):
+    def _set_category_codes(self):
+        """Category codes and values of the categorical columns, shared with the catalog store"""
+        self.category_codes, self.category_values = {}, {}
+        for col in self.categorical_columns:
+            column = self.catalog.column(col)
+            self.category_codes[col], self.category_values[col] = column.codes, pd.Index(column.categories, dtype=object)
+    
+    def get_feature_state(self):
+        """
+        Fitted feature arrays and scaler parameters, as plain NumPy arrays (see load_feature_state)
+        
+        The category codes are not included: they are part of the catalog store.
+        """
+        state = {
+            'feature_columns': np.array(self.feature_columns),
+            'categorical_columns': np.array(self.categorical_columns),
+            'feature_names': np.array(self.feature_names, dtype=str),
+            'numeric_features': self.numeric_features,
+            'categorical_data': self.categorical_features.data,
+            'categorical_indices': self.categorical_features.indices,
+            'categorical_indptr': self.categorical_features.indptr,
+            'scaler_mean': self.scaler.mean_,
+            'scaler_scale': self.scaler.scale_,
+            'scaler_var': self.scaler.var_,
+            'row_norms': self.row_norms,
+        }
+        state.update(self.retriever.get_state())
+        if self.neighbour_indices is not None:
+            state['neighbour_indices'], state['neighbour_scores'] = self.neighbour_indices, self.neighbour_scores
+        return state
+    
+    def load_feature_state(self, state):
+        """Restore the fitted features without refitting; arrays may be read-only memory maps"""
+        self.feature_columns = [str(col) for col in state['feature_columns']]
+        self.categorical_columns = [str(col) for col in state['categorical_columns']]
+        self.feature_names = [str(name) for name in state['feature_names']]
+        self.feature_index = {col: pos for pos, col in enumerate(self.feature_names)}
+        self.numeric_features = state['numeric_features']
+        self.dtype = self.numeric_features.dtype
+        self.categorical_features = sparse.csr_matrix(
+            (state['categorical_data'], state['categorical_indices'], state['categorical_indptr']),
+            shape=(len(self.numeric_features), len(self.feature_names) - len(self.feature_columns))
+        )
+        self.scaler = ScalerParams(state['scaler_mean'], state['scaler_scale'], state['scaler_var'])
+        self.row_norms = state['row_norms']
+        self._set_category_codes()
+        self.catalog.build_id_index()
+        self.retriever = make_retriever(self, self.retrieval, state)
+        if 'neighbour_indices' in state and len(state['neighbour_indices']) == len(self.catalog):
+            self.neighbour_indices, self.neighbour_scores = state['neighbour_indices'], state['neighbour_scores']
+    
+    def get_recommendations(self, bar_data, num_recommendations=5, explain=True, user_key=None):
         """
         Generate whisky recommendations based on user bar
         
         Parameters:
         - bar_data: List of user's bottles from BAXUS API
         - num_recommendations: Number of recommendations to generate
+        - explain: Whether to fetch the LLM explanations; when False, 'llm_message'
+          holds the rule-based reasoning text (see add_llm_messages)
+        - user_key: Identifies the user (e.g. the BAXUS username); when given, the
+          profile is kept between calls and only the bottles added or removed since
+          the previous bar are applied to it (see incremental_profile)
         
         Returns:
         - user_profile: Dict of user preferences
@@ -98,55 +286,155 @@ class WhiskyRecommender:
         - bar_stats: Statistics about user's collection
         """
         try:
-            # DEBUG: Log bar_data recebido
-            logger.warning(f"bar_data recebido: {bar_data}")
-            # Extract bottle info from bar data
-            user_bottles = []
-            for item in bar_data:
-                if 'product' in item and item['product']:
-                    bottle = item['product']
-                    user_bottles.append({
-                        'id': bottle.get('id'),
-                        'name': bottle.get('name', 'Unknown'),
-                        'brand': bottle.get('brand', 'Unknown'),
-                        'spirit': bottle.get('spirit', 'Unknown'),
-                        'price': bottle.get('price') if bottle.get('price') is not None else self._get_price_from_master(bottle.get('id')),
-                        'proof': bottle.get('proof'),
-                        'region': bottle.get('region', 'Unknown'),
-                        'age': bottle.get('age'),
-                        'image_url': bottle.get('image_url')
-                    })
-            
-            logger.warning(f"user_bottles extraído: {user_bottles}")
-            if not user_bottles:
+            log_payload(logger, "bar_data recebido", bar_data)
+            with span('extract_bottles'):
+                user_bottles = self.extract_user_bottles(bar_data)
+                user_df = self.bottles_dataframe(user_bottles)
+            if user_df is None:
                 logger.warning("No valid bottles found in user bar data")
                 return {}, [], [], {}
             
-            # Create DataFrame of user bottles
-            user_df = pd.DataFrame(user_bottles)
-            
-            # Corrige valores None para 0 em campos numéricos
-            for col in ['price', 'proof', 'age']:
-                if col in user_df.columns:
-                    user_df[col] = user_df[col].fillna(0)
-            # Analyze user preferences
-            user_profile = self.analyze_user_preferences(user_df)
-            
-            # Find similar bottles (based on user preferences)
-            similar_recs = self.find_similar_bottles(user_df, num_recommendations)
-            
-            # Find complementary bottles (to diversify collection)
-            complementary_recs = self.find_complementary_bottles(user_df, user_profile, num_recommendations)
-            
-            # Get collection statistics
-            bar_stats = self.calculate_bar_stats(user_df)
-            
-            return user_profile, similar_recs, complementary_recs, bar_stats
+            profile = None
+            if user_key is not None:
+                with span('profile'):
+                    profile = self.incremental_profile(user_key, user_bottles)
+            return self.recommend_for_user(user_df, num_recommendations, explain, profile=profile)
             
         except Exception as e:
             logger.error(f"Error generating recommendations: {e}", exc_info=True)
             return {}, [], [], {}
     
+    def get_recommendations_batch(self, bars, num_recommendations=5, explain=False):
+        """
+        Generate recommendations for many bars at once
+        
+        The similar bottles of every user are searched in one call to the retriever
+        (a single matrix product against the catalog for the exact scan). Returns one (user_profile, similar_recs,
+        complementary_recs, bar_stats) tuple per bar, in order; bars without valid
+        bottles (or that fail) get empty results, as in get_recommendations.
+        """
+        user_dfs = []
+        for bar_data in bars:
+            try:
+                user_dfs.append(self.build_user_dataframe(bar_data))
+            except Exception as e:
+                logger.error(f"Error reading bar data: {e}", exc_info=True)
+                user_dfs.append(None)
+        
+        valid = [position for position, user_df in enumerate(user_dfs) if user_df is not None]
+        neighbours = []
+        if valid:
+            profile_vectors = np.vstack([self.build_user_profile_vector(user_dfs[position]) for position in valid])
+            excludes = [self.owned_mask(user_dfs[position]) for position in valid]
+            with span('batch_search'):
+                neighbours = self.retriever.search_batch(profile_vectors, num_recommendations, excludes)
+        
+        results = [({}, [], [], {})] * len(user_dfs)
+        for column, position in enumerate(valid):
+            try:
+                results[position] = self.recommend_for_user(
+                    user_dfs[position], num_recommendations, explain, neighbours=neighbours[column]
+                )
+            except Exception as e:
+                logger.error(f"Error generating recommendations: {e}", exc_info=True)
+        return results
+    
+    def build_user_dataframe(self, bar_data):
+        """DataFrame of the bottles in a BAXUS bar payload, or None if it has no valid bottle"""
+        return self.bottles_dataframe(self.extract_user_bottles(bar_data))
+    
+    def extract_user_bottles(self, bar_data):
+        """One dict per bottle of a BAXUS bar payload (price taken from the catalog when missing)"""
+        user_bottles = []
+        for item in bar_data:
+            if 'product' in item and item['product']:
+                bottle = item['product']
+                user_bottles.append({
+                    'id': bottle.get('id'),
+                    'name': bottle.get('name', 'Unknown'),
+                    'brand': bottle.get('brand', 'Unknown'),
+                    'spirit': bottle.get('spirit', 'Unknown'),
+                    'price': bottle.get('price') if bottle.get('price') is not None else self._get_price_from_master(bottle.get('id')),
+                    'proof': bottle.get('proof'),
+                    'region': bottle.get('region', 'Unknown'),
+                    'age': bottle.get('age'),
+                    'image_url': bottle.get('image_url')
+                })
+        
+        log_payload(logger, "user_bottles extraído", user_bottles)
+        return user_bottles
+    
+    def bottles_dataframe(self, user_bottles):
+        """DataFrame of extracted bottles, or None if there are none"""
+        if not user_bottles:
+            return None
+        
+        # Create DataFrame of user bottles
+        user_df = pd.DataFrame(user_bottles)
+        
+        # Corrige valores None para 0 em campos numéricos
+        for col in ['price', 'proof', 'age']:
+            if col in user_df.columns:
+                user_df[col] = user_df[col].fillna(0)
+        return user_df
+    
+    def recommend_for_user(self, user_df, num_recommendations=5, explain=True, neighbours=None, profile=None):
+        """
+        Profile, recommendations and stats for one user's bottles (see get_recommendations)
+        
+        neighbours can hold the user's precomputed (positions, scores) search result (batch path),
+        profile the (user_profile, profile_vector) pair from incremental_profile.
+        """
+        # Analyze user preferences
+        if profile is None:
+            with span('profile'):
+                user_profile, profile_vector = self.analyze_user_preferences(user_df), None
+        else:
+            user_profile, profile_vector = profile
+        
+        # Find similar bottles (based on user preferences)
+        with span('similarity'):
+            similar_recs = self.find_similar_bottles(
+                user_df, num_recommendations, user_profile, explain=False, neighbours=neighbours,
+                profile_vector=profile_vector
+            )
+        
+        # Find complementary bottles (to diversify collection)
+        with span('complementary'):
+            complementary_recs = self.find_complementary_bottles(user_df, user_profile, num_recommendations, explain=False)
+        
+        # LLM explanations for both lists, fetched concurrently under one deadline
+        if explain:
+            with span('llm'):
+                self.add_llm_messages(similar_recs + complementary_recs, user_profile)
+        else:
+            for rec in similar_recs + complementary_recs:
+                rec['llm_message'] = self.reasoning_message(rec['reasoning'])
+        
+        # Get collection statistics
+        with span('bar_stats'):
+            bar_stats = self.calculate_bar_stats(user_df)
+        
+        return user_profile, similar_recs, complementary_recs, bar_stats
+    
+    def incremental_profile(self, user_key, user_bottles):
+        """
+        (user_profile, profile_vector) of a user, updated from the previous call's state
+        
+        Equivalent to analyze_user_preferences and build_user_profile_vector on the
+        user's DataFrame, but only the bottles that changed since the user's last bar
+        are applied. States are kept in an LRU (PROFILE_STATE_SIZE users) and are
+        rebuilt when the catalog version changes.
+        """
+        state = self.profile_states.get(user_key)
+        if state is None or state.catalog_version != self.catalog_version:
+            state = UserProfileState(self.catalog_version)
+            self.profile_states.set(user_key, state)
+        with state.lock:
+            added, removed = state.update(user_bottles, self)
+            logger.debug(f"Profile state of {user_key}: {added} bottles added, {removed} removed")
+            return state.user_profile(user_bottles), state.profile_vector(self)
+    
     def analyze_user_preferences(self, user_df):
         """Extract user preferences from their bottle collection"""
         user_profile = {'avg_price': 0, 'min_price': 0, 'max_price': 0}
@@ -156,7 +444,6 @@ class WhiskyRecommender:
             prices = user_df['price']
             prices_nonzero = prices[prices > 0]
             price_stats = prices.describe()
-            import numpy as np
             avg_price = price_stats.get('mean', 0)
             min_price = prices_nonzero.min() if not prices_nonzero.empty else 0
             max_price = price_stats.get('max', 0)
@@ -201,158 +488,277 @@ class WhiskyRecommender:
         
         return user_profile
     
-    def find_similar_bottles(self, user_df, num_recommendations=5, user_profile=None):
-        """Find bottles similar to user's collection"""
+    def build_user_feature_matrix(self, user_df):
+        """Build the raw (unscaled) sparse feature matrix of the user's bottles, one row per bottle"""
+        num_bottles = len(user_df)
+        rows, cols, values = [], [], []
+        
+        # Numeric features (missing values count as 0)
+        for col in self.feature_columns:
+            if col in user_df.columns:
+                rows.append(np.arange(num_bottles))
+                cols.append(np.full(num_bottles, self.feature_index[col]))
+                values.append(pd.to_numeric(user_df[col], errors='coerce').fillna(0).to_numpy(dtype=float))
+        
+        # One-hot encoded features, only for categories known by the catalog
+        for prefix in self.categorical_columns:
+            if prefix not in user_df.columns:
+                continue
+            positions = np.array([
+                -1 if pd.isna(value) else self.feature_index.get(f"{prefix}_{value}", -1)
+                for value in user_df[prefix]
+            ], dtype=int)
+            known = np.flatnonzero(positions >= 0)
+            rows.append(known)
+            cols.append(positions[known])
+            values.append(np.ones(len(known)))
+        
+        return sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(num_bottles, len(self.feature_names))
+        )
+    
+    def build_user_profile_vector(self, user_df):
+        """Average of the user's standardized bottle vectors"""
+        mean_features = np.asarray(self.build_user_feature_matrix(user_df).mean(axis=0)).ravel()
+        return (mean_features - self.scaler.mean_) / self.scaler.scale_
+    
+    def standardized_rows(self, rows):
+        """Dense standardized vectors (x - mean) / scale of the given catalog rows"""
+        raw = np.hstack([
+            np.asarray(self.numeric_features[rows], dtype=np.float64),
+            self.categorical_features[rows].toarray()
+        ])
+        return (raw - self.scaler.mean_) / self.scaler.scale_
+    
+    def similarity_scores(self, profile_vectors, rows=None):
+        """
+        Cosine similarity between standardized profile vector(s) and every catalog bottle.
+        
+        The catalog is stored unscaled and uncentered, so for z = (x - mean) / scale:
+        z . u = x . (u / scale) - mean . (u / scale), which keeps the product sparse.
+        Accepts one vector (returns shape (n_bottles,)) or a matrix of row vectors
+        (returns shape (n_bottles, n_vectors)). rows (positions or a slice) restricts
+        the scoring to those catalog bottles.
+        """
+        numeric, categorical, row_norms = self.numeric_features, self.categorical_features, self.row_norms
+        if rows is not None:
+            numeric, categorical, row_norms = numeric[rows], categorical[rows], row_norms[rows]
+        profile_vectors = np.asarray(profile_vectors, dtype=np.float64)
+        single = profile_vectors.ndim == 1
+        weights = (np.atleast_2d(profile_vectors) / self.scaler.scale_).T
+        offset = self.scaler.mean_ @ weights
+        num_numeric = len(self.feature_columns)
+        
+        scores = (
+            numeric @ weights[:num_numeric].astype(self.dtype)
+            + categorical @ weights[num_numeric:].astype(self.dtype)
+            - offset
+        )
+        
+        # Zero-norm vectors get similarity 0, as in sklearn's cosine_similarity
+        profile_norms = np.linalg.norm(profile_vectors.reshape(-1, len(self.feature_names)), axis=1)
+        profile_norms[profile_norms == 0] = 1
+        row_norms = np.where(row_norms == 0, 1, row_norms)
+        scores = scores / row_norms[:, None] / profile_norms
+        return scores[:, 0] if single else scores
+    
+    def find_similar_bottles(self, user_df, num_recommendations=5, user_profile=None, explain=True, neighbours=None,
+                             profile_vector=None):
+        """
+        Find bottles similar to user's collection
+        
+        neighbours (precomputed retriever result) and profile_vector (see incremental_profile) are optional.
+        """
         user_profile = user_profile or self.analyze_user_preferences(user_df)
-        user_bottle_ids = set(user_df['id'].astype(str).tolist())
-        user_feature_vectors = []
-        for _, bottle in user_df.iterrows():
-            # Get similar features as in the whisky dataset
-            features = {}
-            
-            # Numeric features
-            for col in self.feature_columns:
-                if col in bottle and not pd.isna(bottle[col]):
-                    features[col] = bottle[col]
-                else:
-                    features[col] = 0
-            
-            # One-hot encoded features
-            if 'spirit' in bottle and not pd.isna(bottle['spirit']):
-                spirit_key = f"spirit_{bottle['spirit']}"
-                if spirit_key in self.spirit_dummies.columns:
-                    features[spirit_key] = 1
-            
-            if 'region' in bottle and not pd.isna(bottle['region']):
-                region_key = f"region_{bottle['region']}"
-                if region_key in self.region_dummies.columns:
-                    features[region_key] = 1
-            
-            if 'brand' in bottle and not pd.isna(bottle['brand']):
-                brand_key = f"brand_{bottle['brand']}"
-                if brand_key in self.brand_dummies.columns:
-                    features[brand_key] = 1
-            
-            # Create a DataFrame with the features
-            bottle_features_df = pd.DataFrame([features])
-            
-            # Fill in missing columns from the full feature set
-            for col in self.features_df.columns:
-                if col not in bottle_features_df.columns:
-                    bottle_features_df[col] = 0
-            
-            # Reorder columns to match the full feature set
-            bottle_features_df = bottle_features_df[self.features_df.columns]
-            
-            # Scale features
-            bottle_features_scaled = self.scaler.transform(bottle_features_df)
-            user_feature_vectors.append(bottle_features_scaled[0])
         
-        # Calculate average user profile vector
-        if user_feature_vectors:
-            user_profile_vector = np.mean(user_feature_vectors, axis=0).reshape(1, -1)
-            
-            # Calculate similarity between user profile and all whisky bottles
-            similarity_scores = cosine_similarity(user_profile_vector, self.normalized_features)[0]
-            
-            # Get indices of most similar bottles, excluding user's existing bottles
-            similar_indices = []
-            for idx in np.argsort(similarity_scores)[::-1]:
-                bottle_id = str(self.whisky_data.iloc[idx]['id'])
-                if bottle_id not in user_bottle_ids:
-                    similar_indices.append(idx)
-                if len(similar_indices) >= num_recommendations:
-                    break
+        if not user_df.empty:
+            if neighbours is None:
+                # Calculate average user profile vector
+                user_profile_vector = (
+                    self.build_user_profile_vector(user_df) if profile_vector is None else profile_vector
+                )
+                
+                # Most similar bottles to the profile, excluding user's existing bottles
+                neighbours = self.retriever.search(
+                    user_profile_vector, num_recommendations, exclude=self.owned_mask(user_df)
+                )
+            similar_indices, similar_scores = neighbours
             
             # Get recommended bottle details
             similar_bottles = []
-            for idx in similar_indices:
-                bottle = self.whisky_data.iloc[idx]
+            for idx, score in zip(similar_indices, similar_scores):
+                bottle = self.catalog.record(idx)
                 
                 # Extract reasoning based on similarity to user's collection
                 reasoning = self.generate_similarity_reasoning(bottle, user_df)
                 
-                llm_message = self.generate_llm_message(bottle, user_profile)
-                
-                similar_bottles.append({
-                    'id': bottle['id'],
-                    'name': bottle['name'],
-                    'brand': bottle['brand'],
-                    'spirit': bottle['spirit'],
-                    'region': bottle.get('region', 'Unknown'),
-                    'age': bottle.get('age', 'NAS'),
-                    'price': bottle['price'],
-                    'proof': bottle['proof'],
-                    'image_url': bottle.get('image_url', ''),
-                    'similarity_score': similarity_scores[idx],
-                    'reasoning': reasoning,
-                    'llm_message': llm_message
-                })
+                similar_bottles.append(self._recommendation_record(
+                    bottle,
+                    similarity_score=score,
+                    reasoning=reasoning,
+                    llm_message=None
+                ))
             
+            if explain:
+                self.add_llm_messages(similar_bottles, user_profile)
             return similar_bottles
         
         return []
     
-    def find_complementary_bottles(self, user_df, user_profile, num_recommendations=5):
-        user_bottle_ids = set(user_df['id'].astype(str).tolist())
-        user_spirits = set(user_df['spirit'].unique())
-        user_regions = set(user_df['region'].unique())
-        all_spirits = set(self.whisky_data['spirit'].unique())
-        all_regions = set(self.whisky_data['region'].unique())
-        missing_spirits = all_spirits - user_spirits
-        missing_regions = all_regions - user_regions
-        complementary_score = []
-        for idx, bottle in self.whisky_data.iterrows():
-            score = 0
-            bottle_id = str(bottle['id'])
-            if bottle_id in user_bottle_ids:
-                continue
-            if bottle['spirit'] in missing_spirits:
-                score += 3
-            if bottle.get('region') in missing_regions:
-                score += 2
-            avg_price = user_profile.get('avg_price', 0)
-            if abs(bottle['price'] - avg_price) < (avg_price * 0.3):
-                score += 1
-            complementary_score.append((idx, score))
-        complementary_score.sort(key=lambda x: x[1], reverse=True)
+    def similar_to_bottle(self, bottle_id, num_recommendations=5):
+        """
+        Catalog bottles most similar to one bottle ("more like this")
+        
+        Reads the bottle's precomputed neighbour list when the catalog has one long
+        enough (see neighbours.py); otherwise searches with the bottle's own vector.
+        Other catalog rows with the same id are skipped.
+        
+        Returns:
+        - (bottle, recommendations): the bottle's record and the recommendation dicts,
+          or None if the id is not in the catalog
+        """
+        position = self.catalog.position(bottle_id)
+        if position is None:
+            return None
+        source = self.catalog.record(position)
+        same_id = self.catalog.positions([bottle_id])
+        
+        if self.neighbour_indices is not None and num_recommendations + len(same_id) - 1 <= self.neighbour_indices.shape[1]:
+            indices = np.asarray(self.neighbour_indices[position], dtype=int)
+            scores = np.asarray(self.neighbour_scores[position], dtype=np.float64)
+            keep = (indices >= 0) & ~np.isin(indices, same_id)
+            indices, scores = indices[keep][:num_recommendations], scores[keep][:num_recommendations]
+        else:
+            exclude = np.zeros(len(self.catalog), dtype=bool)
+            exclude[same_id] = True
+            indices, scores = self.retriever.search(self.standardized_rows([position])[0], num_recommendations, exclude)
+        
+        recommendations = []
+        for idx, score in zip(indices, scores):
+            bottle = self.catalog.record(idx)
+            reasoning = self.generate_bottle_similarity_reasoning(bottle, source)
+            recommendations.append(self._recommendation_record(
+                bottle,
+                similarity_score=float(score),
+                reasoning=reasoning,
+                llm_message=self.reasoning_message(reasoning)
+            ))
+        return self._recommendation_record(source), recommendations
+    
+    def find_complementary_bottles(self, user_df, user_profile, num_recommendations=5, explain=True):
+        owned = self.owned_mask(user_df)
+        
+        # +3 for a spirit missing from the collection, +2 for a missing region,
+        # +1 for a price within 30% of the user's average
+        avg_price = user_profile.get('avg_price', 0)
+        prices = np.asarray(self.numeric_features[:, self.feature_columns.index('price')], dtype=np.float64)
+        complementary_score = (
+            3 * self._missing_category_mask('spirit', user_df['spirit'])
+            + 2 * self._missing_category_mask('region', user_df['region'])
+            + (np.abs(prices - avg_price) < (avg_price * 0.3))
+        )
+        
         complementary_bottles = []
-        for idx, score in complementary_score[:num_recommendations]:
-            bottle = self.whisky_data.iloc[idx]
+        for idx in top_k_indices(complementary_score, num_recommendations, exclude=owned):
+            bottle = self.catalog.record(idx)
+            score = int(complementary_score[idx])
             reasoning = self.generate_complementary_reasoning(bottle, user_df, user_profile)
-            llm_message = self.generate_llm_message(bottle, user_profile)
-            complementary_bottles.append({
-                'id': bottle['id'],
-                'name': bottle['name'],
-                'brand': bottle['brand'],
-                'spirit': bottle['spirit'],
-                'region': bottle.get('region', 'Unknown'),
-                'age': bottle.get('age', 'NAS'),
-                'price': bottle['price'],
-                'proof': bottle['proof'],
-                'image_url': bottle.get('image_url', ''),
-                'complementary_score': score,
-                'reasoning': reasoning,
-                'llm_message': llm_message
-            })
+            complementary_bottles.append(self._recommendation_record(
+                bottle,
+                complementary_score=score,
+                reasoning=reasoning,
+                llm_message=None
+            ))
+        if explain:
+            self.add_llm_messages(complementary_bottles, user_profile)
         return complementary_bottles
     
-    def generate_llm_message(self, bottle, user_profile):
-        """
-        Gera uma mensagem personalizada usando LLM Groq.
-        """
-        from llm_utils import generate_llm_message
-        prompt = (
+    def _missing_category_mask(self, col, user_values):
+        """Boolean mask over the catalog, True where the bottle's category is absent from user_values"""
+        missing = ~pd.Index(self.category_values[col]).isin(user_values)
+        # Code -1 (missing value in the catalog) maps to the last slot
+        missing_na = not pd.isna(user_values).any()
+        return np.append(missing, missing_na)[self.category_codes[col]]
+    
+    def build_llm_prompt(self, bottle, user_profile):
+        """Prompt asking the LLM why a bottle suits the user"""
+        return (
             f"Usuário prefere {', '.join(user_profile.get('top_spirits', {}).keys()) or 'whisky'}, "
             f"faixa de preço ${user_profile.get('avg_price', 'N/A')}. "
             f"Garrafa sugerida: {bottle.get('name', 'Desconhecida')}, {bottle.get('spirit', '')}, "
             f"${bottle.get('price', '')}, região {bottle.get('region', '')}. "
             "Explique de forma amigável em uma frase por que ela é uma boa escolha para o usuário. Não mencione valores"
         )
-        try:
-            return generate_llm_message(prompt)
-        except Exception as e:
-            return f"Sugestão baseada nos seus gostos e perfil. (Erro LLM: {e})"
+    
+    def build_llm_batch_prompt(self, bottles, user_profile):
+        """Single prompt asking the LLM why each of several bottles suits the user, answered as JSON"""
+        lines = "\n".join(
+            f"- id {bottle.get('id')}: {bottle.get('name', 'Desconhecida')}, {bottle.get('spirit', '')}, "
+            f"${bottle.get('price', '')}, região {bottle.get('region', '')}"
+            for bottle in bottles
+        )
+        return (
+            f"Usuário prefere {', '.join(user_profile.get('top_spirits', {}).keys()) or 'whisky'}, "
+            f"faixa de preço ${user_profile.get('avg_price', 'N/A')}. "
+            f"Garrafas sugeridas:\n{lines}\n"
+            "Para cada garrafa, explique de forma amigável em uma frase por que ela é uma boa escolha para o usuário. "
+            "Não mencione valores. Responda somente com um array JSON, um item por garrafa: "
+            '[{"id": <id da garrafa>, "message": "<frase>"}]'
+        )
+    
+    @staticmethod
+    def reasoning_message(reasoning):
+        """Rule-based message used when the LLM explanation is not available"""
+        return " ".join(f"{reason}." for reason in reasoning)
+    
+    def iter_llm_messages(self, recommendations, user_profile):
+        """
+        Yield (index, llm_message) for every recommendation as soon as it is available.
+        
+        Cached explanations come first. The others are asked in batched prompts when
+        the client supports it (one call per group of bottles, with per-bottle calls
+        for the bottles missing from the reply), or with one call per bottle, all under
+        one deadline. Bottles whose explanation fails or does not arrive in time get
+        the rule-based reasoning text (which is not cached).
+        """
+        from llm_utils import get_llm_client
+        from explanation_cache import get_explanation_cache
+        client = self.llm_client or get_llm_client()
+        cache = self.explanation_cache or get_explanation_cache()
+        
+        pending = []
+        for index, rec in enumerate(recommendations):
+            key = cache.make_key(rec['id'], user_profile, self.catalog_version)
+            message = cache.get(key)
+            if message is None:
+                pending.append((index, key))
+            else:
+                yield index, message
+        
+        prompts = [self.build_llm_prompt(recommendations[index], user_profile) for index, _ in pending]
+        if len(pending) > 1 and getattr(client, 'batch', False):
+            messages = client.iter_batched(
+                prompts, [recommendations[index]['id'] for index, _ in pending],
+                lambda positions: self.build_llm_batch_prompt(
+                    [recommendations[pending[position][0]] for position in positions], user_profile
+                )
+            )
+        else:
+            messages = client.iter_many(prompts)
+        for position, message in messages:
+            index, key = pending[position]
+            if message is None:
+                message = self.reasoning_message(recommendations[index]['reasoning'])
+            else:
+                cache.set(key, message)
+            yield index, message
+    
+    def add_llm_messages(self, recommendations, user_profile):
+        """Fill 'llm_message' of every recommendation (see iter_llm_messages)"""
+        for index, message in self.iter_llm_messages(recommendations, user_profile):
+            recommendations[index]['llm_message'] = message
+        return recommendations
 
     def generate_similarity_reasoning(self, rec_bottle, user_df):
         """Generate reasoning for why a bottle is similar to user's collection"""
@@ -381,6 +787,28 @@ class WhiskyRecommender:
         
         return reasons
     
+    def generate_bottle_similarity_reasoning(self, rec_bottle, source_bottle):
+        """Generate reasoning for why a bottle is similar to another bottle"""
+        reasons = []
+        
+        if rec_bottle['brand'] == source_bottle['brand']:
+            reasons.append(f"Also made by {rec_bottle['brand']}")
+        
+        if rec_bottle['spirit'] == source_bottle['spirit']:
+            reasons.append(f"Also a {rec_bottle['spirit']}")
+        
+        if 'region' in rec_bottle and rec_bottle.get('region') == source_bottle.get('region'):
+            reasons.append(f"Also from {rec_bottle['region']}")
+        
+        source_price = source_bottle['price']
+        if abs(rec_bottle['price'] - source_price) < (source_price * 0.2):
+            reasons.append(f"Similar price point (${rec_bottle['price']})")
+        
+        if not reasons:
+            reasons.append(f"Has similar characteristics to {source_bottle['name']}")
+        
+        return reasons
+    
     def generate_complementary_reasoning(self, rec_bottle, user_df, user_profile):
         """Generate reasoning for why a bottle complements user's collection"""
         reasons = []
@@ -419,37 +847,21 @@ class WhiskyRecommender:
         """Calculate statistics about user's bar collection for visualization"""
         stats = {}
         
-        # Count bottles by spirit type
-        if 'spirit' in user_df.columns:
-            stats['spirits_count'] = user_df['spirit'].value_counts().to_dict()
-        
-        # Count bottles by region
-        if 'region' in user_df.columns:
-            stats['regions_count'] = user_df['region'].value_counts().to_dict()
-        
-        # Count bottles by brand
-        if 'brand' in user_df.columns:
-            stats['brands_count'] = user_df['brand'].value_counts().to_dict()
-        
-        # Price distribution
-        if 'price' in user_df.columns and not user_df['price'].empty:
-            price_bins = [0, 50, 100, 200, 500, 1000, float('inf')]
-            price_labels = ['<$50', '$50-100', '$100-200', '$200-500', '$500-1000', '$1000+']
-            price_counts = pd.cut(user_df['price'], bins=price_bins, labels=price_labels).value_counts().to_dict()
-            stats['price_distribution'] = price_counts
-        
-        # Age distribution
-        if 'age' in user_df.columns and not user_df['age'].empty:
-            age_bins = [0, 5, 10, 15, 20, 25, float('inf')]
-            age_labels = ['NAS/≤5', '6-10', '11-15', '16-20', '21-25', '25+']
-            age_counts = pd.cut(user_df['age'], bins=age_bins, labels=age_labels).value_counts().to_dict()
-            stats['age_distribution'] = age_counts
-        
-        # Proof distribution
-        if 'proof' in user_df.columns and not user_df['proof'].empty:
-            proof_bins = [0, 80, 90, 100, 110, 120, float('inf')]
-            proof_labels = ['≤80', '80-90', '90-100', '100-110', '110-120', '120+']
-            proof_counts = pd.cut(user_df['proof'], bins=proof_bins, labels=proof_labels).value_counts().to_dict()
-            stats['proof_distribution'] = proof_counts
+        # Counts by spirit type, region and brand, most frequent first (ties in order of appearance)
+        for col, key in (('spirit', 'spirits_count'), ('region', 'regions_count'), ('brand', 'brands_count')):
+            if col in user_df.columns:
+                codes, uniques = pd.factorize(user_df[col])
+                counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+                order = np.argsort(-counts, kind='stable')
+                stats[key] = dict(zip(uniques[order].tolist(), counts[order].tolist()))
+        
+        # Price, age and proof distributions: right-closed bins, values <= 0 or missing are not counted
+        for col, key in (('price', 'price_distribution'), ('age', 'age_distribution'), ('proof', 'proof_distribution')):
+            if col in user_df.columns and not user_df[col].empty:
+                bins, labels = BAR_STAT_BINS[col]
+                values = pd.to_numeric(user_df[col], errors='coerce').to_numpy(dtype=float)
+                positions = np.digitize(values[~np.isnan(values)], bins, right=True)
+                counts = np.bincount(positions, minlength=len(bins) + 1)[1:len(bins)]
+                stats[key] = dict(zip(labels, counts.tolist()))
         
         return stats
@@ -0,0 +1,104 @@
+import os
+import json
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Por omissão os resultados ficam num ficheiro SQLite ao lado do snapshot do catálogo,
+# partilhado por todos os workers: o token da sessão vale em qualquer um deles
+DEFAULT_RESULT_STORE_PATH = os.path.join(os.environ.get("CATALOG_SNAPSHOT_DIR", "catalog_snapshot"), "results.db")
+
+
+def _to_native(obj):
+    # Tipos numpy -> tipos nativos Python para serializar em JSON
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def bar_fingerprint(bar_data):
+    """Hash of the user's bar payload, used to tell whether stored results are still valid"""
+    payload = json.dumps(bar_data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class ResultStore(TTLCache):
+    """
+    Server-side store for computed recommendation results.
+
+    Results are kept per username and catalog version as zlib-compressed compact
+    JSON, in a SQLite file (`db_path`) shared by the worker processes, or without one
+    in an in-process LRU. Only the short token from make_token needs to go into the
+    Flask session.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, db_path=None):
+        # Com o ficheiro partilhado não há cópia em memória: outro worker pode reescrever
+        # um resultado (explicações do LLM) e a cópia local ficaria desatualizada
+        super().__init__(max_entries=0 if db_path else max_entries, ttl=ttl, db_path=db_path, table='results')
+
+    @staticmethod
+    def make_token(username, catalog_version):
+        key = f"{catalog_version}|{username.strip().lower()}"
+        return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    def put_result(self, token, result):
+        """Store a result dict (numpy scalars are converted to native types)"""
+        payload = json.dumps(result, separators=(',', ':'), default=_to_native, allow_nan=True)
+        self.set(token, zlib.compress(payload.encode(), 6))
+
+    def get_result(self, token):
+        """Stored result dict for the token, or None"""
+        if not token:
+            return None
+        value = self.get(token)
+        if value is None:
+            return None
+        return json.loads(zlib.decompress(value))
+
+    def put_chart_data(self, data):
+        """Store chart data as compact JSON; returns its key, a hash of the content"""
+        payload = json.dumps(data, separators=(',', ':'), default=_to_native).encode()
+        key = hashlib.sha1(payload).hexdigest()[:20]
+        self.set(f"chart:{key}", zlib.compress(payload, 6))
+        return key
+
+    def get_chart_data(self, key):
+        """Compact JSON (bytes) stored by put_chart_data, or None"""
+        value = self.get(f"chart:{key}")
+        return None if value is None else zlib.decompress(value)
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_result_store():
+    """
+    Shared ResultStore configured from the environment
+
+    RESULT_STORE_PATH selects the SQLite file (default DEFAULT_RESULT_STORE_PATH); an
+    empty value keeps results in this process only, which is only valid with a single
+    worker process.
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            options = dict(max_entries=int(os.environ.get("RESULT_STORE_SIZE", 1024)),
+                           ttl=float(os.environ.get("RESULT_STORE_TTL", 3600)))
+            db_path = os.environ.get("RESULT_STORE_PATH", DEFAULT_RESULT_STORE_PATH) or None
+            try:
+                if db_path:
+                    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+                _default_store = ResultStore(db_path=db_path, **options)
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Cannot open the result store at {db_path} ({e}), keeping results in this "
+                             f"process only: with several workers, results will not be found by the others")
+                _default_store = ResultStore(**options)
+        return _default_store
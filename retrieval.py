@@ -0,0 +1,488 @@
+import os
+import time
+import logging
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+# Backend de busca dos vizinhos: "exact" (varredura completa) ou "ivf" (aproximado)
+RETRIEVAL_BACKEND = os.environ.get("RECOMMENDER_RETRIEVAL", "exact")
+
+# Row x centroid scores computed per block when assigning the catalog to IVF partitions
+ASSIGN_BLOCK_ELEMENTS = 1 << 22
+# Rounds of splitting oversized IVF partitions
+REBALANCE_ROUNDS = 3
+# k of the recall@k an IVF index must reach before it is used
+RECALL_K = 10
+
+
+def top_k_indices(scores, k, exclude=None):
+    """
+    Positions of the k highest scores, best first, without sorting the whole vector.
+
+    Positions flagged True in the boolean `exclude` mask are never returned.
+    Ties are broken by catalog order (lower position first); NaN scores rank last.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    candidates = np.arange(len(scores)) if exclude is None else np.flatnonzero(~np.asarray(exclude))
+    if k <= 0 or len(candidates) == 0:
+        return np.array([], dtype=int)
+    values = scores[candidates]
+    values = np.where(np.isnan(values), -np.inf, values)
+
+    if k < len(values):
+        # The k-th best value is the cut-off: keep everything above it and
+        # complete with the earliest positions tied with it
+        threshold = values[np.argpartition(-values, k - 1)[:k]].min()
+        above = np.flatnonzero(values > threshold)
+        tied = np.flatnonzero(values == threshold)[:k - len(above)]
+        selected = np.concatenate([above, tied])
+    else:
+        selected = np.arange(len(values))
+
+    order = np.lexsort((selected, -values[selected]))
+    return candidates[selected[order]]
+
+
+class ExactRetriever:
+    """Exact scan: cosine similarity between the profile and every catalog bottle"""
+
+    name = 'exact'
+
+    def __init__(self, recommender, rejected_index=None):
+        self.recommender = recommender
+        # Persisted record of an IVF index that failed its check (see make_retriever)
+        self.rejected_index = rejected_index
+
+    def search(self, profile_vector, k, exclude=None):
+        """(positions, scores) of the k most similar bottles, best first"""
+        scores = self.recommender.similarity_scores(profile_vector)
+        indices = top_k_indices(scores, k, exclude=exclude)
+        return indices, scores[indices]
+
+    def search_batch(self, profile_vectors, k, excludes):
+        """search for every row of profile_vectors, scored with one matrix product"""
+        scores = self.recommender.similarity_scores(profile_vectors)
+        results = []
+        for column, exclude in enumerate(excludes):
+            indices = top_k_indices(scores[:, column], k, exclude=exclude)
+            results.append((indices, scores[indices, column]))
+        return results
+
+    def get_state(self):
+        return dict(self.rejected_index) if self.rejected_index else {}
+
+    def measure_recall(self, num_queries=100, k=10, **options):
+        return {'backend': self.name, 'k': k, 'queries': 0, 'recall': 1.0, 'scanned_fraction': 1.0}
+
+
+class IVFRetriever:
+    """
+    Approximate search over an inverted file index.
+
+    The standardized catalog vectors are split into partitions with spherical k-means
+    (about `n_lists`, trained on up to `train_size` rows). A partition holding more
+    than `max_list_ratio` times the average number of bottles is split again, so no
+    query has to scan one huge partition. A query scores the partition centroids,
+    then runs the exact cosine only on the bottles of the `n_probe` closest
+    partitions. More probes give higher recall and slower queries.
+
+    The centroids are kept sparse, as sums of unscaled catalog rows (the same trick
+    as WhiskyRecommender.similarity_scores), and the catalog features are copied in
+    partition order, so a partition is a contiguous block of rows and a query never
+    gathers scattered rows.
+    """
+
+    name = 'ivf'
+
+    def __init__(self, recommender, n_lists=None, n_probe=20, train_size=50000, iterations=10, seed=0,
+                 max_list_ratio=2.0):
+        self.recommender = recommender
+        num_bottles = len(recommender.row_norms)
+        self.n_lists = max(1, min(int(n_lists or 4 * np.sqrt(num_bottles)), num_bottles))
+        self.n_probe = max(1, int(n_probe))
+        self.train_size = int(train_size)
+        self.iterations = int(iterations)
+        self.seed = int(seed)
+        self.max_list_ratio = float(max_list_ratio)
+        self.centroids = None
+        self.list_offsets = None
+        self.list_members = None
+        self.list_numeric = self.list_categorical = self.list_row_norms = None
+        # One-hot columns split by frequency, only while building (see _split_categorical)
+        self._categorical_split = None
+        # Result of the check against the exact scan (see make_retriever)
+        self.report = None
+
+    def params(self):
+        return np.array([self.n_lists, self.train_size, self.iterations, self.seed, self.max_list_ratio])
+
+    def build(self):
+        """Train the partitions, split the oversized ones and assign every catalog bottle to one"""
+        start = time.time()
+        num_bottles = len(self.recommender.row_norms)
+        rng = np.random.default_rng(self.seed)
+        all_rows = np.arange(num_bottles)
+        sample = np.sort(rng.choice(num_bottles, size=min(num_bottles, self.train_size), replace=False))
+        self._split_categorical()
+
+        sums = self._kmeans(sample, self.n_lists, rng)
+        labels = self._assign(self._centroids(sums), all_rows)
+        labels, num_lists = self._rebalance(labels, rng)
+        # Centróides finais: médias exatas das partições do catálogo inteiro
+        self.centroids = self._centroids(self._unit_sums(labels, all_rows, num_lists)[0])
+        self._set_lists(np.argsort(labels, kind='stable'), np.bincount(labels, minlength=num_lists))
+        self._categorical_split = None
+        sizes = np.diff(self.list_offsets)
+        logger.info(f"Built IVF index with {num_lists} lists over {num_bottles} bottles in {time.time() - start:.2f}s "
+                    f"(largest list {sizes.max()}, average {num_bottles / num_lists:.0f})")
+        return self
+
+    def _split_categorical(self):
+        """
+        Split the one-hot columns into the common ones (present in at least an average list's
+        worth of bottles, so in nearly every centroid) and the rare ones, scored densely and
+        sparsely by _assign
+        """
+        categorical = self.recommender.categorical_features.tocsc()
+        counts = np.diff(categorical.indptr)
+        common = counts >= categorical.shape[0] / self.n_lists
+        self._categorical_split = (
+            np.flatnonzero(common), categorical[:, common].tocsr(),
+            np.flatnonzero(~common), categorical[:, ~common].tocsr(),
+        )
+
+    def _set_lists(self, members, sizes):
+        rec = self.recommender
+        self.list_members = members
+        self.list_offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.list_numeric = np.asarray(rec.numeric_features[members])
+        self.list_categorical = rec.categorical_features[members]
+        self.list_row_norms = np.asarray(rec.row_norms[members])
+
+    def _unit_sums(self, labels, rows, num_clusters):
+        """
+        Per cluster: sum of the unscaled numeric and categorical rows, each divided by the
+        norm of its standardized vector, the sum of those weights, and the cluster sizes
+        """
+        rec = self.recommender
+        norms = np.asarray(rec.row_norms[rows], dtype=np.float64)
+        weights = 1.0 / np.where(norms == 0, 1, norms)
+        assignment = sparse.csr_matrix((weights, (labels, np.arange(len(rows)))), shape=(num_clusters, len(rows)))
+        numeric = assignment @ np.asarray(rec.numeric_features[rows], dtype=np.float64)
+        categorical = sparse.csr_matrix(assignment @ rec.categorical_features[rows].astype(np.float64))
+        weight_sums = np.asarray(assignment.sum(axis=1)).ravel()
+        return (numeric, categorical, weight_sums), np.bincount(labels, minlength=num_clusters)
+
+    def _centroids(self, sums):
+        """
+        Everything needed to score against the centroids (sum - w * mean) / scale of
+        the clusters, without materializing them as dense vectors
+        """
+        numeric, categorical, weights = sums
+        scaler = self.recommender.scaler
+        num_numeric = numeric.shape[1]
+        inv_var = 1.0 / scaler.scale_ ** 2
+        mean_inv_var = scaler.mean_ * inv_var
+        mean_dot = numeric @ mean_inv_var[:num_numeric] + categorical @ mean_inv_var[num_numeric:]
+        mean_sq = scaler.mean_ @ mean_inv_var
+        squares = (numeric ** 2) @ inv_var[:num_numeric] + categorical.multiply(categorical) @ inv_var[num_numeric:]
+        norms = np.sqrt(np.maximum(squares - 2 * weights * mean_dot + weights ** 2 * mean_sq, 0))
+        norms = np.where(norms == 0, 1, norms)
+        return {
+            'numeric': numeric,
+            'categorical': categorical,
+            'weights': weights,
+            'norms': norms,
+            'constant': (weights * mean_sq - mean_dot) / norms,
+            'inv_var': inv_var,
+            'row_mean': mean_inv_var,
+        }
+
+    def _assign(self, centroids, rows):
+        """Closest centroid (by cosine) of every row, scored in blocks"""
+        rec = self.recommender
+        common, categorical_common, rare, categorical_rare = self._categorical_split
+        num_numeric = centroids['numeric'].shape[1]
+        norms = centroids['norms']
+        inv_var = centroids['inv_var'][num_numeric:]
+        row_mean = centroids['row_mean']
+        # Fatores já divididos pelas normas; a última linha numérica multiplica x . (mean / var)
+        numeric_factors = np.vstack([(centroids['numeric'] * centroids['inv_var'][:num_numeric]).T,
+                                     -centroids['weights']]) / norms
+        categorical = centroids['categorical'].tocsc()
+        common_factors = (categorical[:, common].toarray() * inv_var[common]).T / norms
+        rare_factors = sparse.csr_matrix(categorical[:, rare].multiply(inv_var[rare]).T.multiply(1 / norms))
+        block = max(256, ASSIGN_BLOCK_ELEMENTS // len(norms))
+        labels = np.empty(len(rows), dtype=np.int64)
+        for start in range(0, len(rows), block):
+            chunk = rows[start:start + block]
+            numeric = np.asarray(rec.numeric_features[chunk], dtype=np.float64)
+            # z . c = x . (s / var) - w x . (mean / var) - mean . (s / var) + w mean . (mean / var)
+            row_dot = numeric @ row_mean[:num_numeric] + rec.categorical_features[chunk] @ row_mean[num_numeric:]
+            scores = np.column_stack([numeric, row_dot]) @ numeric_factors
+            scores += categorical_common[chunk] @ common_factors
+            rare_scores = (categorical_rare[chunk] @ rare_factors).tocoo()
+            scores[rare_scores.row, rare_scores.col] += rare_scores.data
+            scores += centroids['constant']
+            labels[start:start + len(chunk)] = np.argmax(scores, axis=1)
+        return labels
+
+    def _kmeans(self, rows, num_clusters, rng):
+        """Spherical k-means over the given catalog rows; returns the cluster sums"""
+        num_clusters = min(num_clusters, len(rows))
+        seeds = np.sort(rng.choice(rows, size=num_clusters, replace=False))
+        sums = self._unit_sums(np.arange(num_clusters), seeds, num_clusters)[0]
+        for _ in range(self.iterations):
+            labels = self._assign(self._centroids(sums), rows)
+            new_sums, counts = self._unit_sums(labels, rows, num_clusters)
+            # Partições vazias ficam com o centróide anterior
+            empty = counts == 0
+            if empty.any():
+                keep = sparse.diags((~empty).astype(np.float64))
+                new_sums = (
+                    np.where(empty[:, None], sums[0], new_sums[0]),
+                    sparse.csr_matrix(keep @ new_sums[1] + sparse.diags(empty.astype(np.float64)) @ sums[1]),
+                    np.where(empty, sums[2], new_sums[2]),
+                )
+            sums = new_sums
+        return sums
+
+    def _rebalance(self, labels, rng):
+        """Split the lists holding more than max_list_ratio times the average; returns (labels, number of lists)"""
+        num_bottles = len(labels)
+        average = num_bottles / self.n_lists
+        limit = max(1, int(np.ceil(self.max_list_ratio * average)))
+        num_lists = self.n_lists
+        unsplittable = set()
+        for _ in range(REBALANCE_ROUNDS):
+            sizes = np.bincount(labels, minlength=num_lists)
+            oversized = [lst for lst in np.flatnonzero(sizes > limit) if lst not in unsplittable]
+            if not oversized:
+                break
+            order = np.argsort(labels, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            for lst in oversized:
+                members = order[offsets[lst]:offsets[lst + 1]]
+                train = members if len(members) <= self.train_size else np.sort(
+                    rng.choice(members, size=self.train_size, replace=False))
+                pieces = int(np.ceil(len(members) / average))
+                sub_labels = self._assign(self._centroids(self._kmeans(train, pieces, rng)), members)
+                used, sub_labels = np.unique(sub_labels, return_inverse=True)
+                if len(used) == 1:
+                    # Bottles with the same vector: cannot be split
+                    unsplittable.add(lst)
+                    continue
+                # A primeira sub-partição fica com o número da lista original
+                labels[members] = np.where(sub_labels == 0, lst, num_lists + sub_labels - 1)
+                num_lists += len(used) - 1
+        return labels, num_lists
+
+    def _probe(self, profile_vector):
+        """Partitions whose centroids are closest to the profile"""
+        centroids, scaler = self.centroids, self.recommender.scaler
+        weights = np.asarray(profile_vector, dtype=np.float64) / scaler.scale_
+        num_numeric = centroids['numeric'].shape[1]
+        # c . u = s . (u / scale) - w mean . (u / scale)
+        scores = (centroids['numeric'] @ weights[:num_numeric] + centroids['categorical'] @ weights[num_numeric:]
+                  - centroids['weights'] * (scaler.mean_ @ weights)) / centroids['norms']
+        return top_k_indices(scores, self.n_probe)
+
+    def candidates(self, profile_vector, exclude=None):
+        """Catalog positions in the n_probe partitions closest to the profile"""
+        rows = np.concatenate([
+            self.list_members[self.list_offsets[lst]:self.list_offsets[lst + 1]] for lst in self._probe(profile_vector)
+        ])
+        if exclude is not None:
+            rows = rows[~np.asarray(exclude)[rows]]
+        return rows
+
+    def search(self, profile_vector, k, exclude=None):
+        """(positions, scores) of the (approximately) k most similar bottles, best first"""
+        rec = self.recommender
+        profile_vector = np.asarray(profile_vector, dtype=np.float64)
+        weights = profile_vector / rec.scaler.scale_
+        offset = rec.scaler.mean_ @ weights
+        num_numeric = len(rec.feature_columns)
+        numeric_weights = weights[:num_numeric].astype(rec.dtype)
+        categorical_weights = weights[num_numeric:].astype(rec.dtype)
+        profile_norm = np.linalg.norm(profile_vector) or 1.0
+
+        categorical = self.list_categorical
+        positions, scores = [], []
+        for lst in self._probe(profile_vector):
+            start, end = self.list_offsets[lst], self.list_offsets[lst + 1]
+            if start == end:
+                continue
+            # Partição = bloco contíguo das cópias ordenadas: só fatias, sem gather de linhas
+            indptr = categorical.indptr[start:end + 1]
+            contributions = np.append(
+                categorical.data[indptr[0]:indptr[-1]] * categorical_weights[categorical.indices[indptr[0]:indptr[-1]]],
+                0
+            )
+            categorical_scores = np.add.reduceat(contributions, indptr[:-1] - indptr[0])
+            categorical_scores[indptr[1:] == indptr[:-1]] = 0
+            block_scores = self.list_numeric[start:end] @ numeric_weights + categorical_scores - offset
+            row_norms = self.list_row_norms[start:end]
+            positions.append(self.list_members[start:end])
+            scores.append(block_scores / np.where(row_norms == 0, 1, row_norms) / profile_norm)
+        positions = np.concatenate(positions) if positions else np.array([], dtype=np.int64)
+        scores = np.concatenate(scores) if scores else np.array([])
+        if exclude is not None:
+            keep = ~np.asarray(exclude)[positions]
+            positions, scores = positions[keep], scores[keep]
+        if len(positions) < k:
+            # Poucas garrafas nas partições visitadas: varredura exata
+            return ExactRetriever(rec).search(profile_vector, k, exclude)
+        top = _top_k_by_position(positions, scores, k)
+        return positions[top], scores[top]
+
+    def search_batch(self, profile_vectors, k, excludes):
+        return [self.search(vector, k, exclude) for vector, exclude in zip(profile_vectors, excludes)]
+
+    def get_state(self):
+        centroids = self.centroids
+        state = {
+            'ivf_params': self.params(),
+            'ivf_centroid_numeric': centroids['numeric'],
+            'ivf_centroid_data': centroids['categorical'].data,
+            'ivf_centroid_indices': centroids['categorical'].indices,
+            'ivf_centroid_indptr': centroids['categorical'].indptr,
+            'ivf_centroid_weights': centroids['weights'],
+            'ivf_offsets': self.list_offsets,
+            'ivf_members': self.list_members,
+            'ivf_numeric': self.list_numeric,
+            'ivf_categorical_data': self.list_categorical.data,
+            'ivf_categorical_indices': self.list_categorical.indices,
+            'ivf_categorical_indptr': self.list_categorical.indptr,
+            'ivf_row_norms': self.list_row_norms,
+        }
+        if self.report is not None:
+            state['ivf_checked'] = np.array([self.n_probe, self.report['target_recall'], self.report['k']])
+        return state
+
+    def load_state(self, state):
+        """Restore a persisted index; False if it was built with other parameters"""
+        if 'ivf_params' not in state or not np.array_equal(state['ivf_params'], self.params()):
+            return False
+        if 'ivf_numeric' not in state or len(state['ivf_members']) != len(self.recommender.row_norms):
+            return False
+        num_lists = len(state['ivf_offsets']) - 1
+        categorical = sparse.csr_matrix(
+            (state['ivf_centroid_data'], state['ivf_centroid_indices'], state['ivf_centroid_indptr']),
+            shape=(num_lists, self.recommender.categorical_features.shape[1])
+        )
+        self.centroids = self._centroids((np.asarray(state['ivf_centroid_numeric']), categorical,
+                                          np.asarray(state['ivf_centroid_weights'])))
+        self.list_offsets = np.asarray(state['ivf_offsets'])
+        self.list_members = state['ivf_members']
+        self.list_numeric = state['ivf_numeric']
+        self.list_categorical = sparse.csr_matrix(
+            (state['ivf_categorical_data'], state['ivf_categorical_indices'], state['ivf_categorical_indptr']),
+            shape=self.recommender.categorical_features.shape
+        )
+        self.list_row_norms = state['ivf_row_norms']
+        return True
+
+    def measure_recall(self, num_queries=100, k=10, bottles_per_query=5, seed=0):
+        """
+        Recall@k of this index against the exact scan, and the query times of both.
+
+        Queries are profiles averaged from random catalog bottles, as user profiles are.
+        """
+        rec = self.recommender
+        exact = ExactRetriever(rec)
+        num_bottles = len(rec.row_norms)
+        rng = np.random.default_rng(seed)
+        hits, scanned, exact_time, approx_time = 0, 0, 0.0, 0.0
+        for _ in range(num_queries):
+            rows = rng.choice(num_bottles, size=min(bottles_per_query, num_bottles), replace=False)
+            vector = rec.standardized_rows(rows).mean(axis=0)
+            start = time.perf_counter()
+            expected = exact.search(vector, k)[0]
+            exact_time += time.perf_counter() - start
+            start = time.perf_counter()
+            found = self.search(vector, k)[0]
+            approx_time += time.perf_counter() - start
+            hits += len(np.intersect1d(expected, found))
+            scanned += len(self.candidates(vector))
+        sizes = np.diff(self.list_offsets)
+        return {
+            'backend': self.name,
+            'k': k,
+            'queries': num_queries,
+            'n_lists': len(sizes),
+            'n_probe': self.n_probe,
+            'largest_list': int(sizes.max()),
+            'recall': hits / max(num_queries * min(k, num_bottles), 1),
+            'scanned_fraction': scanned / max(num_queries * num_bottles, 1),
+            'exact_ms': 1000 * exact_time / max(num_queries, 1),
+            'approximate_ms': 1000 * approx_time / max(num_queries, 1),
+        }
+
+
+def _top_k_by_position(positions, scores, k):
+    """Indices of the k best scores, best first, ties broken by catalog position (as top_k_indices)"""
+    top = top_k_indices(scores, k)
+    threshold = scores[top[-1]]
+    tied = np.flatnonzero(scores == threshold)
+    if len(tied) > np.count_nonzero(scores[top] == threshold):
+        above = top[scores[top] > threshold]
+        tied = tied[np.argsort(positions[tied], kind='stable')][:k - len(above)]
+        top = np.concatenate([above, tied])
+    return top[np.lexsort((positions[top], -scores[top]))]
+
+
+def make_retriever(recommender, backend=None, state=None):
+    """
+    Retrieval backend for a recommender ("exact" or "ivf"), configured from the environment.
+
+    An IVF index is only used once measure_recall shows that it reaches
+    IVF_TARGET_RECALL and answers faster than the exact scan; otherwise the exact
+    scan is kept. An index found in `state` (a persisted feature state) is reused
+    when it was built with the same parameters, and so is a rejection, so a
+    rejected index is not rebuilt on every load.
+    """
+    backend = backend or RETRIEVAL_BACKEND
+    if backend == 'exact':
+        return ExactRetriever(recommender)
+    if backend != 'ivf':
+        raise ValueError(f"Unknown retrieval backend: {backend}")
+
+    retriever = IVFRetriever(
+        recommender,
+        n_lists=int(os.environ.get("IVF_LISTS", 0)) or None,
+        n_probe=int(os.environ.get("IVF_PROBES", 20)),
+        train_size=int(os.environ.get("IVF_TRAIN_SIZE", 50000)),
+        iterations=int(os.environ.get("IVF_ITERATIONS", 10)),
+        max_list_ratio=float(os.environ.get("IVF_MAX_LIST_RATIO", 2.0))
+    )
+    target_recall = float(os.environ.get("IVF_TARGET_RECALL", 0.95))
+    num_queries = int(os.environ.get("IVF_RECALL_QUERIES", 50))
+    check = np.concatenate([retriever.params(), [retriever.n_probe, target_recall, RECALL_K]])
+
+    if state is not None and np.array_equal(state.get('ivf_rejected', []), check):
+        logger.info("Using the exact scan: the IVF index with these settings was rejected when it was built")
+        return ExactRetriever(recommender, rejected_index={'ivf_rejected': check})
+    if state is not None and retriever.load_state(state):
+        checked = state.get('ivf_checked')
+        if checked is not None and np.array_equal(checked, check[-3:]):
+            return retriever
+    else:
+        retriever.build()
+
+    if num_queries <= 0:
+        logger.warning("IVF index used without checking it against the exact scan (IVF_RECALL_QUERIES=0)")
+        return retriever
+    report = retriever.measure_recall(num_queries=num_queries, k=RECALL_K)
+    report['target_recall'] = target_recall
+    summary = (f"recall@{report['k']} {report['recall']:.3f} (target {target_recall}), "
+               f"{report['approximate_ms']:.2f} ms per query against {report['exact_ms']:.2f} ms for the exact scan, "
+               f"scanning {report['scanned_fraction']:.1%} of the catalog")
+    if report['recall'] < target_recall or report['approximate_ms'] >= report['exact_ms']:
+        logger.warning(f"IVF index rejected, using the exact scan: {summary}")
+        return ExactRetriever(recommender, rejected_index={'ivf_rejected': check})
+    logger.info(f"IVF index accepted: {summary}")
+    retriever.report = report
+    return retriever
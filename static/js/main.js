@@ -74,6 +74,57 @@ function initTooltips() {
     });
 }
 
+// Receive the LLM explanations over Server-Sent Events and replace the placeholder messages
+function initExplanationStream() {
+    const streamElement = document.getElementById('explanationStream');
+    if (!streamElement || typeof EventSource === 'undefined') return;
+
+    const source = new EventSource(streamElement.dataset.url);
+    source.onmessage = function(event) {
+        const data = JSON.parse(event.data);
+        const selector = '.llm-suggestion-text[data-rec-list="' + data.list + '"][data-rec-index="' + data.index + '"]';
+        document.querySelectorAll(selector).forEach(span => {
+            if (data.llm_message) span.textContent = data.llm_message;
+            span.classList.remove('llm-pending');
+        });
+    };
+    source.addEventListener('done', function() {
+        source.close();
+        document.querySelectorAll('.llm-suggestion-text.llm-pending').forEach(span => {
+            span.classList.remove('llm-pending');
+        });
+    });
+    source.onerror = function() {
+        // Mantém as mensagens baseadas em regras se o stream cair
+        source.close();
+        document.querySelectorAll('.llm-suggestion-text.llm-pending').forEach(span => {
+            span.classList.remove('llm-pending');
+        });
+    };
+}
+
+// Fetch the bar stats (cached by the browser) and draw the charts
+function initBarCharts() {
+    const barStatsElement = document.getElementById('barStatsData');
+    if (!barStatsElement) return;
+
+    fetch(barStatsElement.dataset.url)
+        .then(response => response.ok ? response.json() : null)
+        .then(barStats => {
+            if (!barStats) return;
+            if (barStats.spirits_count) {
+                createSpiritChart(barStats.spirits_count);
+            }
+            if (barStats.brands_count) {
+                createBrandChart(barStats.brands_count);
+            }
+            if (barStats.price_distribution) {
+                createPriceChart(barStats.price_distribution);
+            }
+        })
+        .catch(error => console.error('Error loading bar stats:', error));
+}
+
 // Initialize the application when the DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
     // Ativa o carrossel para trocar slides automaticamente a cada 5 segundos
@@ -95,19 +146,10 @@ document.addEventListener('DOMContentLoaded', function() {
     hideLoader();
     
     // Initialize charts if we're on the recommendations page
-    const barStatsElement = document.getElementById('barStatsData');
-    if (barStatsElement) {
-        const barStats = JSON.parse(barStatsElement.textContent);
-        if (barStats.spirit_types) {
-            createSpiritChart(barStats.spirit_types);
-        }
-        if (barStats.brands_count) {
-            createBrandChart(barStats.brands_count);
-        }
-        if (barStats.price_distribution) {
-            createPriceChart(barStats.price_distribution);
-        }
-    }
+    initBarCharts();
+    
+    // Stream the LLM explanations into the recommendations page
+    initExplanationStream();
     
     // Setup view toggle buttons
     const gridBtn = document.getElementById('gridBtn');
@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# Os testes importam os módulos da raiz do repositório
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubServer:
+    """
+    Local HTTP server answering GET and POST requests from a script.
+
+    `responses` is a list of (status, body, delay) consumed one per request; the last
+    one is repeated once the list runs out. Every request path is kept in `requests`
+    and every POST body (parsed as JSON when possible) in `bodies`.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.bodies = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def script(self, responses):
+        """Replace the responses still to be served"""
+        with self._lock:
+            self.responses = list(responses)
+
+    def _next_response(self, path, body=None):
+        with self._lock:
+            self.requests.append(path)
+            if body is not None:
+                self.bodies.append(body)
+            if len(self.responses) > 1:
+                return self.responses.pop(0)
+            return self.responses[0]
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._answer(*stub._next_response(self.path))
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                try:
+                    body = json.loads(raw)
+                except ValueError:
+                    body = raw
+                self._answer(*stub._next_response(self.path, body))
+
+            def _answer(self, status, body, delay):
+                if delay:
+                    time.sleep(delay)
+                payload = body if isinstance(body, bytes) else json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """Factory for StubServer instances, stopped at the end of the test"""
+    servers = []
+
+    def start(responses):
+        server = StubServer(responses).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+os.environ.setdefault('CATALOG_LOAD', 'lazy')
+
+import app as app_module
+
+BAR = [{'product': {'id': 1, 'name': 'Bottle A'}}]
+
+
+class FakeRecommender:
+    catalog_version = 'test'
+
+    def __init__(self):
+        self.calls = []
+
+    def get_recommendations(self, bar_data, num_recommendations=5, explain=True, user_key=None):
+        self.calls.append({'bar': bar_data, 'explain': explain, 'user_key': user_key})
+        return {}, [], [], {}
+
+
+class FakeBaxusClient:
+    def get_bar(self, username):
+        return BAR
+
+
+@pytest.fixture
+def api(monkeypatch):
+    recommender = FakeRecommender()
+    monkeypatch.setattr(app_module.catalog_manager, 'wait', lambda timeout=None: recommender)
+    monkeypatch.setattr(app_module, 'baxus_client', FakeBaxusClient())
+    return app_module.app.test_client(), recommender
+
+
+def test_fetched_bar_updates_the_user_profile_state(api):
+    client, recommender = api
+    response = client.post('/api/recommendations', json={'username': 'alice', 'explain': False})
+    assert response.status_code == 200
+    assert recommender.calls == [{'bar': BAR, 'explain': False, 'user_key': 'alice'}]
+
+
+def test_raw_bar_does_not_touch_the_user_profile_state(api):
+    client, recommender = api
+    other_bar = [{'product': {'id': 2, 'name': 'Bottle B'}}]
+    response = client.post('/api/recommendations', json={'username': 'alice', 'bar': other_bar, 'explain': False})
+    assert response.status_code == 200
+    assert recommender.calls == [{'bar': other_bar, 'explain': False, 'user_key': None}]
+
+
+@pytest.mark.parametrize('value, expected', [(True, True), (0, False), ('false', False), (' TRUE ', True), ('1', True)])
+def test_explain_flag_values(api, value, expected):
+    client, recommender = api
+    assert client.post('/api/recommendations', json={'username': 'alice', 'explain': value}).status_code == 200
+    assert recommender.calls[-1]['explain'] is expected
+
+
+@pytest.mark.parametrize('value', ['yes', 2, None, [], 'off'])
+def test_invalid_explain_flag_is_rejected(api, value):
+    client, recommender = api
+    response = client.post('/api/recommendations', json={'username': 'alice', 'explain': value})
+    assert response.status_code == 400
+    assert recommender.calls == []
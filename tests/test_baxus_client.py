@@ -0,0 +1,137 @@
+import time
+import threading
+
+import pytest
+
+from baxus_client import BaxusClient, BaxusAPIError
+
+BAR = [{'product': {'id': 1, 'name': 'Bottle A'}}, {'product': {'id': 2, 'name': 'Bottle B'}}]
+
+
+def make_client(server, **kwargs):
+    options = dict(base_url=server.url + '/api', connect_timeout=1, read_timeout=1, retries=2,
+                   backoff_factor=0, cache_ttl=0)
+    options.update(kwargs)
+    return BaxusClient(**options)
+
+
+def test_get_bar_returns_parsed_json(stub_server):
+    server = stub_server([(200, BAR, 0)])
+    client = make_client(server)
+    assert client.get_bar('alice') == BAR
+    assert server.requests == ['/api/bar/user/alice']
+
+
+def test_username_is_quoted_in_path(stub_server):
+    server = stub_server([(200, [], 0)])
+    make_client(server).get_bar('a/b c')
+    assert server.requests == ['/api/bar/user/a%2Fb%20c']
+
+
+def test_5xx_is_retried_until_success(stub_server):
+    server = stub_server([(503, {'error': 'busy'}, 0), (502, {'error': 'busy'}, 0), (200, BAR, 0)])
+    client = make_client(server)
+    assert client.get_bar('alice') == BAR
+    assert len(server.requests) == 3
+
+
+def test_retries_exhausted_raise_api_error(stub_server):
+    server = stub_server([(500, {'error': 'down'}, 0)])
+    client = make_client(server, retries=2)
+    with pytest.raises(BaxusAPIError) as excinfo:
+        client.get_bar('alice')
+    assert excinfo.value.status_code == 500
+    # A primeira tentativa mais duas repetições
+    assert len(server.requests) == 3
+
+
+def test_read_timeout_raises_api_error(stub_server):
+    server = stub_server([(200, BAR, 1.0)])
+    client = make_client(server, read_timeout=0.2, retries=0)
+    with pytest.raises(BaxusAPIError) as excinfo:
+        client.get_bar('alice')
+    assert excinfo.value.status_code is None
+
+
+def test_unknown_user_is_not_retried(stub_server):
+    server = stub_server([(404, {'error': 'user not found'}, 0)])
+    client = make_client(server)
+    with pytest.raises(BaxusAPIError) as excinfo:
+        client.get_bar('nobody')
+    assert excinfo.value.status_code == 404
+    assert len(server.requests) == 1
+
+
+def test_invalid_json_raises_api_error(stub_server):
+    server = stub_server([(200, b'<html>not json</html>', 0)])
+    with pytest.raises(BaxusAPIError) as excinfo:
+        make_client(server).get_bar('alice')
+    assert excinfo.value.status_code == 200
+
+
+def test_connection_refused_raises_api_error():
+    client = BaxusClient(base_url='http://127.0.0.1:9/api', connect_timeout=0.5, retries=0, cache_ttl=0)
+    with pytest.raises(BaxusAPIError) as excinfo:
+        client.get_bar('alice')
+    assert excinfo.value.status_code is None
+
+
+def test_bar_is_cached_until_invalidated(stub_server):
+    server = stub_server([(200, BAR, 0)])
+    client = make_client(server, cache_ttl=60)
+    assert client.get_bar('alice') == BAR
+    assert client.get_bar('alice') == BAR
+    assert len(server.requests) == 1
+    client.invalidate('alice')
+    client.get_bar('alice')
+    assert len(server.requests) == 2
+
+
+def test_session_reuses_pooled_connection(stub_server):
+    server = stub_server([(200, BAR, 0)])
+    client = make_client(server)
+    for _ in range(3):
+        client.get_bar('alice')
+    adapter = client.session.get_adapter(server.url)
+    pools = list(adapter.poolmanager.pools._container.values())
+    assert len(pools) == 1
+    assert pools[0].num_connections == 1
+
+
+def test_cache_is_bounded(stub_server):
+    server = stub_server([(200, BAR, 0)])
+    client = make_client(server, cache_ttl=60, cache_size=2)
+    for username in ('alice', 'bob', 'carol'):
+        client.get_bar(username)
+    client.get_bar('alice')
+    assert len(server.requests) == 4
+
+
+def test_waiting_requests_share_the_leader_error(stub_server):
+    server = stub_server([(200, BAR, 0)])
+    client = make_client(server)
+    started = threading.Event()
+
+    def failing_fetch(username):
+        started.set()
+        time.sleep(0.2)
+        raise RuntimeError("unexpected payload")
+
+    client._fetch_bar = failing_fetch
+    errors = []
+
+    def fetch():
+        try:
+            client.get_bar('alice')
+        except BaxusAPIError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=fetch)
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(target=fetch) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join(2)
+    assert len(errors) == 4
@@ -0,0 +1,37 @@
+import pandas as pd
+
+from benchmarks.generators import make_catalog, catalog_csv
+from catalog_store import CatalogStore
+from data_loader import preprocess_whisky_data, read_catalog_csv
+
+
+def write_csv(tmp_path, raw):
+    path = tmp_path / 'catalog.csv'
+    path.write_text(catalog_csv(raw))
+    return str(path)
+
+
+def assert_same_store(a, b):
+    assert list(a.columns) == list(b.columns)
+    for col in a.columns:
+        assert pd.Series(a.values(col)).equals(pd.Series(b.values(col))), col
+
+
+def test_chunked_read_matches_one_pass(tmp_path):
+    path = write_csv(tmp_path, make_catalog(2500, seed=0))
+    expected = CatalogStore.from_dataframe(preprocess_whisky_data(pd.read_csv(path)))
+    store = read_catalog_csv(path, chunksize=600)
+    assert_same_store(store, expected)
+    assert store.kind('brand') == 'category' and store.kind('name') == 'text'
+
+
+def test_generated_ids_do_not_depend_on_the_chunk_size(tmp_path):
+    raw = make_catalog(2000, seed=1)
+    raw['ID'] = raw['ID'].astype(object)
+    raw.loc[raw.index % 700 == 0, 'ID'] = None
+    path = write_csv(tmp_path, raw)
+    ids = list(read_catalog_csv(path, chunksize=300).values('id'))
+    assert ids == list(read_catalog_csv(path, chunksize=5000).values('id'))
+    assert [value for value in ids if str(value).startswith('gen_')] == ['gen_0', 'gen_1', 'gen_2']
+    assert len(set(ids)) == len(ids)
+    assert not any(str(value).endswith('.0') for value in ids)
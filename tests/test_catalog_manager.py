@@ -0,0 +1,56 @@
+import time
+
+from catalog_manager import CatalogManager
+
+
+class FakeRecommender:
+    def __init__(self, version):
+        self.catalog_version = version
+
+
+def flaky_loader(failures):
+    """Loader that fails `failures` times before returning a recommender"""
+    calls = []
+
+    def load(current_version):
+        calls.append(current_version)
+        if len(calls) <= failures:
+            raise RuntimeError("catalog source unavailable")
+        return FakeRecommender('v1')
+
+    return load, calls
+
+
+def test_wait_starts_the_first_load():
+    loader, calls = flaky_loader(0)
+    manager = CatalogManager(loader)
+    assert manager.wait(2).catalog_version == 'v1'
+    assert len(calls) == 1
+
+
+def test_failed_first_load_is_retried_after_backoff():
+    loader, calls = flaky_loader(2)
+    manager = CatalogManager(loader, retry_interval=0.2, max_retry_interval=1)
+
+    assert manager.wait(2) is None
+    assert manager.failures == 1
+    # Ainda dentro do intervalo: não tenta outra vez
+    assert manager.wait(2) is None
+    assert len(calls) == 1
+
+    time.sleep(0.25)
+    assert manager.wait(2) is None
+    assert len(calls) == 2
+    assert manager.retry_delay() == 0.4
+
+    time.sleep(0.45)
+    assert manager.wait(2).catalog_version == 'v1'
+    assert len(calls) == 3
+    assert manager.failures == 0
+    assert manager.last_error is None
+
+
+def test_retry_delay_is_capped():
+    manager = CatalogManager(lambda version: None, retry_interval=10, max_retry_interval=60)
+    manager.failures = 8
+    assert manager.retry_delay() == 60
@@ -0,0 +1,49 @@
+from explanation_stream import ExplanationStreams
+
+
+class FakeRecommender:
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+
+    @staticmethod
+    def reasoning_message(reasoning):
+        return " ".join(f"{reason}." for reason in reasoning)
+
+    def iter_llm_messages(self, recommendations, user_profile):
+        for position in range(len(recommendations)):
+            if position == self.fail_after:
+                raise RuntimeError("LLM client crashed")
+            yield position, f"LLM {position}"
+
+
+def make_result():
+    return {
+        'user_profile': {},
+        'similar_recommendations': [{'id': 1, 'reasoning': ['Same spirit'], 'llm_message': 'Same spirit.'},
+                                    {'id': 2, 'reasoning': ['Same region'], 'llm_message': None}],
+        'complementary_recommendations': [{'id': 3, 'reasoning': ['New region'], 'llm_message': 'New region.'}],
+        'explanations_pending': True,
+    }
+
+
+def run_job(recommender):
+    stored = []
+    job = ExplanationStreams().start('token', recommender, make_result(), on_complete=stored.append)
+    events = list(job.iter_events(5))
+    assert job.done
+    return events, stored
+
+
+def test_completed_explanations_are_stored():
+    events, stored = run_job(FakeRecommender())
+    assert [event['llm_message'] for event in events] == ['LLM 0', 'LLM 1', 'LLM 2']
+    assert len(stored) == 1 and stored[0]['explanations_pending'] is False
+    assert stored[0]['complementary_recommendations'][0]['llm_message'] == 'LLM 2'
+
+
+def test_failure_stores_the_rule_based_messages():
+    events, stored = run_job(FakeRecommender(fail_after=1))
+    assert [event['llm_message'] for event in events] == ['LLM 0']
+    assert len(stored) == 1 and stored[0]['explanations_pending'] is False
+    messages = [rec['llm_message'] for rec in stored[0]['similar_recommendations'] + stored[0]['complementary_recommendations']]
+    assert messages == ['LLM 0', 'Same region.', 'New region.']
@@ -0,0 +1,44 @@
+import json
+
+from llm_utils import parse_batch_reply
+
+ITEMS = [{'id': 11, 'message': "Smoky like your Islays."}, {'id': 12, 'message': "A softer wheated bourbon."}]
+EXPECTED = {'11': "Smoky like your Islays.", '12': "A softer wheated bourbon."}
+
+
+def test_plain_array():
+    assert parse_batch_reply(json.dumps(ITEMS), [11, 12]) == EXPECTED
+
+
+def test_fenced_array_with_prose():
+    text = f"Here are the explanations:\n```json\n{json.dumps(ITEMS, indent=2)}\n```\nEnjoy!"
+    assert parse_batch_reply(text, [11, 12]) == EXPECTED
+
+
+def test_array_wrapped_in_an_object():
+    assert parse_batch_reply(json.dumps({'explanations': ITEMS}), [11, 12]) == EXPECTED
+
+
+def test_id_to_message_object():
+    assert parse_batch_reply(json.dumps({'11': EXPECTED['11'], '12': EXPECTED['12']}), [11, 12]) == EXPECTED
+
+
+def test_single_item_object():
+    assert parse_batch_reply(json.dumps(ITEMS[0]), [11]) == {'11': EXPECTED['11']}
+    # Com vários ids pedidos, os que faltam ficam de fora (sem itens inventados)
+    assert parse_batch_reply(json.dumps(ITEMS[1]), [11, 12]) == {'12': EXPECTED['12']}
+    assert parse_batch_reply(json.dumps({'id': 12, 'explanation': "Rich."}), [12, 'id', 'message']) == {'12': "Rich."}
+
+
+def test_truncated_array_keeps_complete_items():
+    text = json.dumps(ITEMS + [{'id': 13, 'message': "Cut off"}])[:-20]
+    assert parse_batch_reply(text, [11, 12, 13]) == EXPECTED
+
+
+def test_unknown_and_empty_items_are_left_out():
+    items = ITEMS + [{'id': 99, 'message': "Not asked for"}, {'id': 13, 'message': "  "}]
+    assert parse_batch_reply(json.dumps(items), [11, 12, 13]) == EXPECTED
+
+
+def test_no_json():
+    assert parse_batch_reply("Sorry, I cannot help with that.", [11, 12]) == {}
@@ -0,0 +1,99 @@
+import time
+
+from llm_utils import LLMClient, CircuitBreaker
+
+
+def reply(content):
+    return {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+
+
+def make_client(server, **kwargs):
+    options = dict(api_key='test-key', url=server.url + '/v1/chat/completions', model='stub-model',
+                   timeout=2, max_workers=4, batch=False)
+    options.update(kwargs)
+    return LLMClient(**options)
+
+
+def test_iter_many_yields_every_message(stub_server):
+    server = stub_server([(200, reply(" A smoky pick. "), 0)])
+    client = make_client(server)
+    try:
+        messages = dict(client.iter_many(['first', 'second', 'third'], deadline=5))
+    finally:
+        client.close()
+    assert messages == {0: "A smoky pick.", 1: "A smoky pick.", 2: "A smoky pick."}
+    assert server.requests == ['/v1/chat/completions'] * 3
+    assert sorted(body['messages'][0]['content'] for body in server.bodies) == ['first', 'second', 'third']
+    assert all(body['model'] == 'stub-model' for body in server.bodies)
+
+
+def test_calls_past_the_deadline_yield_none(stub_server):
+    server = stub_server([(200, reply("Too late"), 1.0)])
+    client = make_client(server)
+    try:
+        start = time.monotonic()
+        messages = dict(client.iter_many(['first', 'second'], deadline=0.2))
+        elapsed = time.monotonic() - start
+    finally:
+        client.close()
+    assert messages == {0: None, 1: None}
+    assert elapsed < 0.9
+
+
+def test_generate_many_keeps_the_fallbacks_on_5xx(stub_server):
+    server = stub_server([(503, {'error': 'overloaded'}, 0)])
+    client = make_client(server)
+    try:
+        assert client.generate_many(['first', 'second'], fallbacks=['rule 1', 'rule 2'], deadline=5) == ['rule 1', 'rule 2']
+        assert client.generate_many(['first'], deadline=5) == [None]
+    finally:
+        client.close()
+
+
+def test_missing_api_key_falls_back_without_calling(stub_server, monkeypatch):
+    monkeypatch.delenv('LLM_API_KEY', raising=False)
+    server = stub_server([(200, reply("Unused"), 0)])
+    client = make_client(server, api_key='')
+    try:
+        assert client.generate_many(['first', 'second'], fallbacks=['rule 1', 'rule 2']) == ['rule 1', 'rule 2']
+        assert dict(client.iter_many(['first'])) == {0: None}
+    finally:
+        client.close()
+    assert server.requests == []
+
+
+def test_circuit_breaker_opens_and_lets_one_trial_through(stub_server):
+    server = stub_server([(500, {'error': 'down'}, 0)])
+    client = make_client(server, circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.3))
+    try:
+        assert client.generate_many(['first', 'second'], deadline=5) == [None, None]
+        assert client.circuit_breaker.state == 'open'
+
+        # Circuito aberto: nenhuma chamada chega ao endpoint
+        assert client.generate_many(['third'], deadline=5) == [None]
+        assert len(server.requests) == 2
+
+        # Depois do cool-down só uma chamada de teste passa; o sucesso fecha o circuito
+        server.script([(200, reply("Back up"), 0.1)])
+        time.sleep(0.35)
+        assert client.circuit_breaker.state == 'half-open'
+        messages = client.generate_many(['a', 'b', 'c'], deadline=5)
+        assert sorted(messages, key=str) == ["Back up", None, None]
+        assert len(server.requests) == 3
+        assert client.circuit_breaker.state == 'closed'
+        assert client.generate_many(['a', 'b'], deadline=5) == ["Back up", "Back up"]
+    finally:
+        client.close()
+
+
+def test_failed_trial_opens_the_circuit_again(stub_server):
+    server = stub_server([(500, {'error': 'down'}, 0)])
+    client = make_client(server, circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.2))
+    try:
+        assert client.generate_many(['first'], deadline=5) == [None]
+        time.sleep(0.25)
+        assert client.generate_many(['second', 'third'], deadline=5) == [None, None]
+        assert len(server.requests) == 2
+        assert client.circuit_breaker.state == 'open'
+    finally:
+        client.close()
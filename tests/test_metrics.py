@@ -0,0 +1,33 @@
+from instrumentation import CacheStats
+from ttl_cache import TTLCache
+
+
+def test_cache_counters_are_rendered():
+    cache = TTLCache(max_entries=1, ttl=60)
+    cache.set('a', 'x')
+    cache.set('b', 'y')
+    cache.get('b')
+    cache.get('a')
+    metric = CacheStats('test_cache_events', 'Cache events')
+    metric.register('bars', cache.stats)
+
+    lines = metric.render().splitlines()
+    assert '# TYPE test_cache_events_total counter' in lines
+    assert 'test_cache_events_total{cache="bars",event="hits"} 1' in lines
+    assert 'test_cache_events_total{cache="bars",event="misses"} 1' in lines
+    assert 'test_cache_events_total{cache="bars",event="evictions"} 1' in lines
+    assert 'test_cache_events_total{cache="bars",event="writes"} 2' in lines
+    assert 'test_cache_events_entries{cache="bars"} 1' in lines
+
+
+def test_failing_stats_source_is_skipped():
+    metric = CacheStats('test_cache_events', 'Cache events')
+
+    def broken():
+        raise OSError("disk gone")
+
+    metric.register('broken', broken)
+    metric.register('ok', TTLCache().stats)
+    text = metric.render()
+    assert 'cache="broken"' not in text
+    assert 'test_cache_events_entries{cache="ok"} 0' in text
@@ -0,0 +1,128 @@
+"""
+Recommendation results must be usable on any worker process.
+
+Runs the app under Gunicorn with several workers against the stubs of
+benchmarks.loadtest, and opens a new connection for every request so that
+consecutive requests of one user are spread over the workers.
+"""
+import os
+import re
+import sys
+import json
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+pytest.importorskip('gunicorn')
+
+from data_loader import preprocess_whisky_data
+from benchmarks.generators import make_catalog, catalog_csv
+from benchmarks.loadtest import StubService, BarPool, make_stub_handler, free_port, wait_until_ready
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKERS = 4
+SESSIONS = 20
+
+
+@pytest.fixture(scope='module')
+def stubs():
+    raw = make_catalog(300, seed=0)
+    bars = BarPool(preprocess_whisky_data(raw), [5, 15], [1, 1], seed=0)
+    quiet = StubService(0, 0, 0, 0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(catalog_csv(raw).encode(), bars, quiet, quiet))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='module')
+def app_url(stubs, tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('multiworker')
+    env = {key: value for key, value in os.environ.items() if not key.startswith(('RESULT_STORE', 'CATALOG_'))}
+    env.update(
+        BAXUS_API_URL=f"{stubs}/api",
+        LLM_API_URL=f"{stubs}/v1/chat/completions",
+        LLM_API_KEY='stub',
+        LLM_STREAMING='1',
+        CATALOG_URL=f"{stubs}/catalog.csv",
+        CATALOG_SNAPSHOT_DIR=str(workdir / 'snapshot'),
+        LOG_LEVEL='WARNING',
+    )
+    port = free_port()
+    log_path = workdir / 'app.log'
+    with open(log_path, 'w') as log_file:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'main:app', '--bind', f'127.0.0.1:{port}',
+             '--workers', str(WORKERS), '--log-level', 'warning'],
+            cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT
+        )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        # Cada pedido de prontidão pode cair num worker diferente: espera que vários respondam 200
+        for _ in range(WORKERS * 3):
+            wait_until_ready(base_url, process, 120)
+        yield base_url
+    except RuntimeError:
+        pytest.fail(log_path.read_text()[-4000:])
+    finally:
+        process.terminate()
+        process.wait(30)
+
+
+def new_connection_session():
+    """Cookies are kept, but every request goes over a new connection"""
+    http = requests.Session()
+    http.headers['Connection'] = 'close'
+    return http
+
+
+def test_results_are_found_on_every_worker(app_url):
+    failures = []
+    for number in range(SESSIONS):
+        http = new_connection_session()
+        response = http.post(f"{app_url}/analyze", data={'username': f"user{number}"}, allow_redirects=False, timeout=30)
+        assert response.headers.get('Location', '').endswith('/recommendations')
+
+        page = http.get(f"{app_url}/recommendations", allow_redirects=False, timeout=30)
+        match = re.search(r'id="barStatsData" data-url="([^"]+)"', page.text)
+        if page.status_code != 200 or match is None:
+            failures.append((number, 'recommendations', page.status_code))
+            continue
+
+        chart = http.get(f"{app_url}{match.group(1)}", timeout=30)
+        if chart.status_code != 200 or 'spirits_count' not in chart.json():
+            failures.append((number, 'bar_stats', chart.status_code))
+
+        stream = http.get(f"{app_url}/recommendations/stream", timeout=60)
+        if stream.status_code != 200 or 'event: done' not in stream.text:
+            failures.append((number, 'stream', stream.status_code))
+            continue
+        messages = [json.loads(line[len('data: '):]) for line in stream.text.splitlines()
+                    if line.startswith('data: ') and line != 'data: {}']
+        if not messages:
+            failures.append((number, 'explanations', stream.status_code))
+    assert failures == []
+
+
+def test_several_workers_need_a_shared_result_store(tmp_path):
+    env = {key: value for key, value in os.environ.items() if not key.startswith(('RESULT_STORE', 'CATALOG_'))}
+    env.update(RESULT_STORE_PATH='', CATALOG_OFFLINE='1', CATALOG_SNAPSHOT_DIR=str(tmp_path))
+    result = subprocess.run(
+        [sys.executable, '-m', 'gunicorn', 'main:app', '--bind', f'127.0.0.1:{free_port()}', '--workers', '2'],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode != 0
+    assert 'RESULT_STORE_PATH' in result.stderr
+
+
+def test_gunicorn_master_does_not_import_numpy():
+    code = ("import sys, runpy; runpy.run_path('gunicorn.conf.py'); "
+            "print(sorted(name for name in ('numpy', 'pandas', 'scipy') if name in sys.modules))")
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[]'
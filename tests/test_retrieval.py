@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from benchmarks.generators import make_catalog
+from data_loader import preprocess_whisky_data
+from recommendation_engine import WhiskyRecommender
+from retrieval import IVFRetriever, make_retriever
+
+
+def make_recommender(num_bottles=3000):
+    return WhiskyRecommender(preprocess_whisky_data(make_catalog(num_bottles, seed=1)), retrieval='exact')
+
+
+def test_ivf_probing_every_list_matches_the_exact_scan():
+    rec = make_recommender()
+    ivf = IVFRetriever(rec, n_lists=40, iterations=3).build()
+    ivf.n_probe = len(ivf.list_offsets) - 1
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        vector = rec.standardized_rows(rng.choice(len(rec.row_norms), size=5, replace=False)).mean(axis=0)
+        exclude = np.zeros(len(rec.row_norms), dtype=bool)
+        exclude[rng.choice(len(rec.row_norms), size=20, replace=False)] = True
+        expected = rec.retriever.search(vector, 10, exclude)
+        found = ivf.search(vector, 10, exclude)
+        assert np.array_equal(found[0], expected[0])
+        assert np.allclose(found[1], expected[1])
+
+
+def test_oversized_lists_are_split():
+    rec = make_recommender()
+    ivf = IVFRetriever(rec, n_lists=40, iterations=3, max_list_ratio=1.5).build()
+    sizes = np.diff(ivf.list_offsets)
+    assert sizes.sum() == len(rec.row_norms)
+    assert len(sizes) > 40
+    assert sizes.max() <= np.ceil(1.5 * len(rec.row_norms) / 40)
+
+
+def test_ivf_index_below_the_target_recall_is_rejected(monkeypatch):
+    rec = make_recommender()
+    monkeypatch.setenv("IVF_LISTS", "40")
+    monkeypatch.setenv("IVF_PROBES", "1")
+    monkeypatch.setenv("IVF_ITERATIONS", "3")
+    monkeypatch.setenv("IVF_RECALL_QUERIES", "20")
+    monkeypatch.setenv("IVF_TARGET_RECALL", "1.01")
+    retriever = make_retriever(rec, 'ivf')
+    assert retriever.name == 'exact'
+
+    # A rejeição persistida evita reconstruir o índice no próximo carregamento
+    state = retriever.get_state()
+    monkeypatch.setattr(IVFRetriever, 'build', lambda self: pytest.fail("rejected index rebuilt"))
+    assert make_retriever(rec, 'ivf', state=state).name == 'exact'
@@ -0,0 +1,146 @@
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    Two-tier key/value cache with expiration.
+
+    The memory tier is an LRU bounded to `max_entries` items; the optional disk tier
+    is a table in a SQLite file (`db_path`) that worker processes can share. Entries
+    in both tiers expire after `ttl` seconds. Values must be str or bytes to be
+    stored on disk. Expired rows are deleted from the disk tier every `purge_every` writes.
+    """
+
+    def __init__(self, max_entries=2048, ttl=86400, db_path=None, table='cache', purge_every=1000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.db_path = db_path
+        self.table = table
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'writes': 0}
+        if db_path:
+            with self._connection() as conn:
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    "key TEXT PRIMARY KEY, value NOT NULL, expires_at REAL NOT NULL)"
+                )
+
+    def _connection(self):
+        # Uma conexão por thread; WAL permite leitores e escritor em processos diferentes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return value
+                del self._entries[key]
+                self._counters['expirations'] += 1
+
+        if self.db_path:
+            try:
+                row = self._connection().execute(
+                    f"SELECT value, expires_at FROM {self.table} WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Cache read failed ({self.table}): {e}")
+                row = None
+            if row is not None:
+                self._count('disk_hits')
+                self._store_in_memory(key, row[0], row[1])
+                return row[0]
+
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._store_in_memory(key, value, expires_at)
+        with self._lock:
+            self._counters['writes'] += 1
+            purge = self.purge_every and self._counters['writes'] % self.purge_every == 0
+        if purge:
+            self.purge_expired()
+        if self.db_path:
+            try:
+                with self._connection() as conn:
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, value, expires_at)
+                    )
+            except sqlite3.Error as e:
+                logger.warning(f"Cache write failed ({self.table}): {e}")
+
+    def _store_in_memory(self, key, value, expires_at):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def delete(self, key):
+        """Drop one key from both tiers"""
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.db_path:
+            try:
+                with self._connection() as conn:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            except sqlite3.Error as e:
+                logger.warning(f"Cache delete failed ({self.table}): {e}")
+
+    def purge_expired(self):
+        """Drop expired entries from both tiers"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                del self._entries[key]
+            self._counters['expirations'] += len(expired)
+        if self.db_path:
+            try:
+                with self._connection() as conn:
+                    conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+            except sqlite3.Error as e:
+                logger.warning(f"Cache purge failed ({self.table}): {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.db_path:
+            with self._connection() as conn:
+                conn.execute(f"DELETE FROM {self.table}")
+
+    def stats(self):
+        """Hit, miss and eviction counters plus the current memory size"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._entries)
+        return stats